@@ -0,0 +1,67 @@
+"""Compare the vectorised annotation matrix with the per-scan loop.
+
+Usage (from this folder): python annotation_matrix.py [n_spectra]
+
+Requires spectrum_fundamentals for the reference loop.
+"""
+import sys
+import time
+
+import numpy as np
+from spectrum_fundamentals.annotation.annotation import generate_annotation_matrix
+from spectrum_fundamentals.mod_string import internal_without_mods
+from synthetic import synthetic_annotations, synthetic_metadata
+
+from prospectdataset.process_intensity_data import build_annotation_matrix
+
+
+def per_scan_loop(annotation_df, metadata_df):
+    charge_seq = metadata_df.groupby(["raw_file", "scan_number"]).agg(
+        {
+            "precursor_charge": lambda x: np.unique(x)[0],
+            "modified_sequence": lambda x: np.unique(x)[0],
+        }
+    )
+    intensities_raw, masses_raw = [], []
+    for (raw_file, scan_number), spectrum in annotation_df.groupby(
+        ["raw_file", "scan_number"]
+    ):
+        charge, mod_sequence = charge_seq.loc[raw_file, scan_number]
+        unmod_seq = internal_without_mods([mod_sequence])[0]
+        intensities, mz = generate_annotation_matrix(spectrum, unmod_seq, charge)
+        intensities_raw.append(intensities)
+        masses_raw.append(mz)
+    return np.stack(intensities_raw), np.stack(masses_raw)
+
+
+def main(n_spectra=20000):
+    metadata = synthetic_metadata(n_spectra)
+    annotations = synthetic_annotations(metadata)
+    annotations = annotations[
+        (annotations.neutral_loss == "") & (annotations.ion_type != "precursor")
+    ]
+    annotations = annotations.drop_duplicates(
+        subset=["raw_file", "scan_number", "ion_type", "no", "charge"]
+    ).rename(columns={"experimental_mass": "exp_mass"})
+
+    start = time.perf_counter()
+    expected_intensities, expected_masses = per_scan_loop(annotations, metadata)
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, _, intensities, masses = build_annotation_matrix(
+        annotations, metadata, dtype="float64"
+    )
+    vectorised_time = time.perf_counter() - start
+
+    assert np.array_equal(intensities, expected_intensities)
+    assert np.array_equal(masses, expected_masses)
+
+    print("spectra:            ", n_spectra)
+    print("per-scan loop [s]:  ", round(loop_time, 3))
+    print("vectorised [s]:     ", round(vectorised_time, 3))
+    print("speedup:            ", round(loop_time / vectorised_time, 1))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
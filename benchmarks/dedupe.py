@@ -0,0 +1,54 @@
+"""Compare the dedupe kernel with sort_values/drop_duplicates in pandas.
+
+Both are timed on string key columns and on the dictionary-encoded (categorical) key
+columns the processing reads, the best of `repeat` runs is reported.
+
+Usage (from this folder): python dedupe.py [n_spectra] [repeat]
+"""
+import sys
+import time
+
+from synthetic import synthetic_annotations, synthetic_metadata
+
+from prospectdataset.dedupe import FRAGMENT_KEYS, MASS_KEYS, dedupe_annotations
+from prospectdataset.keys import encode_dictionary_columns
+
+
+def pandas_dedupe(df):
+    df = df.sort_values(by="fragment_score", ascending=False, kind="stable")
+    df = df.drop_duplicates(subset=MASS_KEYS, keep="first")
+    df = df.sort_values(by="intensity", ascending=False, kind="stable")
+    return df.drop_duplicates(subset=FRAGMENT_KEYS, keep="first")
+
+
+def best_time(func, df, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(df)
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def main(n_spectra=100000, repeat=3):
+    annotations = synthetic_annotations(synthetic_metadata(n_spectra))
+    # create collisions on experimental peaks and fragment ions
+    annotations["experimental_mass"] = annotations["experimental_mass"].round(0)
+
+    for name, df in [
+        ("string keys", annotations),
+        ("categorical keys", encode_dictionary_columns(annotations)),
+    ]:
+        expected, pandas_time = best_time(pandas_dedupe, df, repeat)
+        result, kernel_time = best_time(dedupe_annotations, df, repeat)
+        assert result.index.sort_values().equals(expected.index.sort_values())
+
+        print(name)
+        print("  annotations:      ", len(df), "->", len(result))
+        print("  pandas [s]:       ", round(pandas_time, 3))
+        print("  kernel [s]:       ", round(kernel_time, 3))
+        print("  speedup:          ", round(pandas_time / kernel_time, 1))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
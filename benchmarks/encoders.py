@@ -0,0 +1,64 @@
+"""Compare per-row feature encoding with the vectorised encoders.
+
+Measures building the encoded columns and writing them to parquet.
+
+Usage (from this folder): python encoders.py [n_spectra]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from synthetic import synthetic_metadata
+
+from prospectdataset.encoders import encode_features, write_parquet
+from prospectdataset.keys import encode_dictionary_columns
+from prospectdataset.process_intensity_data import precursor_int_to_onehot
+
+
+def apply_features(df):
+    from spectrum_fundamentals.constants import FRAGMENTATION_ENCODING
+
+    df["collision_energy_aligned_normed"] = df["aligned_collision_energy"].apply(
+        lambda x: x / 100.0
+    )
+    df["method_nbr"] = df["fragmentation"].map(FRAGMENTATION_ENCODING)
+    df["precursor_charge_onehot"] = df["precursor_charge"].apply(
+        precursor_int_to_onehot
+    )
+    return df
+
+
+def main(n_spectra=1000000):
+    # string columns are categoricals in the processing pipeline
+    metadata = encode_dictionary_columns(synthetic_metadata(n_spectra))
+    columns = ["aligned_collision_energy", "fragmentation", "precursor_charge"]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "features.parquet")
+
+        start = time.perf_counter()
+        apply_df = apply_features(metadata[columns].copy())
+        apply_time = time.perf_counter() - start
+        apply_df.to_parquet(path, index=False)
+        apply_write_time = time.perf_counter() - start - apply_time
+
+        start = time.perf_counter()
+        encoded_df = encode_features(metadata[columns].copy())
+        encode_time = time.perf_counter() - start
+        write_parquet(encoded_df, path)
+        encode_write_time = time.perf_counter() - start - encode_time
+
+    print("spectra:            ", n_spectra)
+    print("apply [s]:          ", round(apply_time, 3))
+    print("apply write [s]:    ", round(apply_write_time, 3))
+    print("encoders [s]:       ", round(encode_time, 3))
+    print("encoders write [s]: ", round(encode_write_time, 3))
+    print(
+        "speedup:            ",
+        round((apply_time + apply_write_time) / (encode_time + encode_write_time), 1),
+    )
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,55 @@
+"""Compare random access to spectra in npy shards with reading the processed parquet file.
+
+Usage (from this folder): python export.py [n_spectra] [batch_size]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from synthetic import synthetic_metadata
+
+from prospectdataset.encoders import encode_features, write_parquet
+from prospectdataset.export import SpectrumShards, export_spectra
+
+
+def synthetic_pool(n_spectra, seed=0):
+    # processed pool with random annotation matrices
+    rng = np.random.default_rng(seed)
+    df = encode_features(synthetic_metadata(n_spectra, seed=seed))
+    df["intensities_raw"] = list(rng.random((n_spectra, 174), dtype=np.float32))
+    df["masses_raw"] = list(rng.random((n_spectra, 174), dtype=np.float32))
+    return df
+
+
+def main(n_spectra=200000, batch_size=1024):
+    df = synthetic_pool(n_spectra)
+    indices = np.random.default_rng(1).integers(0, n_spectra, batch_size)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        parquet_path = os.path.join(tmp_dir, "pool.parquet")
+        write_parquet(df, parquet_path)
+        export_spectra(df, os.path.join(tmp_dir, "pool"), shard_size=50000)
+
+        start = time.perf_counter()
+        pool = pd.read_parquet(parquet_path, columns=["intensities_raw"])
+        expected = np.stack(pool["intensities_raw"].to_numpy()[indices])
+        parquet_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        shards = SpectrumShards(os.path.join(tmp_dir, "pool"))
+        result = shards.get_batch(indices, ["intensities"])["intensities"]
+        shards_time = time.perf_counter() - start
+
+    assert np.array_equal(result, expected)
+
+    print("spectra:            ", n_spectra, "batch:", batch_size)
+    print("parquet [s]:        ", round(parquet_time, 3))
+    print("npy shards [s]:     ", round(shards_time, 3))
+    print("speedup:            ", round(parquet_time / shards_time, 1))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,60 @@
+"""Compare (raw_file, scan_number) lookups on strings and on packed int64 keys.
+
+Every annotated peak is matched to its spectrum in the metadata, once with a pandas
+MultiIndex of object string keys and once with the packed keys of `prospectdataset.keys`.
+
+Usage (from this folder): python keys.py [n_spectra]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from synthetic import synthetic_annotations, synthetic_metadata
+
+from prospectdataset.keys import KEY_COLUMNS, encode_dictionary_columns, spectrum_keys
+
+
+def memory_mb(df):
+    return df.memory_usage(deep=True).sum() / 1024**2
+
+
+def main(n_spectra=100000):
+    metadata = synthetic_metadata(n_spectra)
+    annotations = synthetic_annotations(metadata)
+    string_mb = memory_mb(annotations)
+
+    start = time.perf_counter()
+    index = pd.MultiIndex.from_frame(metadata[KEY_COLUMNS]).sort_values()
+    expected = index.get_indexer(
+        pd.MultiIndex.from_frame(annotations[KEY_COLUMNS].astype(object))
+    )
+    string_time = time.perf_counter() - start
+
+    metadata = encode_dictionary_columns(metadata)
+    annotations = encode_dictionary_columns(annotations)
+    categorical_mb = memory_mb(annotations)
+
+    start = time.perf_counter()
+    categories = metadata["raw_file"].cat.categories
+    metadata_keys = np.sort(
+        spectrum_keys(metadata["raw_file"], metadata["scan_number"], categories)
+    )
+    result = np.searchsorted(
+        metadata_keys,
+        spectrum_keys(annotations["raw_file"], annotations["scan_number"], categories),
+    )
+    packed_time = time.perf_counter() - start
+
+    assert np.array_equal(result, expected)
+
+    print("annotations:        ", len(annotations))
+    print("memory strings [MB]:", round(string_mb, 1))
+    print("memory dict [MB]:   ", round(categorical_mb, 1))
+    print("string keys [s]:    ", round(string_time, 3))
+    print("packed keys [s]:    ", round(packed_time, 3))
+    print("speedup:            ", round(string_time / packed_time, 1))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,77 @@
+"""Compare serving shuffled NumPy batches with BatchLoader and with pd.read_parquet.
+
+Usage (from this folder): python loader.py [n_spectra] [batch_size]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from export import synthetic_pool
+
+from prospectdataset.encoders import write_parquet
+from prospectdataset.loader import BatchLoader
+
+COLUMNS = [
+    "intensities_raw",
+    "masses_raw",
+    "precursor_charge_onehot",
+    "collision_energy_aligned_normed",
+]
+
+
+def pandas_batches(path, batch_size, seed=0):
+    # read everything, shuffle, stack the per-row arrays of each batch
+    df = pd.read_parquet(path, columns=COLUMNS)
+    order = np.random.default_rng(seed).permutation(len(df))
+    for start in range(0, len(df), batch_size):
+        rows = order[start : start + batch_size]
+        yield {
+            column: np.stack(df[column].to_numpy()[rows])
+            if df[column].dtype == object
+            else df[column].to_numpy()[rows]
+            for column in COLUMNS
+        }
+
+
+def consume(batches):
+    start = time.perf_counter()
+    n_rows, n_bytes = 0, 0
+    for batch in batches:
+        n_rows += len(batch[COLUMNS[0]])
+        n_bytes += sum(values.nbytes for values in batch.values())
+    return n_rows, n_bytes / 1024**2, time.perf_counter() - start
+
+
+def main(n_spectra=200000, batch_size=1024):
+    df = synthetic_pool(n_spectra)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "pool.parquet")
+        write_parquet(df, path, row_group_size=20000)
+        del df
+
+        pandas_rows, size, pandas_time = consume(pandas_batches(path, batch_size))
+        loader = BatchLoader(path, COLUMNS, batch_size=batch_size)
+        loader_rows, size, loader_time = consume(loader)
+
+    assert pandas_rows == loader_rows == n_spectra
+
+    print("spectra:            ", n_spectra, "batch:", batch_size)
+    print(
+        "pd.read_parquet [s]:",
+        round(pandas_time, 3),
+        "({:.0f} MB/s)".format(size / pandas_time),
+    )
+    print(
+        "BatchLoader [s]:    ",
+        round(loader_time, 3),
+        "({:.0f} MB/s)".format(size / loader_time),
+    )
+    print("speedup:            ", round(pandas_time / loader_time, 1))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
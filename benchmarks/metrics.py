@@ -0,0 +1,73 @@
+"""Compare masked_spectral_distance with the batched float32 version on memory-mapped arrays.
+
+Usage (from this folder): python metrics.py [n_spectra]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from prospectdataset.metrics import (
+    batched_masked_spectral_distance,
+    masked_spectral_distance,
+)
+
+
+def synthetic_spectra(n_spectra, n_peaks=174, seed=0):
+    # observed intensities with masked (-1) and missing (0) peaks, and noisy predictions
+    rng = np.random.default_rng(seed)
+    y_true = rng.random((n_spectra, n_peaks), dtype=np.float32)
+    y_true[rng.random(y_true.shape) < 0.3] = -1
+    y_true[rng.random(y_true.shape) < 0.3] = 0
+    noise = rng.normal(0, 0.1, y_true.shape).astype(np.float32)
+    return y_true, np.clip(y_true + noise, 0, None)
+
+
+def measure(function):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak / 1024**2
+
+
+def main(n_spectra=500000):
+    y_true, y_pred = synthetic_spectra(n_spectra)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        np.save(os.path.join(tmp_dir, "true.npy"), y_true)
+        np.save(os.path.join(tmp_dir, "pred.npy"), y_pred)
+        del y_true, y_pred
+        y_true = np.load(os.path.join(tmp_dir, "true.npy"), mmap_mode="r")
+        y_pred = np.load(os.path.join(tmp_dir, "pred.npy"), mmap_mode="r")
+
+        expected, full_time, full_memory = measure(
+            lambda: masked_spectral_distance(y_true, y_pred)
+        )
+        (result, histogram), batched_time, batched_memory = measure(
+            lambda: batched_masked_spectral_distance(y_true, y_pred)
+        )
+        del y_true, y_pred
+
+    valid = ~np.isnan(expected)
+    assert np.allclose(result[valid], expected[valid], atol=1e-3)
+
+    print("spectra:            ", n_spectra)
+    print("full [s]:           ", round(full_time, 3), "peak MB:", round(full_memory))
+    print(
+        "batched [s]:        ",
+        round(batched_time, 3),
+        "peak MB:",
+        round(batched_memory),
+    )
+    print("speedup:            ", round(full_time / batched_time, 1))
+    print("median distance:    ", round(histogram.summary()["median"], 4))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
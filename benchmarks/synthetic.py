@@ -0,0 +1,50 @@
+"""Synthetic PROSPECT-like pools for the benchmarks in this folder."""
+import numpy as np
+import pandas as pd
+
+AMINO_ACIDS = list("ACDEFGHIKLMNPQRSTVWY")
+
+
+def synthetic_metadata(n_spectra=20000, n_raw_files=10, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(7, 35, n_spectra)
+    sequences = [
+        "".join(rng.choice(AMINO_ACIDS, length)).replace("M", "M[UNIMOD:35]", 1)
+        for length in lengths
+    ]
+    return pd.DataFrame(
+        {
+            "raw_file": np.array(["raw_file_{}".format(i) for i in range(n_raw_files)])[
+                rng.integers(0, n_raw_files, n_spectra)
+            ],
+            "scan_number": np.arange(n_spectra) + 1,
+            "modified_sequence": sequences,
+            "precursor_charge": rng.integers(1, 5, n_spectra),
+            "peptide_length": lengths,
+            "andromeda_score": rng.uniform(0, 300, n_spectra),
+            "indexed_retention_time": rng.normal(50, 30, n_spectra),
+            "aligned_collision_energy": rng.uniform(20, 40, n_spectra),
+            "fragmentation": rng.choice(["HCD", "CID"], n_spectra),
+        }
+    )
+
+
+def synthetic_annotations(metadata, peaks_per_spectrum=40, seed=0):
+    rng = np.random.default_rng(seed)
+    n = len(metadata) * peaks_per_spectrum
+    spectrum = np.repeat(np.arange(len(metadata)), peaks_per_spectrum)
+    lengths = metadata["peptide_length"].to_numpy()[spectrum]
+    return pd.DataFrame(
+        {
+            "raw_file": metadata["raw_file"].to_numpy()[spectrum],
+            "scan_number": metadata["scan_number"].to_numpy()[spectrum],
+            "ion_type": rng.choice(["y", "b", "precursor"], n, p=[0.48, 0.48, 0.04]),
+            "no": rng.integers(1, lengths),
+            "charge": rng.integers(1, 4, n),
+            "experimental_mass": rng.uniform(100, 2000, n).round(2),
+            "theoretical_mass": rng.uniform(100, 2000, n),
+            "intensity": rng.uniform(0, 1, n).astype(np.float32),
+            "neutral_loss": rng.choice(["", "", "", "H2O", "NH3"], n),
+            "fragment_score": rng.integers(0, 100, n),
+        }
+    )
@@ -1,13 +1,33 @@
 from .config import AVAILABLE_DATASET_RECORDS, AVAILABLE_DATASET_URLS
+from .dataset import Dataset, col
 from .download import download_dataset
-from .metrics import masked_spectral_distance, timedelta_metric
+from .export import SpectrumShards
+from .index import SpectrumIndex
+from .loader import BatchLoader
+from .metrics import (
+    TimedeltaAccumulator,
+    batched_masked_spectral_distance,
+    grouped_timedelta_metric,
+    masked_spectral_distance,
+    timedelta_metric,
+)
 from .process_intensity_data import download_process_pool
+from .profiling import PipelineProfile
 
 __all__ = [
     "download_dataset",
     "download_process_pool",
+    "PipelineProfile",
+    "Dataset",
+    "col",
+    "SpectrumShards",
+    "SpectrumIndex",
+    "BatchLoader",
     "masked_spectral_distance",
+    "batched_masked_spectral_distance",
     "timedelta_metric",
+    "grouped_timedelta_metric",
+    "TimedeltaAccumulator",
     "AVAILABLE_DATASET_URLS",
     "AVAILABLE_DATASET_RECORDS",
 ]
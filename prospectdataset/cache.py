@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+from .config import CACHE_DIR_ENV_VARIABLE
+
+INDEX_FILENAME = "index.json"
+LOCK_FILENAME = "index.lock"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_checksum(path, algorithm="md5", chunk_size=HASH_CHUNK_SIZE):
+    hasher = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def split_checksum(checksum):
+    # Zenodo publishes checksums as "md5:<hexdigest>"
+    if ":" in checksum:
+        algorithm, digest = checksum.split(":", 1)
+        return algorithm, digest
+    return "md5", checksum
+
+
+def default_cache_dir(save_directory=""):
+    return os.environ.get(CACHE_DIR_ENV_VARIABLE) or os.path.join(
+        save_directory, ".cache"
+    )
+
+
+def link_file(src, dst, link="hardlink"):
+    """Make `src` available as `dst` via a hard link, symbolic link or copy.
+
+    Hard links fall back to symbolic links (e.g. across file systems), symbolic links
+    fall back to copying.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if link == "hardlink":
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            link = "symlink"
+    if link == "symlink":
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return dst
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return dst
+
+
+class DatasetCache:
+    """Content-addressed cache of downloaded dataset files.
+
+    Files are stored under `<cache_dir>/<record_id>/<checksum>/<filename>` and tracked in
+    a JSON index with their size and last access time. The index is updated under a file
+    lock, so a cache directory can be shared by several processes. If `max_size` (bytes)
+    is set, the least recently used files are evicted once the files held only by the
+    cache grow beyond it. Files that are also hard-linked into a save directory do not
+    count, removing them from the cache would not free any space.
+    """
+
+    def __init__(self, cache_dir, max_size=None, link="hardlink"):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.link = link
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def index_path(self):
+        return os.path.join(self.cache_dir, INDEX_FILENAME)
+
+    @contextmanager
+    def _locked(self):
+        # serialise index updates between threads and processes (file lock where fcntl
+        # is available)
+        with self._lock:
+            try:
+                import fcntl
+            except ImportError:
+                yield
+                return
+            with open(os.path.join(self.cache_dir, LOCK_FILENAME), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        tmp_path = "{}.{}.tmp".format(self.index_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def key(record_id, checksum):
+        return "{}/{}".format(record_id, split_checksum(checksum)[1])
+
+    def entry_dir(self, record_id, checksum):
+        return os.path.join(self.cache_dir, self.key(record_id, checksum))
+
+    def path(self, record_id, checksum, filename):
+        return os.path.join(self.entry_dir(record_id, checksum), filename)
+
+    def get(self, record_id, checksum, filename):
+        """Return the cached path of a file or None if it is not cached."""
+        path = self.path(record_id, checksum, filename)
+        with self._locked():
+            index = self._read_index()
+            entry = index.get(self.key(record_id, checksum))
+            if entry is None or not os.path.exists(path):
+                return None
+            if os.path.getsize(path) != entry["size"]:
+                return None
+            entry["last_access"] = time.time()
+            self._write_index(index)
+        return path
+
+    def add(self, record_id, checksum, filename, src_path):
+        """Move a downloaded and verified file into the cache and return its path."""
+        path = self.path(record_id, checksum, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.abspath(src_path) != os.path.abspath(path):
+            os.replace(src_path, path)
+        with self._locked():
+            index = self._read_index()
+            index[self.key(record_id, checksum)] = {
+                "filename": filename,
+                "size": os.path.getsize(path),
+                "last_access": time.time(),
+            }
+            self._write_index(index)
+        self.evict(keep=[self.key(record_id, checksum)])
+        return path
+
+    def remove(self, record_id, checksum):
+        """Remove a file from the cache, links to it elsewhere stay valid (hard links)
+        or break (symbolic links)."""
+        key = self.key(record_id, checksum)
+        with self._locked():
+            index = self._read_index()
+            index.pop(key, None)
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            self._write_index(index)
+
+    def link_into(self, cached_path, save_directory):
+        dst = os.path.join(save_directory, os.path.basename(cached_path))
+        if os.path.exists(dst) and os.path.samefile(cached_path, dst):
+            return dst
+        return link_file(cached_path, dst, self.link)
+
+    def size(self):
+        return sum(e["size"] for e in self._read_index().values())
+
+    def held_size(self, key, entry):
+        # bytes freed by removing an entry, none if the file has other hard links
+        try:
+            stat = os.stat(os.path.join(self.cache_dir, key, entry["filename"]))
+        except OSError:
+            return 0
+        return entry["size"] if stat.st_nlink <= 1 else 0
+
+    def evict(self, keep=()):
+        """Remove least recently used files until the cache fits into `max_size`."""
+        if self.max_size is None:
+            return []
+
+        evicted = []
+        with self._locked():
+            index = self._read_index()
+            held = {key: self.held_size(key, entry) for key, entry in index.items()}
+            total = sum(held.values())
+            lru_keys = sorted(index, key=lambda k: index[k]["last_access"])
+            for key in lru_keys:
+                if total <= self.max_size:
+                    break
+                if key in keep or not held[key]:
+                    continue
+                index.pop(key)
+                shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+                total -= held[key]
+                evicted.append(key)
+            self._write_index(index)
+
+        for key in evicted:
+            print("Evicted from cache: ", key)
+        return evicted
@@ -1,5 +1,8 @@
 ZENODO_BASE = "https://zenodo.org/"
 ZENODO_BASE_RECORD = "https://zenodo.org/record/"
+ZENODO_API_RECORDS = "https://zenodo.org/api/records/"
+
+CACHE_DIR_ENV_VARIABLE = "PROSPECT_CACHE_DIR"
 
 AVAILABLE_DATASET_RECORDS = {
     "prospect": "6602020",
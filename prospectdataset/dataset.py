@@ -0,0 +1,236 @@
+import copy
+import glob
+import os
+import time
+from collections import namedtuple
+
+from .cache import default_cache_dir
+from .config import AVAILABLE_DATASET_RECORDS
+from .keys import DICTIONARY_COLUMNS, encode_dictionary_columns
+from .manifest import META_DATA_KIND, load_manifest, parse_file_name
+from .readers import criteria_to_expression, log_throughput, parquet_format
+
+# columns of every row holding the pool and package of its file
+POOL_COLUMNS = ["pool", "package"]
+BATCH_SIZE = 100_000
+
+PoolFile = namedtuple("PoolFile", ["path", "pool", "package"])
+
+
+def col(name):
+    """Reference a column in `Dataset.filter`, e.g. `col("andromeda_score") >= 70`."""
+    import pyarrow.dataset as ds
+
+    return ds.field(name)
+
+
+def local_files(path):
+    # parquet files of a file, directory or glob pattern with their pool and package
+    if os.path.isdir(path):
+        paths = sorted(glob.glob(os.path.join(path, "*.parquet")))
+    else:
+        paths = sorted(glob.glob(path)) or [path]
+    files = []
+    for path in paths:
+        stem = os.path.basename(path).split(".", 1)[0]
+        package, pool, _ = parse_file_name(os.path.basename(path))
+        files.append(PoolFile(path, pool or stem, package or stem))
+    return files
+
+
+def record_files(record, directory="", cache_dir=None, offline=False):
+    # metadata files of a record listed in its manifest, downloaded or not
+    manifest = load_manifest(
+        record, cache_dir=cache_dir or default_cache_dir(directory), offline=offline
+    )
+    return [
+        PoolFile(os.path.join(directory, f.name), f.pool, f.package)
+        for f in manifest
+        if f.kind == META_DATA_KIND
+    ]
+
+
+class Dataset:
+    """Lazy query over the pools of PROSPECT records or local parquet files.
+
+    `filter` and `select` only record the query, nothing is read until `to_arrow`,
+    `to_pandas` or `iter_batches`. The plan prunes pools by the `pool` and `package`
+    columns (known from the file names) and row groups by their parquet statistics, then
+    reads only the selected columns of the remaining row groups:
+
+        from prospectdataset import Dataset, col
+
+        query = (
+            Dataset("prospect", directory="data")
+            .filter(col("andromeda_score") >= 70, col("peptide_length") <= 30)
+            .filter(col("package") == "TUM_first_pool")
+            .select(["modified_sequence", "indexed_retention_time", "pool"])
+        )
+        print(query.explain())
+        df = query.to_pandas()
+
+    A source is a record name (its metadata files are listed by the manifest and
+    expected in `directory`), a parquet file, a directory or a glob pattern. Filters
+    are pyarrow expressions built with `col`, or criteria dicts as in
+    `metadata_filtering_criteria`.
+    """
+
+    def __init__(
+        self,
+        source="prospect",
+        directory="",
+        cache_dir=None,
+        offline=False,
+        dictionary_columns=DICTIONARY_COLUMNS,
+    ):
+        sources = [source] if isinstance(source, str) else list(source)
+        self.files = []
+        for name in sources:
+            if name in AVAILABLE_DATASET_RECORDS:
+                self.files += record_files(name, directory, cache_dir, offline)
+            else:
+                self.files += local_files(name)
+        self.sources = sources
+        self.dictionary_columns = dictionary_columns
+        self.expression = None
+        self.columns = None
+        self._dataset = None
+
+    def _replace(self, **attributes):
+        query = copy.copy(self)
+        query.__dict__.update(attributes)
+        return query
+
+    def filter(self, *predicates):
+        """Keep the rows matching all `predicates`, returns a new Dataset."""
+        expression = self.expression
+        for predicate in predicates:
+            if isinstance(predicate, dict):
+                predicate = criteria_to_expression(predicate)
+            if predicate is None:
+                continue
+            expression = predicate if expression is None else expression & predicate
+        return self._replace(expression=expression)
+
+    def select(self, columns):
+        """Read only `columns`, returns a new Dataset."""
+        return self._replace(columns=list(columns))
+
+    def dataset(self):
+        """The pyarrow dataset of all files, with the pool and package of each file as
+        its partition expression. Only the footers of the local files are read."""
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.fs as fs
+
+        if self._dataset is not None:
+            return self._dataset
+        local = [f for f in self.files if os.path.exists(f.path)]
+        if not local:
+            raise FileNotFoundError(
+                "None of the {} files of {} are available locally, download them with "
+                "download_dataset.".format(len(self.files), self.sources)
+            )
+        file_format = parquet_format(self.dictionary_columns)
+        filesystem = fs.LocalFileSystem()
+        schema = pa.unify_schemas(
+            [file_format.inspect(f.path, filesystem) for f in local],
+            promote_options="permissive",
+        )
+        for name in POOL_COLUMNS:
+            if name not in schema.names:
+                schema = schema.append(pa.field(name, pa.string()))
+        self._dataset = ds.FileSystemDataset.from_paths(
+            [f.path for f in self.files],
+            schema=schema,
+            format=file_format,
+            filesystem=filesystem,
+            partitions=[
+                (ds.field("pool") == f.pool) & (ds.field("package") == f.package)
+                for f in self.files
+            ],
+        )
+        return self._dataset
+
+    @property
+    def schema(self):
+        return self.dataset().schema
+
+    def plan(self):
+        """Files of the pools that pass the filter, with the row groups to read.
+
+        Returns (file, row group fragments, number of row groups) per file, the
+        fragments are None for files that are not available locally.
+        """
+        dataset = self.dataset()
+        files = {f.path: f for f in self.files}
+        plan = []
+        for fragment in dataset.get_fragments(filter=self.expression):
+            if not os.path.exists(fragment.path):
+                plan.append((files[fragment.path], None, 0))
+                continue
+            row_groups = fragment.split_by_row_group(
+                filter=self.expression, schema=dataset.schema
+            )
+            plan.append((files[fragment.path], row_groups, fragment.num_row_groups))
+        return plan
+
+    def explain(self):
+        """Describe the plan: the filter, the columns and the row groups of each pool."""
+        plan = self.plan()
+        lines = [
+            "Dataset of {} files from {}".format(len(self.files), self.sources),
+            "Filter: {}".format(self.expression),
+            "Columns: {}".format(self.columns or "all"),
+            "Pools: {} of {} after pruning by pool and package".format(
+                len(plan), len(self.files)
+            ),
+        ]
+        for f, row_groups, n_row_groups in plan:
+            if row_groups is None:
+                lines.append("  {}: missing, {}".format(f.pool, f.path))
+                continue
+            lines.append(
+                "  {}: {} of {} row groups, {} rows before filtering".format(
+                    f.pool,
+                    len(row_groups),
+                    n_row_groups,
+                    sum(
+                        rg.num_rows
+                        for fragment in row_groups
+                        for rg in fragment.row_groups
+                    ),
+                )
+            )
+        return "\n".join(lines)
+
+    def scanner(self, batch_size=BATCH_SIZE):
+        import pyarrow.dataset as ds
+
+        plan = self.plan()
+        missing = [f.path for f, row_groups, _ in plan if row_groups is None]
+        if missing:
+            raise FileNotFoundError(
+                "Files of the selected pools are not downloaded: {}".format(missing)
+            )
+        dataset = self.dataset()
+        return ds.FileSystemDataset(
+            [fragment for _, row_groups, _ in plan for fragment in row_groups],
+            dataset.schema,
+            dataset.format,
+            dataset.filesystem,
+        ).scanner(columns=self.columns, filter=self.expression, batch_size=batch_size)
+
+    def to_arrow(self):
+        start = time.perf_counter()
+        table = self.scanner().to_table()
+        log_throughput(", ".join(self.sources), table, time.perf_counter() - start)
+        return table
+
+    def to_pandas(self):
+        """Materialise the query as a DataFrame, dictionary columns as categoricals."""
+        return encode_dictionary_columns(self.to_arrow().to_pandas())
+
+    def iter_batches(self, batch_size=BATCH_SIZE):
+        """Yield the rows of the query as record batches."""
+        yield from self.scanner(batch_size).to_batches()
@@ -0,0 +1,144 @@
+MASS_KEYS = ["raw_file", "scan_number", "experimental_mass"]
+FRAGMENT_KEYS = ["raw_file", "scan_number", "ion_type", "no", "charge"]
+
+
+def encode_column(values):
+    # integer codes (or the values themselves if integer) that identify each value
+    import numpy as np
+    import pandas as pd
+
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy()
+    values = values.to_numpy()
+    if np.issubdtype(values.dtype, np.integer):
+        return values
+    return pd.factorize(values)[0]
+
+
+def ordered_codes(values):
+    # non-negative int64 codes that sort like the values and their number of values
+    import numpy as np
+
+    if np.issubdtype(values.dtype, np.integer) or values.dtype == bool:
+        values = values.astype(np.int64)
+        low = values.min()
+        return values - low, int(values.max() - low) + 1
+    uniques, inverse = np.unique(values, return_inverse=True)
+    return inverse.astype(np.int64).ravel(), len(uniques)
+
+
+def descending(values):
+    # negated values sort in descending order, unsigned integers are widened first so
+    # that they do not wrap around
+    import numpy as np
+
+    values = np.asarray(values)
+    if values.dtype.kind in "ub":
+        values = values.astype(np.int64)
+    return -values
+
+
+def pack_columns(columns):
+    """Pack integer columns into one int64 key that sorts like the tuple of columns.
+
+    If the packed key would overflow, the key built so far is replaced by its dense rank.
+    """
+    import numpy as np
+
+    key = np.zeros(len(columns[0]), dtype=np.int64)
+    span = 1
+    for column in columns:
+        codes, width = ordered_codes(column)
+        if span * width >= 2**62:
+            uniques, key = np.unique(key, return_inverse=True)
+            key = key.astype(np.int64).ravel()
+            span = len(uniques)
+        key = key * width + codes
+        span *= width
+    return key, span
+
+
+def keep_first(key_columns, priority_columns=()):
+    """Return the positions of the rows that come first in their group.
+
+    Rows are grouped by `key_columns` and ordered within each group by `priority_columns`
+    (ascending, the first column decides first, NaN last), remaining ties keep the row
+    order. Keys are packed into one int64 key and sorted once with a stable sort, the
+    priorities are only compared to the minimum of their group, they are not sorted.
+    """
+    import numpy as np
+
+    if len(key_columns[0]) == 0:
+        return np.arange(0)
+
+    group_key, _ = pack_columns(key_columns)
+    order = np.argsort(group_key, kind="stable")
+
+    # first row of each group in sorted order
+    sorted_groups = group_key[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = sorted_groups[1:] != sorted_groups[:-1]
+    if not priority_columns:
+        return order[first]
+
+    # narrow the rows of each group down to the minimum of every priority column in turn
+    starts = np.flatnonzero(first)
+    groups = np.cumsum(first) - 1
+    candidate = np.ones(len(order), dtype=bool)
+    for column in priority_columns:
+        values = np.asarray(column)[order]
+        if values.dtype == bool:
+            values = values.astype(np.int8)
+        if values.dtype.kind == "f":
+            values = np.where(np.isnan(values), np.inf, values)
+            largest = np.inf
+        else:
+            largest = np.iinfo(values.dtype).max
+        values = np.where(candidate, values, largest)
+        candidate &= values == np.minimum.reduceat(values, starts)[groups]
+
+    # first remaining row of each group
+    rows = np.flatnonzero(candidate)
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = groups[rows][1:] != groups[rows][:-1]
+    return order[rows[first]]
+
+
+def dedupe_annotations(
+    df,
+    fragment_score="fragment_score",
+    intensity="intensity",
+    mass_keys=MASS_KEYS,
+    fragment_keys=FRAGMENT_KEYS,
+):
+    """Keep one annotation per experimental peak and one peak per fragment ion.
+
+    First, each experimental peak (`mass_keys`) keeps the annotation with the highest
+    `fragment_score`. Then each fragment ion (`fragment_keys`) keeps the peak with the
+    highest `intensity`. Ties are resolved by the higher fragment score and then by row
+    order, like a stable descending sort followed by `drop_duplicates(keep="first")`.
+    Passing None for a score column keeps the first row of each group instead.
+
+    Keys are integer encoded and each stage is a single sort of the packed keys followed
+    by a per-group minimum of the priorities. Returns the selected rows in their original
+    order.
+    """
+    if fragment_score not in df.columns:
+        fragment_score = None
+    if intensity not in df.columns:
+        intensity = None
+
+    encoded = {c: encode_column(df[c]) for c in set(mass_keys) | set(fragment_keys)}
+    score_priority = [descending(df[fragment_score])] if fragment_score else []
+
+    # highest fragment score per experimental peak
+    kept = keep_first([encoded[c] for c in mass_keys], score_priority)
+    kept.sort()
+
+    # highest intensity per fragment ion
+    priority = [descending(df[intensity].to_numpy()[kept])] if intensity else []
+    priority += [p[kept] for p in score_priority]
+    kept = kept[keep_first([encoded[c][kept] for c in fragment_keys], priority)]
+    kept.sort()
+
+    return df.iloc[kept]
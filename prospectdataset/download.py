@@ -1,119 +1,380 @@
-import glob
-import itertools
 import os
+import re
 import shutil
 import zipfile
-from pathlib import Path
 
-from .config import AVAILABLE_DATASET_URLS, ZENODO_BASE
+from .cache import DatasetCache, default_cache_dir, file_checksum, split_checksum
+from .config import AVAILABLE_DATASET_RECORDS, AVAILABLE_DATASET_URLS
+from .manifest import ANNOTATION_KIND, filter_manifest, load_manifest, sort_by_size
 
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_SEGMENT_SIZE = 512 * 1024 * 1024
+DEFAULT_SEGMENT_WORKERS = 4
+DEFAULT_TIMEOUT = 60
 
-def get_all_urls(record_url):
-    import requests
-    from bs4 import BeautifulSoup
 
-    reqs = requests.get(record_url)
-    soup = BeautifulSoup(reqs.text, "html.parser")
+def _open_url(url, start=0, end=None, timeout=DEFAULT_TIMEOUT):
+    import urllib.request
 
-    urls = []
-    for link in soup.find_all("a"):
-        urls.append(link.get("href"))
+    request = urllib.request.Request(url)
+    if start or end is not None:
+        byte_range = "bytes={}-{}".format(start, "" if end is None else end)
+        request.add_header("Range", byte_range)
+    return urllib.request.urlopen(request, timeout=timeout)
 
-    return urls
 
+def probe_url(url, timeout=DEFAULT_TIMEOUT):
+    """Return the remote size in bytes (or None) and whether byte ranges are supported."""
+    import urllib.request
 
-def filter_relevant_urls(urls_unfiltered):
-    # non-null download links only
-    filtered_urls = [
-        u for u in urls_unfiltered if u is not None and u.endswith("download=1")
-    ]
-    return filtered_urls
+    request = urllib.request.Request(url, method="HEAD")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            size = response.headers.get("Content-Length")
+            accept_ranges = response.headers.get("Accept-Ranges", "")
+    except Exception:
+        # some servers do not answer HEAD requests, fall back to a plain download
+        return None, False
 
+    size = int(size) if size is not None else None
+    return size, accept_ranges.lower() == "bytes"
 
-def unique_urls(urls):
-    unique_urls = list(dict.fromkeys(urls))
-    return unique_urls
 
+def unsatisfiable_range_size(error):
+    # size of the file from a 416 response to a range request past its end, or None
+    import urllib.error
 
-def download_files(record, task="retention-time", save_directory="", select_pool=None):
-    import urllib.request
-    from urllib.parse import urlparse
+    if not isinstance(error, urllib.error.HTTPError) or error.code != 416:
+        return None
+    match = re.match(r"bytes \*/(\d+)", error.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
 
-    meta_data_files_only = False
 
-    if task == "retention-time":
-        meta_data_files_only = True
+def _hash_file(path, hasher, chunk_size=DEFAULT_CHUNK_SIZE):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
 
-    print("Downloading dataset from Zenodo record", record)
-    print("Corresponding Zenodo URL is", AVAILABLE_DATASET_URLS[record])
 
-    urls = get_all_urls(AVAILABLE_DATASET_URLS[record])
-    urls = unique_urls(filter_relevant_urls(urls))
+def _download_range(
+    url,
+    path,
+    start=0,
+    end=None,
+    resume=True,
+    retries=3,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    hash_algorithm=None,
+):
+    # download bytes [start, end] of `url` into `path`, resuming from its current size,
+    # returns the hexdigest of the written bytes if a hash algorithm is given
+    import hashlib
+
+    expected = None if end is None else end - start + 1
+
+    for attempt in range(retries + 1):
+        done = os.path.getsize(path) if resume and os.path.exists(path) else 0
+        if expected is not None and done > expected:
+            # stale part file from a different version of the file
+            done = 0
+        hasher = hashlib.new(hash_algorithm) if hash_algorithm else None
+        if expected is not None and done == expected:
+            if hasher:
+                _hash_file(path, hasher, chunk_size)
+            break
+        try:
+            with _open_url(url, start + done, end) as response:
+                if start + done and response.status != 206:
+                    if start:
+                        raise IOError("Server ignored the byte range request.")
+                    # server sent the whole file, start over
+                    done = 0
+                with open(path, "ab+" if done else "wb") as f:
+                    if hasher and done:
+                        # hash the already downloaded prefix before appending
+                        _hash_file(path, hasher, chunk_size)
+                    while True:
+                        chunk = response.read(chunk_size)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        if hasher:
+                            hasher.update(chunk)
+        except Exception as e:
+            if done and end is None and unsatisfiable_range_size(e) == start + done:
+                # the part file of a file of unknown size is already complete
+                if hasher:
+                    _hash_file(path, hasher, chunk_size)
+                break
+            if attempt == retries:
+                raise
+            print("Retrying {} after error: {}".format(url, e))
+            # start over if the part file does not match the remote file
+            resume = unsatisfiable_range_size(e) is None
+            continue
+        break
+
+    if expected is not None and os.path.getsize(path) != expected:
+        raise IOError(
+            "Incomplete download of {}: got {} of {} bytes.".format(
+                url, os.path.getsize(path), expected
+            )
+        )
+    return hasher.hexdigest() if hasher else None
+
 
-    if meta_data_files_only:
-        urls = [u for u in urls if "meta_data" in u]
+def download_url(
+    url,
+    save_path,
+    resume=True,
+    segment_size=DEFAULT_SEGMENT_SIZE,
+    max_segment_workers=DEFAULT_SEGMENT_WORKERS,
+    retries=3,
+    checksum=None,
+):
+    """Download a single URL to `save_path`.
+
+    Data is first written to `save_path + ".part"` and renamed once complete. With
+    `resume=True` an existing part file is continued with an HTTP Range request. Files
+    larger than `segment_size` are fetched as parallel byte-range segments if the server
+    supports it. If a `checksum` ("md5:<hexdigest>") is given, it is computed while the
+    data is written and the download fails on a mismatch.
+    """
+    import hashlib
+    from concurrent.futures import ThreadPoolExecutor
+
+    part_path = save_path + ".part"
+    size, accept_ranges = probe_url(url)
+    hash_algorithm, expected_digest = (
+        split_checksum(checksum) if checksum else (None, None)
+    )
+
+    if not accept_ranges:
+        resume = False
+
+    if (
+        accept_ranges
+        and size
+        and segment_size
+        and size > segment_size
+        and max_segment_workers > 1
+    ):
+        n_segments = -(-size // segment_size)
+        bounds = [
+            (i * segment_size, min(size, (i + 1) * segment_size) - 1)
+            for i in range(n_segments)
+        ]
+        segment_paths = ["{}.{}".format(part_path, i) for i in range(n_segments)]
+
+        with ThreadPoolExecutor(max_workers=max_segment_workers) as executor:
+            futures = [
+                executor.submit(_download_range, url, p, start, end, resume, retries)
+                for p, (start, end) in zip(segment_paths, bounds)
+            ]
+            for future in futures:
+                future.result()
+
+        # stitch segments together into the part file, hashing them on the way
+        hasher = hashlib.new(hash_algorithm) if hash_algorithm else None
+        with open(part_path, "wb") as out:
+            for p in segment_paths:
+                with open(p, "rb") as f:
+                    for chunk in iter(lambda: f.read(DEFAULT_CHUNK_SIZE), b""):
+                        out.write(chunk)
+                        if hasher:
+                            hasher.update(chunk)
+        for p in segment_paths:
+            os.remove(p)
+        digest = hasher.hexdigest() if hasher else None
+    else:
+        end = size - 1 if size else None
+        digest = _download_range(
+            url, part_path, 0, end, resume, retries, hash_algorithm=hash_algorithm
+        )
+
+    if expected_digest and digest != expected_digest:
+        os.remove(part_path)
+        raise IOError(
+            "Checksum mismatch for {}: expected {}, got {}.".format(
+                url, expected_digest, digest
+            )
+        )
 
-    if select_pool:
-        urls = [u for u in urls if select_pool in u]
+    os.replace(part_path, save_path)
+    return save_path
 
-    print("Collected URLs: ", urls)
-    downloaded_files = []
 
-    for u in urls:
-        filename = os.path.basename(urlparse(u).path)
+def is_valid_file(path, checksum=None, size=None):
+    """Check whether a file exists and matches the expected size and checksum."""
+    if not os.path.isfile(path):
+        return False
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    if checksum:
+        hash_algorithm, expected_digest = split_checksum(checksum)
+        return file_checksum(path, hash_algorithm) == expected_digest
+    return True
+
+
+def download_files(
+    record,
+    task="retention-time",
+    save_directory="",
+    select_pool=None,
+    max_workers=4,
+    resume=True,
+    segment_size=DEFAULT_SEGMENT_SIZE,
+    segment_workers=DEFAULT_SEGMENT_WORKERS,
+    cache=None,
+    offline=False,
+    extract_annotations=False,
+    delete_archives=False,
+    extract_workers=2,
+):
+    from concurrent.futures import ThreadPoolExecutor
+
+    print("Downloading dataset from Zenodo record", record)
+    print("Corresponding Zenodo URL is", AVAILABLE_DATASET_URLS[record])
+
+    record_id = AVAILABLE_DATASET_RECORDS[record]
+    manifest = load_manifest(
+        record,
+        cache_dir=cache.cache_dir if cache else default_cache_dir(save_directory),
+        offline=offline,
+    )
+    files = filter_manifest(manifest, task, select_pool)
+
+    print("Collected files: ", [f.name for f in files])
+
+    def _download(manifest_file):
+        filename = manifest_file.name
+        checksum = manifest_file.checksum
         save_full_path = os.path.join(save_directory, filename)
 
-        print("Downloading URL: ", u)
-        urllib.request.urlretrieve(ZENODO_BASE + u, save_full_path)
+        cached_path = cache.get(record_id, checksum, filename) if cache else None
+        if cached_path:
+            print("Using cached file: ", cached_path)
+            return cache.link_into(cached_path, save_directory)
+
+        if is_valid_file(save_full_path, checksum, manifest_file.size):
+            print("Skipping file already present: ", save_full_path)
+            if cache:
+                # adopt the file into the cache and keep a link in place
+                cached_path = cache.add(record_id, checksum, filename, save_full_path)
+                cache.link_into(cached_path, save_directory)
+            return save_full_path
+
+        print("Downloading URL: ", manifest_file.url)
+        if cache:
+            download_path = cache.path(record_id, checksum, filename)
+            os.makedirs(os.path.dirname(download_path), exist_ok=True)
+        else:
+            download_path = save_full_path
+        download_url(
+            manifest_file.url,
+            download_path,
+            resume=resume,
+            segment_size=segment_size,
+            max_segment_workers=segment_workers,
+            checksum=checksum,
+        )
+        if cache:
+            cached_path = cache.add(record_id, checksum, filename, download_path)
+            cache.link_into(cached_path, save_directory)
 
         print("Saved file: ", save_full_path)
-        downloaded_files.append(save_full_path)
+        return save_full_path
+
+    extract_executor = ThreadPoolExecutor(max_workers=max(1, extract_workers))
+    extractions = []
+
+    def _extract(manifest_file, path):
+        pool_dir = os.path.join(save_directory, manifest_file.pool)
+        extracted = extract_annotation_archive(path, pool_dir, delete_archives)
+        if delete_archives and cache:
+            # the deleted archive was a link to the cached copy, free that one as well
+            cache.remove(record_id, manifest_file.checksum)
+        return extracted
+
+    def _download_and_extract(manifest_file):
+        path = _download(manifest_file)
+        if extract_annotations and manifest_file.kind == ANNOTATION_KIND:
+            # extract while the remaining files are still downloading
+            extractions.append(extract_executor.submit(_extract, manifest_file, path))
+        return path
+
+    # start the largest files first, but return paths in manifest order
+    with extract_executor:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = {
+                f.name: executor.submit(_download_and_extract, f)
+                for f in sort_by_size(files)
+            }
+            downloaded_files = [futures[f.name].result() for f in files]
+        for future in extractions:
+            future.result()
 
     return downloaded_files
 
 
-def unzip_annotation_files(files, extract_to_dir=""):
-    # ensure list contains only zip files
-    zip_files = [f for f in files if ".zip" in f]
-
-    for zf in zip_files:
-        print("Unzipping file", zf)
-        with zipfile.ZipFile(zf) as zfile:
-            zfile.extractall(extract_to_dir)
-
-    return zip_files
-
-
-def move_multipart_pools_to_one_folder(data_dir, select_pool):
-    meta_data_filepath = glob.glob(
-        os.path.join(data_dir, "*" + str(select_pool) + "*meta_data.parquet")
-    )[0]
-    annotation_dirs = [
-        path
-        for path in glob.glob(os.path.join(data_dir, "*" + str(select_pool) + "*"))
-        if os.path.isdir(path)
-    ]
-    annotations_filepaths = [
-        glob.glob(os.path.join(d, "*.parquet")) for d in annotation_dirs
-    ]
-    annotations_filepaths = list(itertools.chain(*annotations_filepaths))
-
-    pool_name = Path(meta_data_filepath).stem.split("_meta_data")[0]
-    new_pool_folder = os.path.join(data_dir, pool_name)
-    os.makedirs(new_pool_folder, exist_ok=True)
-    for f in annotations_filepaths:
-        shutil.move(f, new_pool_folder)
-    for d in annotation_dirs:
-        shutil.rmtree(d)
-    return True
+def extract_annotation_archive(zip_path, pool_dir, delete_archive=False):
+    """Extract the parquet members of an annotation archive directly into `pool_dir`.
+
+    Members of multipart pools all land in the same pool folder. Each member is checked
+    against its CRC and size while it is extracted, members already extracted are
+    skipped. With `delete_archive=True` the archive is removed once all members are valid.
+    """
+    os.makedirs(pool_dir, exist_ok=True)
+    extracted = []
+
+    print("Extracting file", zip_path)
+    with zipfile.ZipFile(zip_path) as zfile:
+        for member in zfile.infolist():
+            if member.is_dir() or not member.filename.endswith(".parquet"):
+                continue
+            path = os.path.join(pool_dir, os.path.basename(member.filename))
+            if os.path.isfile(path) and os.path.getsize(path) == member.file_size:
+                extracted.append(path)
+                continue
+
+            # reading the member to its end verifies its CRC
+            with zfile.open(member) as src, open(path + ".part", "wb") as dst:
+                shutil.copyfileobj(src, dst, DEFAULT_CHUNK_SIZE)
+            if os.path.getsize(path + ".part") != member.file_size:
+                raise zipfile.BadZipFile(
+                    "Size mismatch for {} in {}".format(member.filename, zip_path)
+                )
+            os.replace(path + ".part", path)
+            extracted.append(path)
+
+    if delete_archive:
+        os.remove(zip_path)
+        print("Deleted archive", zip_path)
+    return extracted
 
 
 def download_dataset(
-    record="prospect", task="retention-time", save_directory="", select_pool=None
+    record="prospect",
+    task="retention-time",
+    save_directory="",
+    select_pool=None,
+    max_workers=4,
+    resume=True,
+    use_cache=True,
+    cache_dir=None,
+    max_cache_size=None,
+    offline=False,
+    delete_archives=False,
 ):
     os.makedirs(save_directory, exist_ok=True)
     all_files = []
 
+    cache = None
+    if use_cache:
+        cache = DatasetCache(
+            cache_dir or default_cache_dir(save_directory), max_size=max_cache_size
+        )
+
     if record not in AVAILABLE_DATASET_URLS.keys():
         raise ValueError(
             "Record {} not available. Available records are {}".format(
@@ -127,21 +388,18 @@ def download_dataset(
     if isinstance(record, str):
         record = [record]
     for rec in record:
-        files = download_files(rec, task, save_directory, select_pool)
+        files = download_files(
+            rec,
+            task,
+            save_directory,
+            select_pool,
+            max_workers=max_workers,
+            resume=resume,
+            cache=cache,
+            offline=offline,
+            extract_annotations=task != "retention-time",
+            delete_archives=delete_archives,
+        )
         all_files.append(files)
 
-        if task != "retention_time":
-            zip_files = unzip_annotation_files(files, save_directory)
-
-            # a pool was downloaded and has multiple zip annotation files
-            if len(zip_files) > 1 and select_pool:
-                move_multipart_pools_to_one_folder(
-                    data_dir=save_directory, select_pool=select_pool
-                )
-            else:
-                print(
-                    """No pool selected. If you intend to load the data using DLOmix,
-                please ensure you move files belonging to the same pool manually to one folder."""
-                )
-
     return all_files
@@ -0,0 +1,121 @@
+from collections import OrderedDict, namedtuple
+
+MAX_PRECURSOR_CHARGE = 6
+COLLISION_ENERGY_SCALE = 100.0
+
+# rows per row group of processed pools, small enough to read single spectra quickly
+ROW_GROUP_SIZE = 2_000
+
+Encoder = namedtuple("Encoder", ["name", "columns", "function"])
+
+# registered feature encodings, applied in registration order
+ENCODERS = OrderedDict()
+
+
+def register_encoder(name, columns):
+    """Register a function as the encoder of the feature column `name`.
+
+    The function receives a DataFrame with (at least) the input `columns` and returns a
+    NumPy array with one value (1-D) or one fixed-width vector (2-D) per row. It is only
+    applied if all input columns are present.
+
+        @register_encoder("peptide_length_normed", ["peptide_length"])
+        def encode_peptide_length(df):
+            return df["peptide_length"].to_numpy() / 30.0
+    """
+
+    def decorator(function):
+        ENCODERS[name] = Encoder(name, list(columns), function)
+        return function
+
+    return decorator
+
+
+@register_encoder("collision_energy_aligned_normed", ["aligned_collision_energy"])
+def encode_collision_energy(df):
+    return df["aligned_collision_energy"].to_numpy() / COLLISION_ENERGY_SCALE
+
+
+@register_encoder("method_nbr", ["fragmentation"])
+def encode_fragmentation(df):
+    from spectrum_fundamentals.constants import FRAGMENTATION_ENCODING
+
+    # categoricals are mapped once per category
+    return df["fragmentation"].map(FRAGMENTATION_ENCODING).to_numpy()
+
+
+@register_encoder("precursor_charge_onehot", ["precursor_charge"])
+def encode_precursor_charge(df):
+    import numpy as np
+
+    charges = df["precursor_charge"].to_numpy().astype(np.int64)
+    if len(charges) and (charges.min() < 1 or charges.max() > MAX_PRECURSOR_CHARGE):
+        raise ValueError(
+            "Precursor charges must be between 1 and {}.".format(MAX_PRECURSOR_CHARGE)
+        )
+    return np.eye(MAX_PRECURSOR_CHARGE, dtype=np.int8)[charges - 1]
+
+
+def tensor_column(values, index=None):
+    """Wrap a 2-D array as a pandas column of Arrow fixed-size lists without copying.
+
+    The column is stored as `fixed_size_list` in parquet instead of one object per row.
+    """
+    import numpy as np
+    import pandas as pd
+    import pyarrow as pa
+
+    values = np.ascontiguousarray(values)
+    array = pa.FixedSizeListArray.from_arrays(
+        pa.array(values.reshape(-1)), values.shape[1]
+    )
+    return pd.Series(
+        pd.arrays.ArrowExtensionArray(array), index=index, name=None, copy=False
+    )
+
+
+def encode_features(df, encoders=None):
+    """Add the encoded feature columns to `df` in one vectorised pass per encoder.
+
+    `encoders` is a list of registered encoder names (default: all registered encoders),
+    encoders whose input columns are missing are skipped.
+    """
+    for name in ENCODERS if encoders is None else encoders:
+        encoder = ENCODERS[name]
+        if not all(column in df.columns for column in encoder.columns):
+            continue
+        values = encoder.function(df)
+        if values.ndim == 2:
+            values = tensor_column(values, df.index)
+        df[name] = values
+    return df
+
+
+def to_arrow_table(df):
+    """Convert a DataFrame with tensor columns to a pyarrow Table.
+
+    The pandas metadata of fixed-size list columns is marked as object, so that the file
+    can be read back with `pd.read_parquet` (as one array per row).
+    """
+    import json
+
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pandas_metadata = json.loads(table.schema.metadata[b"pandas"])
+    for column in pandas_metadata["columns"]:
+        field = column["field_name"]
+        if field in table.schema.names and pa.types.is_fixed_size_list(
+            table.schema.field(field).type
+        ):
+            column["numpy_type"] = "object"
+    return table.replace_schema_metadata(
+        {**table.schema.metadata, b"pandas": json.dumps(pandas_metadata).encode()}
+    )
+
+
+def write_parquet(df, path, row_group_size=ROW_GROUP_SIZE):
+    import pyarrow.parquet as pq
+
+    pq.write_table(to_arrow_table(df), path, row_group_size=row_group_size)
+    return path
@@ -0,0 +1,285 @@
+import json
+import os
+
+from .tokenizer import SequenceTokenizer, token_dtype
+
+EXPORT_FORMATS = ["npy"]
+INDEX_FILENAME = "index.json"
+EXPORT_VERSION = 1
+
+# spectra per shard, every shard but the last one is full
+SHARD_SIZE = 100_000
+
+# exported column -> (array name, dtype), 2-D columns keep their width
+EXPORT_ARRAYS = {
+    "intensities_raw": ("intensities", "float32"),
+    "masses_raw": ("masses", "float32"),
+    "precursor_charge": ("precursor_charge", "int8"),
+    "collision_energy_aligned_normed": ("collision_energy", "float32"),
+    "method_nbr": ("method_nbr", "int8"),
+    "scan_number": ("scan_number", "int64"),
+}
+
+
+def stack_column(values, dtype):
+    # 2-D array of a column holding one vector per row (object or fixed-size list)
+    import numpy as np
+    import pandas as pd
+
+    if isinstance(values.dtype, pd.ArrowDtype):
+        array = values.array.__arrow_array__()
+        if hasattr(array, "combine_chunks"):
+            array = array.combine_chunks()
+        return (
+            array.flatten()
+            .to_numpy(zero_copy_only=False)
+            .reshape(len(array), array.type.list_size)
+            .astype(dtype, copy=False)
+        )
+    if len(values) == 0:
+        return np.zeros((0, 0), dtype=dtype)
+    return np.stack(values.to_numpy()).astype(dtype, copy=False)
+
+
+def pad_columns(values, width):
+    # pad a 2-D array with zeros to `width` columns
+    import numpy as np
+
+    if values.shape[1] >= width:
+        return values
+    return np.pad(values, ((0, 0), (0, width - values.shape[1])))
+
+
+class SpectrumShardWriter:
+    """Write processed spectra into shards of uncompressed `.npy` files.
+
+    Every shard holds `shard_size` spectra (the last one possibly fewer) as one file per
+    array: float32 intensity and mass matrices, integer-encoded sequences padded to the
+    longest sequence, raw file ids, scan numbers and precursor features. `index.json`
+    lists the shards, array dtypes and shapes, the raw files and the sequence vocabulary.
+    Spectra are added with `write` (DataFrames as returned by `download_process_pool`),
+    `close` writes the last shard and the index, `abort` removes the written shards.
+    """
+
+    def __init__(self, directory, shard_size=SHARD_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.shard_size = shard_size
+        self.sequence_length = 0
+        self.tokenizer = SequenceTokenizer()
+        self.raw_files = {}
+        self.shards = []
+        self.arrays = {}
+        self.buffer = []
+        self.buffered = 0
+        self.n_spectra = 0
+
+    def encode_sequences(self, sequences):
+        # tokenized once per unique sequence
+        tokens, _ = self.tokenizer.encode(sequences)
+        self.sequence_length = max(self.sequence_length, tokens.shape[1])
+        return tokens
+
+    def encode(self, df):
+        import numpy as np
+        import pandas as pd
+
+        from .keys import as_categorical
+
+        arrays = {}
+        for column, (name, dtype) in EXPORT_ARRAYS.items():
+            if column not in df.columns:
+                continue
+            values = df[column]
+            if values.dtype == object or isinstance(values.dtype, pd.ArrowDtype):
+                arrays[name] = stack_column(values, dtype)
+            else:
+                arrays[name] = values.to_numpy().astype(dtype)
+
+        raw_files = as_categorical(df["raw_file"])
+        raw_file_ids = np.array(
+            [
+                self.raw_files.setdefault(raw_file, len(self.raw_files))
+                for raw_file in raw_files.categories
+            ],
+            dtype=np.int32,
+        )
+        arrays["raw_file"] = raw_file_ids[raw_files.codes]
+        if "modified_sequence" in df.columns:
+            sequences = self.encode_sequences(df["modified_sequence"])
+            arrays["sequence"] = sequences
+        return arrays
+
+    def write(self, df):
+        if len(df) == 0:
+            return
+        self.buffer.append(self.encode(df))
+        self.buffered += len(df)
+        while self.buffered >= self.shard_size:
+            self.flush(self.shard_size)
+
+    def flush(self, n_rows):
+        import numpy as np
+
+        if "sequence" in self.buffer[0]:
+            for arrays in self.buffer:
+                arrays["sequence"] = pad_columns(
+                    arrays["sequence"], self.sequence_length
+                )
+        merged = {
+            name: np.concatenate([arrays[name] for arrays in self.buffer])
+            for name in self.buffer[0]
+        }
+        shard = len(self.shards)
+        files = {}
+        for name, values in merged.items():
+            files[name] = "{}_{:05d}.npy".format(name, shard)
+            np.save(os.path.join(self.directory, files[name]), values[:n_rows])
+            self.arrays[name] = {
+                "dtype": values.dtype.str,
+                "shape": list(values.shape[1:]),
+            }
+        self.shards.append({"n_spectra": n_rows, "files": files})
+        self.n_spectra += n_rows
+
+        rest = {name: values[n_rows:] for name, values in merged.items()}
+        self.buffered -= n_rows
+        self.buffer = [rest] if self.buffered else []
+
+    def close(self):
+        import numpy as np
+
+        if self.buffered:
+            self.flush(self.buffered)
+
+        vocabulary = self.tokenizer.tokens
+        if "sequence" in self.arrays:
+            # same width and integer type of the vocabulary for all shards
+            dtype = token_dtype(len(vocabulary))
+            for shard in self.shards:
+                path = os.path.join(self.directory, shard["files"]["sequence"])
+                sequences = pad_columns(np.load(path), self.sequence_length)
+                np.save(path, sequences.astype(dtype))
+            self.arrays["sequence"] = {
+                "dtype": np.dtype(dtype).str,
+                "shape": [self.sequence_length],
+            }
+
+        index = {
+            "format": "npy",
+            "version": EXPORT_VERSION,
+            "n_spectra": self.n_spectra,
+            "shard_size": self.shard_size,
+            "arrays": self.arrays,
+            "shards": self.shards,
+            "raw_files": sorted(self.raw_files, key=self.raw_files.get),
+            "vocabulary": vocabulary,
+        }
+        with open(os.path.join(self.directory, INDEX_FILENAME), "w") as f:
+            json.dump(index, f, indent=1)
+        print(
+            "Exported {} spectra in {} shards to {}".format(
+                self.n_spectra, len(self.shards), self.directory
+            )
+        )
+        return self.directory
+
+    def abort(self):
+        """Remove the shards written so far (and a stale index), so a failed export is
+        not mistaken for a complete one."""
+        files = [name for shard in self.shards for name in shard["files"].values()]
+        for name in files + [INDEX_FILENAME]:
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                os.remove(path)
+        self.shards = []
+        self.buffer = []
+        self.buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def export_spectra(df, directory, shard_size=SHARD_SIZE):
+    """Export a processed pool DataFrame with `SpectrumShardWriter`."""
+    with SpectrumShardWriter(directory, shard_size) as writer:
+        writer.write(df)
+    return directory
+
+
+class SpectrumShards:
+    """Memory-mapped, random access reader of spectra exported with `SpectrumShardWriter`.
+
+    Shards are opened lazily with `np.load(mmap_mode="r")`, spectrum `i` is row
+    `i % shard_size` of shard `i // shard_size`, so access is O(1) and zero-copy.
+
+        shards = SpectrumShards("pool_export")
+        shards[10]["intensities"]        # array of shape (174,)
+        shards.get_batch([3, 10, 12])    # dict of arrays with 3 rows each
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_FILENAME)) as f:
+            self.index = json.load(f)
+        self.shard_size = self.index["shard_size"]
+        self.vocabulary = self.index["vocabulary"]
+        self.raw_files = self.index["raw_files"]
+        self.names = list(self.index["arrays"])
+        self.mapped = {}
+
+    def __len__(self):
+        return self.index["n_spectra"]
+
+    def array(self, name, shard):
+        import numpy as np
+
+        key = (name, shard)
+        if key not in self.mapped:
+            self.mapped[key] = np.load(
+                os.path.join(
+                    self.directory, self.index["shards"][shard]["files"][name]
+                ),
+                mmap_mode="r",
+            )
+        return self.mapped[key]
+
+    def locate(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Spectrum {} out of range.".format(i))
+        return divmod(i, self.shard_size)
+
+    def __getitem__(self, i):
+        shard, offset = self.locate(i)
+        return {name: self.array(name, shard)[offset] for name in self.names}
+
+    def get_batch(self, indices, names=None):
+        """Return a dict of arrays with the spectra at `indices` (in that order)."""
+        import numpy as np
+
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if len(indices) and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError("Spectrum indices out of range.")
+        shards, offsets = np.divmod(indices, self.shard_size)
+
+        batch = {}
+        for name in names or self.names:
+            info = self.index["arrays"][name]
+            values = np.empty([len(indices)] + info["shape"], dtype=info["dtype"])
+            for shard in np.unique(shards):
+                rows = shards == shard
+                values[rows] = self.array(name, shard)[offsets[rows]]
+            batch[name] = values
+        return batch
+
+    def decode_sequence(self, encoded):
+        return "".join(self.vocabulary[token] for token in encoded)
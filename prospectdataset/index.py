@@ -0,0 +1,269 @@
+import json
+import os
+
+from .keys import KEY_COLUMNS, SCAN_NUMBER_BITS, as_categorical
+
+INDEX_SUFFIX = ".index"
+INDEX_VERSION = 1
+SEQUENCE_COLUMN = "modified_sequence"
+
+
+def index_path(parquet_path):
+    """Default location of the index of a parquet file, next to the file."""
+    return os.path.splitext(parquet_path)[0] + INDEX_SUFFIX
+
+
+def row_runs(keys, sequences):
+    # start and length of the runs of consecutive rows with the same key and sequence
+    import numpy as np
+
+    change = np.ones(len(keys), dtype=bool)
+    change[1:] = (keys[1:] != keys[:-1]) | (sequences[1:] != sequences[:-1])
+    starts = np.flatnonzero(change)
+    return starts, np.diff(np.append(starts, len(keys)))
+
+
+class SpectrumIndex:
+    """Map (raw_file, scan_number) and modified_sequence to rows of parquet files.
+
+    The index stores one entry per run of consecutive rows of a spectrum in a row group:
+    (file, row group, row offset, number of rows). Metadata files have one row and
+    annotation files one run of peaks per spectrum. Entries are sorted by the packed
+    (raw_file, scan_number) key, so a look-up is a binary search, and `get_spectra` reads
+    only the row groups that contain the requested spectra.
+
+        index = SpectrumIndex.build(["pool_a.parquet", "pool_b.parquet"])
+        index.save("compendium.index")
+        index = SpectrumIndex.load("compendium.index")
+        df = index.get_spectra([("raw_file_1", 1234), ("raw_file_2", 42)])
+    """
+
+    def __init__(self, files, raw_files, sequences, entries):
+        import numpy as np
+
+        self.files = list(files)
+        self.raw_files = list(raw_files)
+        self.sequences = list(sequences)
+        self.raw_file_ids = {r: i for i, r in enumerate(self.raw_files)}
+        self.sequence_ids = {s: i for i, s in enumerate(self.sequences)}
+
+        order = np.argsort(entries["key"], kind="stable")
+        self.entries = {name: values[order] for name, values in entries.items()}
+        self._sequence_order = None
+        self._parquet_files = {}
+
+    def __len__(self):
+        return len(self.entries["key"])
+
+    @classmethod
+    def build(cls, paths, key_columns=KEY_COLUMNS, sequence_column=SEQUENCE_COLUMN):
+        """Index parquet files, reading only their key columns row group by row group."""
+        import numpy as np
+        import pyarrow.parquet as pq
+
+        if isinstance(paths, str):
+            paths = [paths]
+        raw_file_ids, sequence_ids = {}, {}
+        entries = {
+            name: []
+            for name in ["key", "file_id", "row_group", "offset", "length", "sequence"]
+        }
+
+        for file_id, path in enumerate(paths):
+            print("Indexing file: ", path)
+            parquet_file = pq.ParquetFile(path)
+            columns = list(key_columns)
+            if sequence_column in parquet_file.schema_arrow.names:
+                columns.append(sequence_column)
+
+            for row_group in range(parquet_file.num_row_groups):
+                df = parquet_file.read_row_group(row_group, columns=columns).to_pandas()
+                raw_files = as_categorical(df[key_columns[0]])
+                raw_file_map = np.array(
+                    [
+                        raw_file_ids.setdefault(r, len(raw_file_ids))
+                        for r in raw_files.categories
+                    ],
+                    dtype=np.int64,
+                )
+                keys = (raw_file_map[raw_files.codes] << SCAN_NUMBER_BITS) | df[
+                    key_columns[1]
+                ].to_numpy().astype(np.int64)
+
+                if sequence_column in columns:
+                    sequences = as_categorical(df[sequence_column])
+                    sequence_map = np.array(
+                        [
+                            sequence_ids.setdefault(s, len(sequence_ids))
+                            for s in sequences.categories
+                        ],
+                        dtype=np.int32,
+                    )
+                    sequences = sequence_map[sequences.codes]
+                else:
+                    sequences = np.full(len(keys), -1, dtype=np.int32)
+
+                starts, lengths = row_runs(keys, sequences)
+                entries["key"].append(keys[starts])
+                entries["file_id"].append(np.full(len(starts), file_id, dtype=np.int32))
+                entries["row_group"].append(
+                    np.full(len(starts), row_group, dtype=np.int32)
+                )
+                entries["offset"].append(starts.astype(np.int64))
+                entries["length"].append(lengths.astype(np.int64))
+                entries["sequence"].append(sequences[starts])
+
+        entries = {
+            name: np.concatenate(values) if values else np.zeros(0, dtype=np.int64)
+            for name, values in entries.items()
+        }
+        return cls(paths, raw_file_ids, sequence_ids, entries)
+
+    def save(self, path):
+        """Write the index to `<path>.npz` (entries) and `<path>.json` (files, names)."""
+        import numpy as np
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        np.savez(path + ".npz", **self.entries)
+        with open(path + ".json", "w") as f:
+            json.dump(
+                {
+                    "version": INDEX_VERSION,
+                    # relative to the index, so that both can be moved together
+                    "files": [
+                        os.path.relpath(os.path.abspath(f), directory)
+                        for f in self.files
+                    ],
+                    "raw_files": self.raw_files,
+                    "sequences": self.sequences,
+                },
+                f,
+            )
+        return path
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+
+        with open(path + ".json") as f:
+            names = json.load(f)
+        with np.load(path + ".npz") as entries:
+            entries = {name: entries[name] for name in entries.files}
+        directory = os.path.dirname(os.path.abspath(path))
+        files = [os.path.join(directory, f) for f in names["files"]]
+        return cls(files, names["raw_files"], names["sequences"], entries)
+
+    def spectrum_keys(self, keys):
+        # packed keys of (raw_file, scan_number) pairs or a DataFrame with key columns
+        import numpy as np
+        import pandas as pd
+
+        if not isinstance(keys, pd.DataFrame):
+            keys = pd.DataFrame(list(keys), columns=KEY_COLUMNS)
+        raw_files = as_categorical(keys[KEY_COLUMNS[0]])
+        # unknown raw files (and the code -1 of missing values) map to -1
+        raw_file_map = np.array(
+            [self.raw_file_ids.get(r, -1) for r in raw_files.categories] + [-1],
+            dtype=np.int64,
+        )
+        raw_file_ids = raw_file_map[raw_files.codes]
+        packed = (raw_file_ids << SCAN_NUMBER_BITS) | keys[KEY_COLUMNS[1]].to_numpy(
+            np.int64
+        )
+        packed[raw_file_ids < 0] = -1
+        return packed
+
+    def lookup(self, keys):
+        """Return the positions of the index entries of the spectra `keys`, in order."""
+        import numpy as np
+
+        packed = self.spectrum_keys(keys)
+        start = np.searchsorted(self.entries["key"], packed, side="left")
+        counts = np.searchsorted(self.entries["key"], packed, side="right") - start
+        counts[packed < 0] = 0
+        return np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(
+            counts.sum()
+        )
+
+    def lookup_sequences(self, sequences):
+        """Return the positions of the index entries of the modified sequences, in order."""
+        import numpy as np
+
+        if self._sequence_order is None:
+            self._sequence_order = np.argsort(self.entries["sequence"], kind="stable")
+        sorted_sequences = self.entries["sequence"][self._sequence_order]
+        ids = np.array(
+            [self.sequence_ids.get(s, -2) for s in sequences], dtype=np.int64
+        )
+        start = np.searchsorted(sorted_sequences, ids, side="left")
+        counts = np.searchsorted(sorted_sequences, ids, side="right") - start
+        positions = np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(
+            counts.sum()
+        )
+        return self._sequence_order[positions]
+
+    def parquet_file(self, file_id):
+        import pyarrow.parquet as pq
+
+        if file_id not in self._parquet_files:
+            self._parquet_files[file_id] = pq.ParquetFile(self.files[file_id])
+        return self._parquet_files[file_id]
+
+    def read_entries(self, positions, columns=None):
+        """Read the rows of index entries as a pyarrow Table, in the order of `positions`.
+
+        Every needed row group is read once (only `columns`, default: all).
+        """
+        import numpy as np
+        import pyarrow as pa
+
+        files = self.entries["file_id"][positions]
+        row_groups = self.entries["row_group"][positions]
+        offsets = self.entries["offset"][positions]
+        lengths = self.entries["length"][positions]
+
+        # rows of each entry and the entry they belong to
+        entry = np.repeat(np.arange(len(positions)), lengths)
+        rows = np.repeat(offsets - np.cumsum(lengths) + lengths, lengths) + np.arange(
+            lengths.sum()
+        )
+
+        tables, order = [], []
+        groups = np.unique(np.stack([files, row_groups], axis=1), axis=0)
+        for file_id, row_group in groups:
+            in_group = (files[entry] == file_id) & (row_groups[entry] == row_group)
+            table = self.parquet_file(file_id).read_row_group(
+                int(row_group), columns=columns
+            )
+            tables.append(table.take(pa.array(rows[in_group])))
+            order.append(np.flatnonzero(in_group))
+
+        if not tables:
+            schema = self.parquet_file(0).schema_arrow if self.files else pa.schema([])
+            if columns is not None:
+                schema = pa.schema([schema.field(c) for c in columns])
+            return schema.empty_table()
+        table = pa.concat_tables(tables, promote_options="permissive")
+        return table.take(pa.array(np.argsort(np.concatenate(order), kind="stable")))
+
+    def get_spectra(self, keys, columns=None):
+        """Return the rows of the spectra `keys` as a DataFrame, in the order of `keys`.
+
+        `keys` are (raw_file, scan_number) pairs or a DataFrame with these columns.
+        Unknown spectra are skipped.
+        """
+        return self.read_entries(self.lookup(keys), columns).to_pandas()
+
+    def get_sequences(self, sequences, columns=None):
+        """Return the rows of all spectra of the given modified sequences as a DataFrame."""
+        return self.read_entries(self.lookup_sequences(sequences), columns).to_pandas()
+
+
+def build_index(paths, save_path=None):
+    """Build the `SpectrumIndex` of parquet file(s) and save it next to the (first) file."""
+    if isinstance(paths, str):
+        paths = [paths]
+    index = SpectrumIndex.build(paths)
+    index.save(save_path or index_path(paths[0]))
+    return index
@@ -0,0 +1,102 @@
+KEY_COLUMNS = ["raw_file", "scan_number"]
+
+# string columns read as dictionaries (pandas categoricals) instead of object strings
+DICTIONARY_COLUMNS = [
+    "raw_file",
+    "ion_type",
+    "neutral_loss",
+    "fragmentation",
+    "modified_sequence",
+]
+
+# bits of the packed key used for the scan number
+SCAN_NUMBER_BITS = 32
+
+
+def as_categorical(values, categories=None):
+    """Return `values` as a pandas Categorical with sorted (or the given) categories.
+
+    Categories in sorted order make the integer codes sort like the strings, values not in
+    `categories` get the code -1.
+    """
+    import pandas as pd
+
+    values = pd.Categorical(values)
+    if categories is None:
+        categories = values.categories.sort_values()
+    if values.categories.equals(categories):
+        return values
+    return values.set_categories(categories)
+
+
+def shared_categories(*columns):
+    """Sorted union of the values of several (categorical or string) columns."""
+    import pandas as pd
+
+    categories = pd.Index([])
+    for column in columns:
+        categories = categories.union(as_categorical(column).categories)
+    return categories.sort_values()
+
+
+def spectrum_keys(raw_file, scan_number, categories):
+    """Pack (raw_file, scan_number) into one int64 key.
+
+    The key is `raw_file_id << 32 | scan_number` with the raw file id being its position
+    in `categories`, so keys sort like (raw_file, scan_number) if the categories are
+    sorted. Raw files not in `categories` get the key -1.
+    """
+    import numpy as np
+
+    codes = as_categorical(raw_file, categories).codes.astype(np.int64)
+    keys = (codes << SCAN_NUMBER_BITS) | np.asarray(scan_number, dtype=np.int64)
+    keys[codes < 0] = -1
+    return keys
+
+
+def unpack_spectrum_keys(keys, categories):
+    """Inverse of `spectrum_keys`: raw files (as Categorical) and scan numbers."""
+    import numpy as np
+    import pandas as pd
+
+    keys = np.asarray(keys, dtype=np.int64)
+    raw_files = pd.Categorical.from_codes(
+        (keys >> SCAN_NUMBER_BITS).astype(np.int32), categories
+    )
+    scans = keys & ((1 << SCAN_NUMBER_BITS) - 1)
+    return raw_files, scans
+
+
+def encode_dictionary_columns(df, columns=DICTIONARY_COLUMNS):
+    """Convert the string columns of `df` in `columns` to categoricals with sorted categories."""
+    for column in columns:
+        if column in df.columns:
+            df[column] = as_categorical(df[column])
+    return df
+
+
+def concat_frames(dfs, columns=DICTIONARY_COLUMNS):
+    """Concatenate DataFrames, keeping categorical `columns` categorical.
+
+    pandas falls back to object strings when categories differ, so the categories are
+    unified first.
+    """
+    import pandas as pd
+
+    dfs = list(dfs)
+    for column in columns:
+        if dfs and all(
+            isinstance(df[column].dtype, pd.CategoricalDtype)
+            for df in dfs
+            if column in df.columns
+        ):
+            categories = shared_categories(
+                *[df[column] for df in dfs if column in df.columns]
+            )
+            dfs = [
+                df.assign(**{column: as_categorical(df[column], categories)})
+                if column in df.columns
+                else df
+                for df in dfs
+            ]
+    return pd.concat(dfs, ignore_index=True)
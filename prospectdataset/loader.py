@@ -0,0 +1,233 @@
+from .readers import criteria_to_expression
+
+BATCH_SIZE = 1024
+SHUFFLE_BUFFER = 100_000
+PREFETCH = 4
+
+
+def column_to_numpy(column):
+    """Convert an Arrow column to a NumPy array without per-row Python objects.
+
+    Numeric columns are converted zero-copy where possible, fixed-size list columns (and
+    list columns with one length) become 2-D arrays from their flat values. String
+    columns are the exception and become object arrays.
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks() if column.num_chunks != 1 else column.chunk(0)
+    if pa.types.is_dictionary(column.type):
+        column = column.dictionary_decode()
+
+    if pa.types.is_fixed_size_list(column.type):
+        width = column.type.list_size
+        values = column.flatten().to_numpy(zero_copy_only=False)
+        return values.reshape(len(column), width)
+    if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+        offsets = column.offsets.to_numpy()
+        lengths = np.diff(offsets)
+        if len(lengths) and (lengths != lengths[0]).any():
+            raise ValueError(
+                "List column with different lengths cannot be batched: {}".format(
+                    column.type
+                )
+            )
+        values = column.flatten().to_numpy(zero_copy_only=False)
+        return values.reshape(len(column), lengths[0] if len(lengths) else 0)
+    return column.to_numpy(zero_copy_only=False)
+
+
+def table_to_numpy(table):
+    return {name: column_to_numpy(table.column(name)) for name in table.column_names}
+
+
+class BatchLoader:
+    """Iterate fixed-size batches of NumPy arrays over parquet files.
+
+    Row groups are the unit of reading and sharding: they are shuffled with the seed and
+    epoch, dealt round-robin to `world_size` ranks and read by `num_workers` threads at
+    most `prefetch` row groups ahead. Rows are shuffled within a window of
+    `shuffle_buffer` rows. All ranks get the same number of rows (the smallest share,
+    extra rows are dropped) so that distributed training stays in step. With `criteria`
+    the matching rows of every row group are counted once up front, reading only the
+    columns of the criteria, so the ranks stay in step after filtering too.
+
+        loader = BatchLoader(
+            "pool.parquet", ["intensities_raw", "precursor_charge_onehot"],
+            batch_size=1024, rank=rank, world_size=world_size,
+        )
+        for epoch in range(epochs):
+            loader.set_epoch(epoch)
+            for batch in loader:
+                batch["intensities_raw"]  # float32 array of shape (1024, 174)
+
+    The batches are NumPy arrays, `torch.from_numpy` or `tf.constant` wrap them.
+    """
+
+    def __init__(
+        self,
+        paths,
+        columns=None,
+        batch_size=BATCH_SIZE,
+        shuffle=True,
+        shuffle_buffer=SHUFFLE_BUFFER,
+        seed=0,
+        rank=0,
+        world_size=1,
+        num_workers=4,
+        prefetch=PREFETCH,
+        drop_last=False,
+        criteria=None,
+    ):
+        import pyarrow.parquet as pq
+
+        if not 0 <= rank < world_size:
+            raise ValueError("rank must be in [0, world_size).")
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        self.columns = columns
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = max(shuffle_buffer, batch_size)
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.num_workers = max(1, num_workers)
+        self.prefetch = max(1, prefetch)
+        self.drop_last = drop_last
+        self.criteria = criteria
+        self.epoch = 0
+
+        # (file, row group, rows) of all row groups
+        self.row_groups = []
+        for file_id, path in enumerate(self.paths):
+            metadata = pq.ParquetFile(path).metadata
+            for row_group in range(metadata.num_row_groups):
+                self.row_groups.append(
+                    (file_id, row_group, metadata.row_group(row_group).num_rows)
+                )
+        if criteria:
+            self.row_groups = [
+                (file_id, row_group, self.read_table(i, []).num_rows)
+                for i, (file_id, row_group, _) in enumerate(self.row_groups)
+            ]
+
+    def set_epoch(self, epoch):
+        """Shuffle differently in every epoch, the same on every rank."""
+        self.epoch = epoch
+
+    def shards(self):
+        # row groups of every rank, deterministic for a seed and epoch
+        import numpy as np
+
+        order = np.arange(len(self.row_groups))
+        if self.shuffle:
+            np.random.default_rng([self.seed, self.epoch]).shuffle(order)
+        return [order[rank :: self.world_size] for rank in range(self.world_size)]
+
+    def n_rows(self):
+        """Rows served to this rank per epoch."""
+        return min(sum(self.row_groups[i][2] for i in shard) for shard in self.shards())
+
+    def __len__(self):
+        n_rows = self.n_rows()
+        if self.drop_last:
+            return n_rows // self.batch_size
+        return -(-n_rows // self.batch_size)
+
+    def read_table(self, i, columns=None):
+        # rows of row group i matching the criteria, with `columns` and the columns of
+        # the criteria
+        import pyarrow.parquet as pq
+
+        file_id, row_group, _ = self.row_groups[i]
+        if self.criteria and columns is not None:
+            columns = list(columns) + [
+                c.strip() for c in self.criteria if c.strip() not in columns
+            ]
+        parquet_file = pq.ParquetFile(self.paths[file_id])
+        table = parquet_file.read_row_group(row_group, columns=columns)
+        expression = criteria_to_expression(self.criteria, table.column_names)
+        if expression is not None:
+            table = table.filter(expression)
+        return table
+
+    def read_row_group(self, i):
+        table = self.read_table(i, self.columns)
+        if self.columns is not None:
+            table = table.select([c for c in self.columns if c in table.column_names])
+        return table_to_numpy(table)
+
+    def iter_row_groups(self):
+        # row groups of this rank in order, read ahead by the worker threads
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+
+        shard = self.shards()[self.rank]
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            pending = deque()
+            for i in shard:
+                if len(pending) >= self.prefetch:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(self.read_row_group, i))
+            while pending:
+                yield pending.popleft().result()
+
+    def window_batches(self, window, filled, remaining, rng, final=False):
+        # batches of the first `filled` rows of the window in shuffled order, the rows
+        # that do not fill a batch are moved to the front of the window; returns the
+        # number of rows kept and served
+        import numpy as np
+
+        order = rng.permutation(filled) if self.shuffle else np.arange(filled)
+        end = min(filled, remaining)
+        stop = end if final else end - end % self.batch_size
+        for start in range(0, stop, self.batch_size):
+            rows = order[start : min(start + self.batch_size, stop)]
+            if len(rows) < self.batch_size and self.drop_last:
+                break
+            yield {
+                name: np.take(values, rows, axis=0) for name, values in window.items()
+            }
+        rest = order[stop:filled] if not final else order[:0]
+        for values in window.values():
+            values[: len(rest)] = np.take(values, rest, axis=0)
+        return len(rest), stop
+
+    def __iter__(self):
+        import numpy as np
+
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank])
+        remaining = self.n_rows()
+        # the window arrays are allocated once and refilled, batches are gathered from
+        # them, so no large arrays are allocated per window
+        capacity = self.shuffle_buffer + max(
+            (n for _, _, n in self.row_groups), default=0
+        )
+        window, filled = None, 0
+
+        for arrays in self.iter_row_groups():
+            n = len(next(iter(arrays.values()))) if arrays else 0
+            if n == 0:
+                continue
+            if window is None:
+                window = {
+                    name: np.empty((capacity,) + values.shape[1:], dtype=values.dtype)
+                    for name, values in arrays.items()
+                }
+            for name, values in arrays.items():
+                window[name][filled : filled + n] = values
+            filled += n
+            if filled < self.shuffle_buffer:
+                continue
+
+            filled, served = yield from self.window_batches(
+                window, filled, remaining, rng
+            )
+            remaining -= served
+            # the last (partial) batch is served once its rows are in the window
+            if remaining < self.batch_size and (self.drop_last or filled >= remaining):
+                break
+
+        if filled and remaining > 0:
+            yield from self.window_batches(window, filled, remaining, rng, final=True)
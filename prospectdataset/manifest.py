@@ -0,0 +1,143 @@
+import json
+import os
+import re
+import time
+from collections import namedtuple
+
+from .config import AVAILABLE_DATASET_RECORDS, ZENODO_API_RECORDS
+
+MANIFEST_TTL = 7 * 24 * 60 * 60
+MANIFEST_DIRNAME = "manifests"
+
+META_DATA_KIND = "meta_data"
+ANNOTATION_KIND = "annotation"
+
+ManifestFile = namedtuple(
+    "ManifestFile", ["name", "size", "checksum", "url", "package", "pool", "kind"]
+)
+
+
+def parse_file_name(name):
+    """Return (package, pool, kind) for a file name of a PROSPECT record.
+
+    File names follow `<pool>_meta_data.parquet` and `<pool>_annotation*.zip`, the package
+    is the pool name without its trailing pool number.
+    """
+    stem = name.split(".", 1)[0]
+    if "_meta_data" in stem:
+        kind = META_DATA_KIND
+        pool = stem.split("_meta_data")[0]
+    elif "_annotation" in stem:
+        kind = ANNOTATION_KIND
+        pool = stem.split("_annotation")[0]
+    else:
+        return None, None, None
+
+    package = re.sub(r"_\d+$", "", pool)
+    return package, pool, kind
+
+
+def manifest_from_record_json(record_json):
+    files = []
+    for f in record_json.get("files", []):
+        name = f["key"]
+        package, pool, kind = parse_file_name(name)
+        files.append(
+            ManifestFile(
+                name=name,
+                size=f["size"],
+                checksum=f["checksum"],
+                url=f["links"]["self"],
+                package=package,
+                pool=pool,
+                kind=kind,
+            )
+        )
+    return files
+
+
+def fetch_manifest(record, timeout=60):
+    """Resolve the file list of a record with the Zenodo REST API."""
+    import urllib.request
+
+    record_id = AVAILABLE_DATASET_RECORDS[record]
+    with urllib.request.urlopen(
+        ZENODO_API_RECORDS + record_id, timeout=timeout
+    ) as response:
+        record_json = json.load(response)
+    return manifest_from_record_json(record_json)
+
+
+def save_manifest(files, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {"fetched_at": time.time(), "files": [m._asdict() for m in files]},
+            f,
+            indent=1,
+        )
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_manifest(path):
+    with open(path) as f:
+        manifest_json = json.load(f)
+    files = [ManifestFile(**m) for m in manifest_json["files"]]
+    return files, manifest_json.get("fetched_at", 0)
+
+
+def load_manifest(record, cache_dir=None, ttl=MANIFEST_TTL, offline=False):
+    """Return the list of `ManifestFile` of a record.
+
+    A copy cached in `<cache_dir>/manifests` is used as long as it is younger than `ttl`
+    seconds (or always when `offline=True`), otherwise the manifest is fetched from Zenodo
+    and cached. If Zenodo cannot be reached, a stale cached copy is used. Without a cached
+    copy, `offline=True` fails.
+    """
+    record_id = AVAILABLE_DATASET_RECORDS[record]
+    cached_path = (
+        os.path.join(cache_dir, MANIFEST_DIRNAME, record_id + ".json")
+        if cache_dir
+        else None
+    )
+    cached = None
+    if cached_path and os.path.exists(cached_path):
+        cached = read_manifest(cached_path)
+        files, fetched_at = cached
+        if offline or time.time() - fetched_at < ttl:
+            return files
+
+    if offline:
+        raise FileNotFoundError(
+            "No cached manifest available for record {}, run once without "
+            "offline=True to fetch it.".format(record)
+        )
+    try:
+        files = fetch_manifest(record)
+    except Exception as e:
+        if cached is None:
+            raise
+        print("Could not fetch manifest from Zenodo, using the cached copy:", e)
+        return cached[0]
+    if cached_path:
+        save_manifest(files, cached_path)
+    return files
+
+
+def filter_manifest(files, task="retention-time", select_pool=None):
+    """Select the files needed for a task and optionally a single pool or package."""
+    if task == "retention-time":
+        kinds = [META_DATA_KIND]
+    else:
+        kinds = [META_DATA_KIND, ANNOTATION_KIND]
+
+    files = [f for f in files if f.kind in kinds]
+    if select_pool:
+        files = [f for f in files if select_pool in f.name]
+    return files
+
+
+def sort_by_size(files, descending=True):
+    return sorted(files, key=lambda f: f.size, reverse=descending)
@@ -3,13 +3,14 @@
 def timedelta_metric(y_true, y_pred, threshold=0.95, two_sided=False):
     import numpy as np
 
-    y_true = np.array(y_true)
-    y_pred = np.array(y_pred)
+    y_true = np.asarray(y_true)
+    y_pred = np.asarray(y_pred)
 
     abs_error = np.abs(y_true - y_pred)
 
     mark_threshold = int(np.ceil(len(y_true) * threshold))
-    delta_at_threshold = sorted(abs_error)[mark_threshold - 1]
+    # selection of the k-th smallest error in O(n) instead of sorting all errors
+    delta_at_threshold = np.partition(abs_error, mark_threshold - 1)[mark_threshold - 1]
 
     norm_range = np.max(y_true) - np.min(y_true)
 
@@ -19,6 +20,124 @@ def timedelta_metric(y_true, y_pred, threshold=0.95, two_sided=False):
         return delta_at_threshold / norm_range
 
 
+def grouped_timedelta_metric(y_true, y_pred, groups, threshold=0.95, two_sided=False):
+    """`timedelta_metric` of each group (e.g. pool or peptide length) in one call.
+
+    Returns a Series indexed by the sorted group labels. The range of y_true is the
+    range within each group, as if `timedelta_metric` was called per group.
+    """
+    import numpy as np
+    import pandas as pd
+
+    y_true = np.asarray(y_true, dtype=np.float64)
+    abs_error = np.abs(y_true - np.asarray(y_pred, dtype=np.float64))
+    labels, codes = np.unique(np.asarray(groups), return_inverse=True)
+    codes = codes.ravel()
+
+    counts = np.bincount(codes, minlength=len(labels))
+    starts = np.cumsum(counts) - counts
+    # errors sorted within groups, the k-th smallest error of each group
+    order = np.argsort(abs_error)
+    sorted_errors = abs_error[order[np.argsort(codes[order], kind="stable")]]
+    mark_threshold = np.ceil(counts * threshold).astype(np.int64)
+    delta_at_threshold = sorted_errors[starts + np.maximum(mark_threshold - 1, 0)]
+
+    sorted_true = y_true[np.argsort(codes, kind="stable")]
+    norm_range = np.maximum.reduceat(sorted_true, starts) - np.minimum.reduceat(
+        sorted_true, starts
+    )
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        delta = delta_at_threshold * (2 if two_sided else 1) / norm_range
+    return pd.Series(delta, index=pd.Index(labels, name="group"), name="delta")
+
+
+class TimedeltaAccumulator:
+    """Streaming estimate of `timedelta_metric`, updated batch by batch.
+
+    Absolute errors are counted in logarithmic bins, so the error at the threshold is
+    accurate to `relative_accuracy` whatever the scale of the errors, with constant
+    memory. Errors below `min_error` count as 0. The range of y_true is exact.
+    Accumulators with the same parameters can be merged, e.g. across workers.
+
+        accumulator = TimedeltaAccumulator()
+        for y_true, y_pred in validation_batches:
+            accumulator.update(y_true, y_pred)
+        accumulator.result()
+    """
+
+    def __init__(
+        self,
+        threshold=0.95,
+        two_sided=False,
+        relative_accuracy=1e-3,
+        min_error=1e-6,
+        max_error=1e6,
+    ):
+        import numpy as np
+
+        self.threshold = threshold
+        self.two_sided = two_sided
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.min_error = min_error
+        # bin i > 0 holds errors in (gamma ** (i + offset - 1), gamma ** (i + offset)]
+        self.offset = int(np.floor(np.log(min_error) / self.log_gamma)) - 1
+        n_bins = int(np.ceil(np.log(max_error) / self.log_gamma)) - self.offset + 1
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+        self.y_min, self.y_max = np.inf, -np.inf
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def update(self, y_true, y_pred):
+        import numpy as np
+
+        y_true = np.asarray(y_true, dtype=np.float64).ravel()
+        abs_error = np.abs(y_true - np.asarray(y_pred, dtype=np.float64).ravel())
+        abs_error = abs_error[~np.isnan(abs_error)]
+        bins = np.zeros(len(abs_error), dtype=np.int64)
+        nonzero = abs_error >= self.min_error
+        bins[nonzero] = (
+            np.ceil(np.log(abs_error[nonzero]) / self.log_gamma) - self.offset
+        )
+        np.clip(bins, 0, len(self.counts) - 1, out=bins)
+        self.counts += np.bincount(bins, minlength=len(self.counts))
+        if len(y_true):
+            self.y_min = min(self.y_min, np.nanmin(y_true))
+            self.y_max = max(self.y_max, np.nanmax(y_true))
+        return self
+
+    def merge(self, other):
+        if len(other.counts) != len(self.counts) or other.gamma != self.gamma:
+            raise ValueError("Only accumulators with the same bins can be merged.")
+        self.counts += other.counts
+        self.y_min = min(self.y_min, other.y_min)
+        self.y_max = max(self.y_max, other.y_max)
+        return self
+
+    def quantile(self, q):
+        """Absolute error at quantile `q`, the ceil(n * q)-th smallest error."""
+        import numpy as np
+
+        n = len(self)
+        if n == 0:
+            return np.nan
+        rank = max(int(np.ceil(n * q)), 1)
+        i = int(np.searchsorted(np.cumsum(self.counts), rank))
+        if i == 0:
+            return 0.0
+        # the value with the smallest relative error to all values of the bin
+        return 2 * self.gamma ** (i + self.offset) / (self.gamma + 1)
+
+    def result(self):
+        delta_at_threshold = self.quantile(self.threshold)
+        norm_range = self.y_max - self.y_min
+        if self.two_sided:
+            delta_at_threshold *= 2
+        return delta_at_threshold / norm_range if norm_range else float("nan")
+
+
 def masked_spectral_distance(y_true, y_pred, epsilon=1e-7):
     import numpy as np
 
@@ -41,3 +160,181 @@ def masked_spectral_distance(y_true, y_pred, epsilon=1e-7):
     arccosine = np.arccos(product)
 
     return 2 * arccosine / np.pi
+
+
+BATCH_SIZE = 16_384
+HISTOGRAM_BINS = 10_000
+QUANTILES = (0.05, 0.25, 0.75, 0.95)
+
+
+class StreamingHistogram:
+    """Fixed-bin histogram of values in [low, high] that can be updated and merged.
+
+    Mean and standard deviation are exact, quantiles are interpolated within a bin, so
+    they are accurate to (high - low) / n_bins. Values outside the range are counted in
+    the first or last bin, NaN values are counted separately.
+    """
+
+    def __init__(self, low=0.0, high=1.0, n_bins=HISTOGRAM_BINS):
+        import numpy as np
+
+        self.low, self.high, self.n_bins = float(low), float(high), int(n_bins)
+        self.counts = np.zeros(self.n_bins, dtype=np.int64)
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.n_nan = 0
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def update(self, values):
+        import numpy as np
+
+        values = np.asarray(values, dtype=np.float64).ravel()
+        nan = np.isnan(values)
+        self.n_nan += int(nan.sum())
+        values = values[~nan]
+        bins = (values - self.low) * (self.n_bins / (self.high - self.low))
+        bins = np.clip(bins, 0, self.n_bins - 1).astype(np.int64)
+        self.counts += np.bincount(bins, minlength=self.n_bins)
+        self.total += float(values.sum())
+        self.total_squares += float(np.square(values).sum())
+        return self
+
+    def merge(self, other):
+        if (other.low, other.high, other.n_bins) != (self.low, self.high, self.n_bins):
+            raise ValueError("Only histograms with the same bins can be merged.")
+        self.counts += other.counts
+        self.total += other.total
+        self.total_squares += other.total_squares
+        self.n_nan += other.n_nan
+        return self
+
+    def quantile(self, q):
+        import numpy as np
+
+        n = len(self)
+        if n == 0:
+            return np.full(np.shape(q), np.nan)[()]
+        cumulative = np.append(0, np.cumsum(self.counts))
+        edges = np.linspace(self.low, self.high, self.n_bins + 1)
+        # linear interpolation of the empirical distribution within each bin
+        return np.interp(np.asarray(q, dtype=np.float64) * n, cumulative, edges)
+
+    def mean(self):
+        n = len(self)
+        return self.total / n if n else float("nan")
+
+    def std(self):
+        n = len(self)
+        if n < 2:
+            return float("nan")
+        variance = (self.total_squares - self.total**2 / n) / (n - 1)
+        return max(variance, 0.0) ** 0.5
+
+    def summary(self, quantiles=QUANTILES):
+        values = self.quantile(quantiles)
+        summary = {"count": len(self), "nan": self.n_nan}
+        summary.update({"mean": self.mean(), "std": self.std()})
+        summary.update(
+            {"q{:g}".format(100 * q): float(v) for q, v in zip(quantiles, values)}
+        )
+        summary["median"] = float(self.quantile(0.5))
+        return summary
+
+
+def iter_spectrum_batches(y_true, y_pred=None, batch_size=BATCH_SIZE):
+    """Yield (y_true, y_pred) batches of two 2D arrays (e.g. memory-mapped npy files).
+
+    If `y_pred` is None, `y_true` is taken to be an iterable of (y_true, y_pred) batches
+    and is passed through.
+    """
+    if y_pred is None:
+        yield from y_true
+        return
+    if len(y_true) != len(y_pred):
+        raise ValueError("y_true and y_pred have a different number of spectra.")
+    for start in range(0, len(y_true), batch_size):
+        yield y_true[start : start + batch_size], y_pred[start : start + batch_size]
+
+
+class _DistanceBuffers:
+    # float32 work arrays reused for every batch of the same width
+    def __init__(self):
+        self.arrays = None
+
+    def get(self, shape):
+        import numpy as np
+
+        if (
+            self.arrays is None
+            or self.arrays[0].shape[0] < shape[0]
+            or (self.arrays[0].shape[1] != shape[1])
+        ):
+            self.arrays = [np.empty(shape, dtype=np.float32) for _ in range(3)]
+        return [a[: shape[0]] for a in self.arrays]
+
+
+def _batch_spectral_distance(y_true, y_pred, buffers, epsilon=1e-7):
+    import numpy as np
+
+    true, pred, weight = buffers.get(np.shape(y_true))
+    np.copyto(true, y_true, casting="unsafe")
+    np.copyto(pred, y_pred, casting="unsafe")
+
+    # (y_true + 1) / (y_true + 1 + epsilon) is 0 for masked (-1) peaks and ~1 otherwise
+    np.add(true, 1, out=weight)
+    true *= weight
+    pred *= weight
+    weight += epsilon
+    true /= weight
+    pred /= weight
+
+    product = np.einsum("ij,ij->i", true, pred).astype(np.float64)
+    norms = np.einsum("ij,ij->i", true, true).astype(np.float64)
+    norms *= np.einsum("ij,ij->i", pred, pred)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        product /= np.sqrt(norms)
+    # rounding can push the cosine of identical spectra slightly above 1
+    np.clip(product, -1, 1, out=product)
+    return (2 / np.pi * np.arccos(product)).astype(np.float32)
+
+
+def batched_masked_spectral_distance(
+    y_true,
+    y_pred=None,
+    batch_size=BATCH_SIZE,
+    epsilon=1e-7,
+    return_distances=True,
+    n_bins=HISTOGRAM_BINS,
+):
+    """Masked spectral distance of many spectra, computed batch by batch in float32.
+
+    `y_true` and `y_pred` are 2D arrays (memory-mapped arrays are read batch by batch),
+    or `y_true` is an iterable of (y_true, y_pred) batches. Peaks with y_true == -1 are
+    masked as in `masked_spectral_distance`, the spectral angle is 1 - distance.
+
+    Returns the float32 distance of every spectrum (None if not `return_distances`) and a
+    `StreamingHistogram` of the distances for the mean, median and other quantiles.
+
+        distances, histogram = batched_masked_spectral_distance(
+            np.load("intensities.npy", mmap_mode="r"), predictions
+        )
+        histogram.summary()
+    """
+    import numpy as np
+
+    buffers = _DistanceBuffers()
+    histogram = StreamingHistogram(0.0, 1.0, n_bins)
+    distances = []
+    for true, pred in iter_spectrum_batches(y_true, y_pred, batch_size):
+        batch = _batch_spectral_distance(true, pred, buffers, epsilon)
+        histogram.update(batch)
+        if return_distances:
+            distances.append(batch)
+
+    if not return_distances:
+        return None, histogram
+    if not distances:
+        return np.zeros(0, dtype=np.float32), histogram
+    return np.concatenate(distances), histogram
@@ -0,0 +1,36 @@
+import os
+
+
+def resolve_n_jobs(n_jobs):
+    # -1 uses all cores, as in joblib
+    if n_jobs is None or n_jobs == 0:
+        return 1
+    if n_jobs < 0:
+        return max(1, os.cpu_count() + 1 + n_jobs)
+    return n_jobs
+
+
+def parallel_map(func, tasks, n_jobs=1, max_pending=None):
+    """Yield `func(*task)` for all tasks in order, using `n_jobs` processes.
+
+    At most `max_pending` tasks (default 2 * n_jobs) are submitted at a time, so only a
+    bounded number of task arguments and results are held in memory.
+    """
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    n_jobs = resolve_n_jobs(n_jobs)
+    if n_jobs == 1:
+        for task in tasks:
+            yield func(*task)
+        return
+
+    max_pending = max_pending or 2 * n_jobs
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        pending = deque()
+        for task in tasks:
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, *task))
+        while pending:
+            yield pending.popleft().result()
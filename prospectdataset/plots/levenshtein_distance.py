@@ -1,20 +1,48 @@
 import argparse
-import re
+import os
 import sys
-from itertools import combinations
 from pathlib import Path
 from typing import List
 
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 import seaborn as sns
-from Levenshtein import distance as levenshtein_distance
+
+from ..parallel import parallel_map
+from ..readers import read_parquet
+from ..tokenizer import unmodified
+
+ALPHABET_SIZE = 32
+MAX_SEQUENCE_LENGTH = 64
+PAIR_BATCH_SIZE = 1 << 14
+TASK_SIZE = 1 << 22
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "-d", "--dir_path", help="Path to the directory with the metadata files"
 )
+parser.add_argument(
+    "-n",
+    "--max_pairs",
+    default=500_000,
+    type=int,
+    help="Pairs sampled per peptide length when there are more pairs",
+)
+parser.add_argument(
+    "--exact",
+    action="store_true",
+    help="Compute all pairs of every peptide length, regardless of --max_pairs",
+)
+parser.add_argument(
+    "-j", "--n_jobs", default=1, type=int, help="Number of processes, -1 for all cores"
+)
+parser.add_argument("-s", "--seed", default=1, type=int, help="Seed of the sampling")
+parser.add_argument(
+    "-c",
+    "--cache",
+    help="Path of a .npz file with the distance histograms, created if missing and reused to re-plot",
+)
+parser.add_argument("-o", "--output", default="vs_dist.svg", help="Path of the figure")
 
 
 def internal_without_mods(sequences: List[str]) -> List[str]:
@@ -23,49 +51,228 @@ def internal_without_mods(sequences: List[str]) -> List[str]:
     :param sequences: List[str] of sequences
     :return: List[str] of modified sequences.
     """
-    regex = "\[.*?\]|\-"
-    return [re.sub(regex, "", seq) for seq in sequences]
+    return list(unmodified(sequences))
+
+
+def encode_sequences(sequences):
+    """Encode upper case sequences as a (n, max length) uint8 array of letter codes.
+
+    Returns the codes (1-26 for A-Z, 0 for padding) and the length of each sequence.
+    """
+    sequences = np.asarray(sequences, dtype=bytes)
+    lengths = np.char.str_len(sequences).astype(np.int64)
+    if len(sequences) and lengths.max() > MAX_SEQUENCE_LENGTH:
+        raise ValueError(
+            "Sequences longer than {} are not supported.".format(MAX_SEQUENCE_LENGTH)
+        )
+    width = max(int(lengths.max()) if len(sequences) else 0, 1)
+    codes = np.frombuffer(
+        sequences.astype("S{}".format(width)).tobytes(), dtype=np.uint8
+    ).reshape(len(sequences), width)
+    return codes & (ALPHABET_SIZE - 1), lengths
+
+
+def match_masks(codes, lengths):
+    # bit j of masks[i, c] is set if sequence i has letter c at position j
+    masks = np.zeros((len(codes), ALPHABET_SIZE), dtype=np.uint64)
+    rows = np.arange(len(codes))
+    for j in range(codes.shape[1]):
+        valid = lengths > j
+        masks[rows[valid], codes[valid, j]] |= np.uint64(1 << j)
+    return masks
+
+
+def myers_distances(masks, codes, lengths, first, second):
+    """Levenshtein distances of the pairs of sequences (first[k], second[k]).
+
+    Myers' bit-parallel algorithm, vectorised over the pairs: one column of the dynamic
+    programming matrix is a 64 bit word per pair, updated in place for each letter of
+    the second sequence.
+    """
+    one = np.uint64(1)
+    n = len(first)
+    first_lengths = lengths[first]
+    second_lengths = lengths[second]
+    width = int(second_lengths.max()) if n else 0
+    columns = np.ascontiguousarray(codes[second, :width].T)
+    # all second sequences have the same length within a length bucket
+    uniform = bool((second_lengths == width).all())
+
+    flat_masks = masks.ravel()
+    rows = first * masks.shape[1]
+    high_bit = one << (np.maximum(first_lengths, 1).astype(np.uint64) - one)
+    pv = np.full(n, ~np.uint64(0))
+    mv = np.zeros(n, dtype=np.uint64)
+    eq, xv, xh, ph, mh = (np.empty(n, dtype=np.uint64) for _ in range(5))
+    index = np.empty(n, dtype=np.int64)
+    score = first_lengths.copy()
+
+    for j in range(width):
+        np.add(rows, columns[j], out=index)
+        np.take(flat_masks, index, out=eq)
+        np.bitwise_or(eq, mv, out=xv)
+        np.bitwise_and(eq, pv, out=xh)
+        xh += pv
+        xh ^= pv
+        xh |= eq
+        np.bitwise_or(xh, pv, out=ph)
+        np.invert(ph, out=ph)
+        ph |= mv
+        np.bitwise_and(pv, xh, out=mh)
+
+        active = True if uniform else second_lengths > j
+        score += active & ((ph & high_bit) != 0)
+        score -= active & ((mh & high_bit) != 0)
+
+        ph <<= one
+        ph |= one
+        mh <<= one
+        if uniform:
+            np.bitwise_or(xv, ph, out=pv)
+            np.invert(pv, out=pv)
+            pv |= mh
+            np.bitwise_and(ph, xv, out=mv)
+        else:
+            pv = np.where(active, mh | ~(xv | ph), pv)
+            mv = np.where(active, ph & xv, mv)
+
+    # the distance to an empty sequence is the length of the other one
+    return np.where(first_lengths > 0, score, second_lengths)
+
+
+def row_pairs(n, start, stop):
+    # all pairs (i, j) with start <= i < stop and i < j < n
+    first = np.arange(start, stop)
+    counts = n - 1 - first
+    second = np.repeat(first + 1 - np.cumsum(counts) + counts, counts) + np.arange(
+        counts.sum()
+    )
+    return np.repeat(first, counts), second
+
+
+def pair_histogram(codes, lengths, n_bins, rows=None, pairs=None):
+    """Histogram of the distances of a range of `rows` paired with all following rows,
+    or of explicit (first, second) `pairs`, computed in batches of pairs."""
+    masks = match_masks(codes, lengths)
+    counts = np.zeros(n_bins, dtype=np.int64)
+    if rows is not None:
+        # batches of rows with about PAIR_BATCH_SIZE pairs each
+        start, stop = rows
+        batches = []
+        while start < stop:
+            step = max(1, PAIR_BATCH_SIZE // max(len(codes) - start - 1, 1))
+            batches.append(row_pairs(len(codes), start, min(start + step, stop)))
+            start += step
+    else:
+        batches = (
+            (pairs[0][i : i + PAIR_BATCH_SIZE], pairs[1][i : i + PAIR_BATCH_SIZE])
+            for i in range(0, len(pairs[0]), PAIR_BATCH_SIZE)
+        )
+    for first, second in batches:
+        distances = myers_distances(masks, codes, lengths, first, second)
+        counts += np.bincount(distances, minlength=n_bins)[:n_bins]
+    return counts
+
+
+def bucket_tasks(codes, lengths, n_bins, max_pairs=500_000, exact=False, rng=None):
+    """Tasks of one bucket of sequences: all pairs if there are at most `max_pairs`
+    (or `exact`), otherwise `max_pairs` pairs of distinct sequences sampled uniformly.
+    """
+    n = len(codes)
+    n_pairs = n * (n - 1) // 2
+    if exact or n_pairs <= max_pairs:
+        # row ranges with about TASK_SIZE pairs each
+        pairs_before = np.cumsum(n - 1 - np.arange(n)) - (n - 1 - np.arange(n))
+        bounds = np.searchsorted(
+            pairs_before, np.arange(0, n_pairs, TASK_SIZE), side="left"
+        )
+        for start, stop in zip(bounds, np.append(bounds[1:], n)):
+            if stop > start:
+                yield codes, lengths, n_bins, (int(start), int(stop)), None
+    else:
+        rng = rng or np.random.default_rng()
+        first = rng.integers(0, n, max_pairs)
+        second = rng.integers(0, n - 1, max_pairs)
+        second += second >= first
+        for i in range(0, max_pairs, TASK_SIZE):
+            pairs = (first[i : i + TASK_SIZE], second[i : i + TASK_SIZE])
+            yield codes, lengths, n_bins, None, pairs
+
+
+def distance_histograms(
+    sequences, groups, max_pairs=500_000, exact=False, n_jobs=1, seed=1
+):
+    """Histograms of the pairwise Levenshtein distances of the sequences of each group.
+
+    Returns the sorted group labels and an array with one row of counts per group.
+    """
+    sequences = np.asarray(sequences)
+    groups = np.asarray(groups)
+    codes, lengths = encode_sequences(sequences)
+    n_bins = int(lengths.max()) + 1 if len(lengths) else 1
+    labels = np.unique(groups)
+    rng = np.random.default_rng(seed)
+
+    tasks, task_groups = [], []
+    for g, label in enumerate(labels):
+        members = groups == label
+        for task in bucket_tasks(
+            codes[members], lengths[members], n_bins, max_pairs, exact, rng
+        ):
+            tasks.append(task)
+            task_groups.append(g)
+
+    counts = np.zeros((len(labels), n_bins), dtype=np.int64)
+    for g, histogram in zip(task_groups, parallel_map(pair_histogram, tasks, n_jobs)):
+        counts[g] += histogram
+    return labels, counts
+
+
+def read_unmodified_sequences(dir_path):
+    """Unique unmodified sequences of all metadata files, reading one column."""
+    sequences = set()
+    for parquet_path in sorted(Path(dir_path).glob("*meta_data.parquet")):
+        table = read_parquet(str(parquet_path), columns=["modified_sequence"])
+        modified = table.column(0).to_pandas().unique()
+        sequences.update(internal_without_mods(modified))
+    return np.array(sorted(sequences))
 
 
 def main(sys_args=sys.argv[1:]):
     args = parser.parse_args(sys_args)
-    pools = []
-    for i, parquet_path in enumerate(Path(args.dir_path).glob("*meta_data.parquet")):
-        pool_meta_data = pd.read_parquet(parquet_path)
-        pool_meta_data.drop_duplicates("modified_sequence", inplace=True)
-        pool_meta_data["unmod_seq"] = internal_without_mods(
-            pool_meta_data["modified_sequence"]
+    plt.switch_backend("Agg")
+
+    if args.cache and os.path.exists(args.cache):
+        print("Loading the histograms from", args.cache)
+        with np.load(args.cache) as data:
+            lengths, counts = data["lengths"], data["counts"]
+    else:
+        sequences = read_unmodified_sequences(args.dir_path)
+        lengths, counts = distance_histograms(
+            sequences,
+            np.char.str_len(sequences.astype(str)),
+            args.max_pairs,
+            args.exact,
+            args.n_jobs,
+            args.seed,
         )
-        pool_meta_data.drop_duplicates("unmod_seq", inplace=True)
-        pools.append(pool_meta_data)
-
-    pools_meta_data = pd.concat(pools)
-    pools_meta_data.drop_duplicates("unmod_seq", inplace=True)
-    lv_dict = {}
-    pep_groups = pools_meta_data.groupby("peptide_length")
-    available_lengths = pools_meta_data.peptide_length.unqiue()
-
-    for length, peptides in pep_groups:
-        current_list = []
-        if len(peptides.index) > 1000:
-            samples = peptides["unmod_seq"].sample(n=1000, random_state=1)
-        else:
-            samples = peptides["unmod_seq"].values
-        a = combinations(samples, 2)
-        for pep_tuple in a:
-            current_list.append(levenshtein_distance(pep_tuple[0], pep_tuple[1]) - 1)
-        lv_dict[str(length)] = current_list
+        if args.cache:
+            np.savez(args.cache, lengths=lengths, counts=counts)
 
     sns.set_palette("rocket_r", n_colors=36)
 
-    for length in available_lengths:
-        fig = sns.kdeplot(
-            np.array(lv_dict[str(length)]),
+    distances = np.arange(counts.shape[1])
+    for length, length_counts in zip(lengths, counts):
+        if length_counts.sum() == 0:
+            continue
+        sns.kdeplot(
+            x=distances,
+            weights=length_counts,
             bw_method=0.5,
             label=str(length),
-            cbar=True,
-            shade=True,
+            fill=True,
         )
-        plt.legend()
+    plt.legend()
 
-    plt.savefig("vs_dist.svg")
+    plt.savefig(args.output)
+    plt.close()
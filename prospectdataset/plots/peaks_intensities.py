@@ -1,148 +1,95 @@
 import argparse
-import statistics
 import sys
-from pathlib import Path
 
 import matplotlib.pyplot as plt
-import pandas as pd
+import numpy as np
 import seaborn as sns
 
+from .statistics import ION_TYPES, load_or_collect
+
+# standard deviation of the smoothing of the violins, in histogram bins
+SMOOTHING_BINS = 5
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "-d", "--dir_path", help="Path to the directory with the annotation files"
 )
+parser.add_argument(
+    "-c",
+    "--cache",
+    help="Path of a .npz file with the statistics, created if missing and reused to re-plot",
+)
+parser.add_argument(
+    "-o", "--output", default="violin_peaks.svg", help="Path of the figure"
+)
 
 
 def main(sys_args=sys.argv[1:]):
     args = parser.parse_args(sys_args)
-    all_peaks = pd.DataFrame()
-    for i, parquet_path in enumerate(
-        Path(args.dir_path).glob("*/**_annotation.parquet")
-    ):
-        annotation = pd.read_parquet(
-            parquet_path,
-            columns=[
-                "raw_file",
-                "scan_number",
-                "experimental_mass",
-                "scan_number",
-                "ion_type",
-                "no",
-                "charge",
-                "neutral_loss",
-            ],
-            engine="pyarrow",
-        )
-        annotation.drop_duplicates(
-            subset=["raw_file", "scan_number", "experimental_mass"],
-            keep="first",
-            inplace=True,
-        )
-        annotation.drop_duplicates(
-            subset=[
-                "raw_file",
-                "scan_number",
-                "ion_type",
-                "no",
-                "charge",
-                "neutral_loss",
-            ],
-            keep="first",
-            inplace=True,
-        )
-        all_peaks = pd.concat([all_peaks, annotation])
-    median_b_nl = round(
-        statistics.median(
-            all_peaks.loc[
-                (all_peaks["ion_type"] == "b") & (all_peaks["has_neutral_loss"])
-            ]["median"]
-        ),
-        2,
-    )
-    median_b = round(
-        statistics.median(
-            all_peaks.loc[
-                (all_peaks["ion_type"] == "b") & (~all_peaks["has_neutral_loss"])
-            ]["median"]
-        ),
-        2,
+    plt.switch_backend("Agg")
+    statistics = load_or_collect(args.cache, annotation_dir=args.dir_path)
+    plot_peaks_intensities(
+        statistics.intensity_medians, statistics.ion_counts.counts, args.output
     )
 
-    median_y_nl = round(
-        statistics.median(
-            all_peaks.loc[
-                (all_peaks["ion_type"] == "y") & (all_peaks["has_neutral_loss"])
-            ]["median"]
-        ),
-        2,
-    )
-    median_y = round(
-        statistics.median(
-            all_peaks.loc[
-                (all_peaks["ion_type"] == "y") & (~all_peaks["has_neutral_loss"])
-            ]["median"]
-        ),
-        2,
-    )
 
-    b_ions = all_peaks.loc[
-        (all_peaks["ion_type"] == "b") & (~all_peaks["has_neutral_loss"])
-    ]["count"].sum()
-    b_ions_NL = all_peaks.loc[
-        (all_peaks["ion_type"] == "b") & (all_peaks["has_neutral_loss"])
-    ]["count"].sum()
-    y_ions = all_peaks.loc[
-        (all_peaks["ion_type"] == "y") & (~all_peaks["has_neutral_loss"])
-    ]["count"].sum()
-    y_ions_NL = all_peaks.loc[
-        (all_peaks["ion_type"] == "y") & (all_peaks["has_neutral_loss"])
-    ]["count"].sum()
+def smoothed_density(counts, sigma=SMOOTHING_BINS):
+    # histogram smoothed with a Gaussian kernel, scaled to a maximum of 1
+    offsets = np.arange(-4 * sigma, 4 * sigma + 1)
+    kernel = np.exp(-0.5 * (offsets / sigma) ** 2)
+    density = np.convolve(counts, kernel, mode="same")
+    return density / density.max() if density.max() > 0 else density
+
+
+def plot_peaks_intensities(histogram, ion_counts, output_path="violin_peaks.svg"):
+    """Split violins of the median b/y ion intensity per spectrum, without (left) and with
+    (right) neutral loss, from a `GroupedHistogram` with groups 2 * ion type + has
+    neutral loss and the ion counts per (ion type, has neutral loss)."""
+    colors = sns.color_palette("Set2")
+    counts = np.zeros((2, 2), dtype=np.int64)
+    counts[: len(ion_counts), : np.shape(ion_counts)[1]] = ion_counts[:2, :2]
 
     fig = plt.figure()
     ax = fig.gca()
-    ax = sns.violinplot(
-        x="ion_type",
-        y="median",
-        hue="has_neutral_loss",
-        data=all_peaks,
-        palette="Set2",
-        split=True,
-    )
-    ax.axhline(
-        median_b,
-        color="black",
-        linestyle="-",
-        label="n_b_ions =" + str(b_ions) + " " + str(median_b),
-        linewidth=1,
-        xmax=0.25,
-    )
-    ax.axhline(
-        median_b_nl,
-        color="black",
-        linestyle="-",
-        label="n_b_ions_nl =" + str(b_ions_NL) + " " + str(median_b_nl),
-        linewidth=1,
-        xmin=0.25,
-        xmax=0.47,
-    )
-    ax.axhline(
-        median_y,
-        color="black",
-        linestyle="-",
-        label="n_y_ions =" + str(y_ions) + " " + str(median_y),
-        linewidth=1,
-        xmin=0.55,
-        xmax=0.75,
-    )
-    ax.axhline(
-        median_y_nl,
-        color="black",
-        linestyle="-",
-        label="n_y_ions_nl =" + str(y_ions_NL) + " " + str(median_y_nl),
-        linewidth=1,
-        xmin=0.75,
-    )
+    # axes fractions covered by the median lines of each group
+    spans = [(0, 0.25), (0.25, 0.47), (0.55, 0.75), (0.75, 1)]
+    names = ["n_b_ions", "n_b_ions_nl", "n_y_ions", "n_y_ions_nl"]
+    for position, ion_type in enumerate(ION_TYPES):
+        for has_neutral_loss in [False, True]:
+            group = 2 * position + has_neutral_loss
+            if group >= len(histogram.counts):
+                continue
+            width = 0.4 * smoothed_density(histogram.counts[group])
+            side = 1 if has_neutral_loss else -1
+            ax.fill_betweenx(
+                histogram.centers,
+                position,
+                position + side * width,
+                color=colors[has_neutral_loss],
+                label=str(has_neutral_loss) if position == 0 else None,
+            )
+            median = round(float(histogram.quantile(group, 0.5)), 2)
+            xmin, xmax = spans[group]
+            ax.axhline(
+                median,
+                color="black",
+                linestyle="-",
+                label=names[group]
+                + " ="
+                + str(counts[position, int(has_neutral_loss)])
+                + " "
+                + str(median),
+                linewidth=1,
+                xmin=xmin,
+                xmax=xmax,
+            )
+
+    ax.set_xlim(-0.5, len(ION_TYPES) - 0.5)
+    ax.set_xticks(range(len(ION_TYPES)), ION_TYPES)
+    ax.set_xlabel("ion_type")
+    ax.set_ylabel("median")
     ax.set_ylim(-0.02, 0.5)
-    plt.legend(loc="upper left")
+    plt.legend(loc="upper left", title="has_neutral_loss")
 
-    plt.savefig("violin_peaks.svg", bbox_inches="tight")
+    plt.savefig(output_path, bbox_inches="tight")
+    plt.close()
@@ -1,10 +1,10 @@
 import argparse
 import sys
-from pathlib import Path
 
 import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sns
+import numpy as np
+
+from .statistics import load_or_collect, weighted_box_stats
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -15,86 +15,47 @@ parser.add_argument(
 parser.add_argument(
     "-m", "--dir_path_metadata", help="Path to the directory with the meta data files"
 )
+parser.add_argument(
+    "-c",
+    "--cache",
+    help="Path of a .npz file with the statistics, created if missing and reused to re-plot",
+)
+parser.add_argument(
+    "-o", "--output", default="peaks_per_AA_boxplot.png", help="Path of the figure"
+)
 
 
 def main(sys_args=sys.argv[1:]):
     args = parser.parse_args(sys_args)
-    meta_data_list = []
-    for j, parquet_path_md in enumerate(
-        Path(args.dir_path_metadata).glob("*meta_data.parquet")
-    ):
-        file_name = (
-            str(parquet_path_md).split("/")[-1].replace("_meta_data.parquet", "")
-        )
-        path_ann = args.dir_path_annotation + "/" + file_name
-        meta_data = pd.read_parquet(
-            parquet_path_md,
-            columns=["raw_file", "scan_number", "peptide_length"],
-            engine="pyarrow",
-        )
-        count = 0
+    plt.switch_backend("Agg")
+    statistics = load_or_collect(
+        args.cache, args.dir_path_metadata, args.dir_path_annotation
+    )
+    plot_peaks_per_aa(statistics.peaks_per_length.counts, args.output)
 
-        for f, parquet_path in enumerate(Path(path_ann).glob("*annotation.parquet")):
-            annotation = pd.read_parquet(
-                parquet_path,
-                columns=[
-                    "raw_file",
-                    "scan_number",
-                    "experimental_mass",
-                    "ion_type",
-                    "no",
-                    "charge",
-                    "neutral_loss",
-                ],
-                engine="pyarrow",
-            )
-            annotation.drop_duplicates(
-                subset=["raw_file", "scan_number", "experimental_mass"],
-                keep="first",
-                inplace=True,
-            )
-            annotation.drop_duplicates(
-                subset=[
-                    "raw_file",
-                    "scan_number",
-                    "ion_type",
-                    "no",
-                    "charge",
-                    "neutral_loss",
-                ],
-                keep="first",
-                inplace=True,
-            )
-            meta_data = meta_data.merge(
-                annotation.groupby(["raw_file", "scan_number"])
-                .size()
-                .to_frame()
-                .reset_index(),
-                left_on=["raw_file", "scan_number"],
-                right_on=["raw_file", "scan_number"],
-                how="left",
-            )
-            count += 1
 
-        meta_data["peaks"] = meta_data.iloc[:, -count:].sum(axis=1)
-        meta_data_list.append(
-            meta_data[["raw_file", "scan_number", "peptide_length", "peaks"]]
-        )
+def plot_peaks_per_aa(counts, output_path="peaks_per_AA_boxplot.png"):
+    """Box plot of the annotated peaks per amino acid of each peptide length.
+
+    `counts[length, peaks]` is the number of spectra with `peaks` annotated peaks.
+    """
+    peaks = np.arange(counts.shape[1])
+    stats = [
+        weighted_box_stats(peaks / length, counts[length], label=length)
+        for length in np.flatnonzero(counts.sum(axis=1))
+        if length > 0
+    ]
 
-    concat_meta_data = pd.concat(meta_data_list, ignore_index=True)
-    concat_meta_data.dropna(inplace=True)
-    concat_meta_data.to_csv("meta_data_concat.csv")
     plt.rcParams["figure.figsize"] = [30, 15]
-    concat_meta_data["peaks/length"] = (
-        concat_meta_data["peaks"] / concat_meta_data["peptide_length"]
-    )
-    ax = sns.boxplot(
-        y="peaks/length",
-        x="peptide_length",
-        data=concat_meta_data,
-        color="seagreen",
+    fig, ax = plt.subplots()
+    ax.bxp(
+        stats,
         showfliers=False,
+        patch_artist=True,
+        boxprops={"facecolor": "seagreen"},
+        medianprops={"color": "black"},
     )
     ax.set_xlabel("peptide length")
-    plt.savefig("peaks_per_AA_boxplot.png", dpi=300, bbox_inches="tight")
+    ax.set_ylabel("peaks/length")
+    plt.savefig(output_path, dpi=300, bbox_inches="tight")
     plt.close()
@@ -1,38 +1,45 @@
 import argparse
 import sys
-from pathlib import Path
 
 import matplotlib.pyplot as plt
-import pandas as pd
+import numpy as np
 import seaborn as sns
 
+from .statistics import load_or_collect
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "-d", "--dir_path", help="Path to the directory with the metadata files"
 )
+parser.add_argument(
+    "-c",
+    "--cache",
+    help="Path of a .npz file with the statistics, created if missing and reused to re-plot",
+)
+parser.add_argument(
+    "-o", "--output", default="peptides_charges_dist.svg", help="Path of the figure"
+)
 
 
 def main(sys_args=sys.argv[1:]):
     args = parser.parse_args(sys_args)
-    pools = []
-    for i, parquet_path in enumerate(Path(args.dir_path).glob("*meta_data.parquet")):
-        pool_meta_data = pd.read_parquet(parquet_path)
-        pools.append(pool_meta_data)
-
-    meta_data = pd.concat(pools)
-    df_pie = (
-        meta_data.groupby(["precursor_charge", "peptide_length"])
-        .size()
-        .unstack(fill_value=0)
-    )
+    plt.switch_backend("Agg")
+    statistics = load_or_collect(args.cache, metadata_dir=args.dir_path)
+    plot_charges_distribution(statistics.charge_length.counts, args.output)
+
+
+def plot_charges_distribution(counts, output_path="peptides_charges_dist.svg"):
+    """Pie chart of the precursor charges of each peptide length.
+
+    `counts[charge, length]` is the number of spectra per charge and length.
+    """
+    lengths = np.flatnonzero(counts.sum(axis=0))
     colors = sns.color_palette()[0:6]
 
-    f, axes = plt.subplots(
-        1, len(meta_data["peptide_length"].unique()), figsize=(20, 5)
-    )
-    for ax, col in zip(axes, df_pie.columns):
-        patches, text = ax.pie(df_pie[col].values, colors=colors)
-        ax.set(title=col)
+    f, axes = plt.subplots(1, len(lengths), figsize=(20, 5), squeeze=False)
+    for ax, length in zip(axes[0], lengths):
+        patches, text = ax.pie(counts[1:7, length], colors=colors)
+        ax.set(title=length)
 
     plt.legend(
         labels=["1", "2", "3", "4", "5", "6"],
@@ -44,4 +51,5 @@ def main(sys_args=sys.argv[1:]):
     )
     plt.axis("off")
 
-    plt.savefig("peptides_charges_dist.svg", dpi=300, bbox_inches="tight")
+    plt.savefig(output_path, dpi=300, bbox_inches="tight")
+    plt.close()
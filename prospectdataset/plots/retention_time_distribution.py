@@ -1,52 +1,63 @@
 import argparse
 import itertools
 import sys
-from pathlib import Path
 
 import matplotlib.pyplot as plt
-import pandas as pd
+import numpy as np
 import seaborn as sns
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
+
+from .statistics import load_or_collect
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "-d", "--dir_path", help="Path to the directory with the metadata files"
 )
+parser.add_argument(
+    "-c",
+    "--cache",
+    help="Path of a .npz file with the statistics, created if missing and reused to re-plot",
+)
+parser.add_argument("-o", "--output", default="distrib.svg", help="Path of the figure")
 
 
 def main(sys_args=sys.argv[1:]):
     args = parser.parse_args(sys_args)
-    pools = []
-    for i, parquet_path in enumerate(Path(args.dir_path).glob("*meta_data.parquet")):
-        pool_meta_data = pd.read_parquet(parquet_path)
-        pools.append(pool_meta_data)
+    plt.switch_backend("Agg")
+    statistics = load_or_collect(args.cache, metadata_dir=args.dir_path)
+    plot_retention_time_distribution(statistics.retention_time, args.output)
 
-    meta_data = pd.concat(pools)
+
+def plot_retention_time_distribution(histogram, output_path="distrib.svg"):
+    """Density of the retention time of each peptide length from a `GroupedHistogram`
+    (one group per peptide length)."""
+    lengths = np.flatnonzero(histogram.counts.sum(axis=1))
     palette = itertools.cycle(
-        sns.color_palette(
-            "YlOrRd_r", n_colors=len(meta_data["peptide length"].unique())
-        )
+        sns.color_palette("YlOrRd_r", n_colors=max(len(lengths), 1))
     )
 
     plt.rcParams["figure.figsize"] = [18, 10]
-    lengths = sorted(meta_data["peptide length"].unique())
-    plot = plt.scatter(lengths, lengths, c=lengths, cmap="YlOrRd_r")
-    plt.clf()
-    cbar = plt.colorbar(plot)
+    fig, ax = plt.subplots()
+    mappable = ScalarMappable(
+        norm=Normalize(*(lengths[[0, -1]] if len(lengths) else (0, 1))),
+        cmap="YlOrRd_r",
+    )
+    cbar = fig.colorbar(mappable, ax=ax)
     cbar.ax.set_ylabel("peptide length", rotation=270)
     cbar.ax.yaxis.set_label_coords(2.2, 0.5)
 
-    for i in range(
-        meta_data["peptide length"].min(), meta_data["peptide length"].max() + 1
-    ):
-        if (
-            len(meta_data[meta_data["peptide length"] == i]["retention_time"]) != 1
-            and len(meta_data[meta_data["peptide length"] == i]["retention_time"]) != 2
-        ):
-            ax = sns.kdeplot(
-                data=meta_data[meta_data["peptide length"] == i]["retention_time"],
+    for length in lengths:
+        # a density needs more than two values
+        if histogram.counts[length].sum() > 2:
+            sns.kdeplot(
+                x=histogram.centers,
+                weights=histogram.counts[length],
                 color=next(palette),
+                ax=ax,
             )
 
     ax.set(xlabel="retention time", ylabel="density")
 
-    plt.savefig("distrib.svg", dpi=300, bbox_inches="tight")
+    plt.savefig(output_path, dpi=300, bbox_inches="tight")
+    plt.close()
@@ -1,12 +1,16 @@
 import argparse
+import os
 import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 from matplotlib.colors import LogNorm
 from matplotlib.ticker import LogLocator
 
+from ..readers import column_range, iter_parquet_batches
+
+BATCH_SIZE = 1_000_000
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "-p",
@@ -14,15 +18,135 @@ parser.add_argument(
     help="Path to the file with Retention time predictions and targets",
 )
 
-parser.add_argument("-d", "--delta_95", help="iRT delta95 value")
+parser.add_argument("-d", "--delta_95", help="iRT delta95 value", default=5, type=float)
+parser.add_argument(
+    "-b",
+    "--bins",
+    help="Number of bins per axis of the 2D histogram",
+    default=1000,
+    type=int,
+)
+parser.add_argument(
+    "-c",
+    "--cache",
+    help="Path of a .npz file with the 2D histogram, created if missing and reused to re-plot",
+)
+parser.add_argument(
+    "-o", "--output", help="Path of the figure", default="iRT_density_plot.svg"
+)
+
+
+class DensityHistogram:
+    """Fixed-grid 2D histogram of (target, prediction) pairs, updated batch by batch.
+
+    Points are binned with integer indexing and `np.bincount`, so memory does not grow
+    with the number of points. Points outside the ranges are not counted, as in
+    `np.histogram2d`. The histogram can be saved and loaded to re-plot without the data.
+    """
+
+    def __init__(self, x_range, y_range=None, nbins=1000):
+        self.x_edges = np.linspace(*x_range, nbins + 1)
+        self.y_edges = np.linspace(*(y_range or x_range), nbins + 1)
+        self.counts = np.zeros((nbins, nbins), dtype=np.int64)
+
+    @property
+    def nbins(self):
+        return len(self.counts)
+
+    def bin_indices(self, values, edges):
+        # bin of each value, values on (or rounded up to) the upper edge fall in the
+        # last bin
+        low, high = edges[0], edges[-1]
+        scale = self.nbins / (high - low) if high > low else 0.0
+        return np.clip(((values - low) * scale).astype(np.int64), 0, self.nbins - 1)
+
+    def update(self, x, y):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        inside = (
+            (x >= self.x_edges[0])
+            & (x <= self.x_edges[-1])
+            & (y >= self.y_edges[0])
+            & (y <= self.y_edges[-1])
+        )
+        x_bins = self.bin_indices(x[inside], self.x_edges)
+        y_bins = self.bin_indices(y[inside], self.y_edges)
+        self.counts += np.bincount(
+            x_bins * self.nbins + y_bins, minlength=self.nbins**2
+        ).reshape(self.counts.shape)
+        return self
+
+    def merge(self, other):
+        if not (
+            np.array_equal(self.x_edges, other.x_edges)
+            and np.array_equal(self.y_edges, other.y_edges)
+        ):
+            raise ValueError("Only histograms with the same bins can be merged.")
+        self.counts += other.counts
+        return self
+
+    @classmethod
+    def from_arrays(cls, x, y, nbins=1000, batch_size=BATCH_SIZE):
+        x, y = np.asarray(x), np.asarray(y)
+        histogram = cls((np.min(x), np.max(x)), (np.min(y), np.max(y)), nbins)
+        for start in range(0, len(x), batch_size):
+            histogram.update(
+                x[start : start + batch_size], y[start : start + batch_size]
+            )
+        return histogram
+
+    @classmethod
+    def from_parquet(
+        cls,
+        path,
+        x_column="targets",
+        y_column="predictions",
+        nbins=1000,
+        batch_size=BATCH_SIZE,
+    ):
+        """Accumulate the histogram of two columns of a parquet file, batch by batch.
+
+        The ranges are taken from the row group statistics when available.
+        """
+        histogram = cls(
+            column_range(path, x_column), column_range(path, y_column), nbins
+        )
+        for batch in iter_parquet_batches(path, batch_size, [x_column, y_column]):
+            histogram.update(
+                batch.column(x_column).to_numpy(zero_copy_only=False),
+                batch.column(y_column).to_numpy(zero_copy_only=False),
+            )
+        return histogram
+
+    def save(self, path):
+        np.savez_compressed(
+            path, counts=self.counts, x_edges=self.x_edges, y_edges=self.y_edges
+        )
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            histogram = cls((0, 1), nbins=len(data["counts"]))
+            histogram.counts = data["counts"]
+            histogram.x_edges = data["x_edges"]
+            histogram.y_edges = data["y_edges"]
+        return histogram
 
 
 def main(sys_args=sys.argv[1:]):
     args = parser.parse_args(sys_args)
-    iRT_pred_targets = pd.read_parquet(args.pred_path)
-    plot_density(
-        iRT_pred_targets["targets"], iRT_pred_targets["predictions"], args.delta_95
-    )
+    # no display needed, the figure is only saved
+    plt.switch_backend("Agg")
+
+    if args.cache and os.path.exists(args.cache):
+        print("Loading the histogram from", args.cache)
+        histogram = DensityHistogram.load(args.cache)
+    else:
+        histogram = DensityHistogram.from_parquet(args.pred_path, nbins=args.bins)
+        if args.cache:
+            histogram.save(args.cache)
+    plot_density_histogram(histogram, args.delta_95, output_path=args.output)
 
 
 def plot_density(
@@ -32,6 +156,7 @@ def plot_density(
     palette="Reds_r",
     delta95_line_color="#36479E",
     nbins=1000,
+    output_path="iRT_density_plot.svg",
 ):
     """Create density plot
     Arguments
@@ -42,23 +167,38 @@ def plot_density(
         palette (str, optional): Color palette from matplotlib. Defaults to 'Reds_r'.
         delta95_line_color (str, optional): Color for the delta 95% line. Defaults to '#36479E'.
         nbins (int, optional): Number of bins to use for creating the 2D histogram. Defaults to 1000.
+        output_path (str, optional): Path of the figure. Defaults to 'iRT_density_plot.svg'.
     """
+    histogram = DensityHistogram.from_arrays(targets, predictions, nbins)
+    return plot_density_histogram(
+        histogram, irt_delta95, palette, delta95_line_color, output_path
+    )
 
-    H, xedges, yedges = np.histogram2d(targets, predictions, bins=nbins)
-
-    x_min = np.min(targets)
-    x_max = np.max(targets)
-
-    # H needs to be rotated and flipped
-    H = np.rot90(H)
-    H = np.flipud(H)
-
-    # Mask zeros
-    Hmasked = np.ma.masked_where(H == 0, H)  # Mask pixels with a value of zero
 
-    # Plot 2D histogram using pcolor
-    cm = plt.cm.get_cmap(palette)
-    plt.pcolormesh(xedges, yedges, Hmasked, cmap=cm, norm=LogNorm(vmin=1e0, vmax=1e2))
+def plot_density_histogram(
+    histogram,
+    irt_delta95=5,
+    palette="Reds_r",
+    delta95_line_color="#36479E",
+    output_path="iRT_density_plot.svg",
+    vmax=1e2,
+):
+    """Render a `DensityHistogram` as an image, see `plot_density`."""
+    x_min, x_max = histogram.x_edges[0], histogram.x_edges[-1]
+
+    # rows of the image are predictions, mask zeros
+    H = np.ma.masked_where(histogram.counts.T == 0, histogram.counts.T)
+
+    cm = plt.get_cmap(palette)
+    plt.imshow(
+        H,
+        cmap=cm,
+        norm=LogNorm(vmin=1e0, vmax=vmax),
+        origin="lower",
+        extent=[x_min, x_max, histogram.y_edges[0], histogram.y_edges[-1]],
+        aspect="auto",
+        interpolation="nearest",
+    )
 
     plt.xlabel("Targets", fontsize=18)
     plt.ylabel("Predictions", fontsize=18)
@@ -81,6 +221,6 @@ def plot_density(
     font_size = 14  # Adjust as appropriate.
     cbar.ax.tick_params(labelsize=font_size)
     cbar.ax.minorticks_on()
-    plt.savefig("iRT_density_plot.svg")
-    plt.show()
+    plt.savefig(output_path)
     plt.close()
+    return output_path
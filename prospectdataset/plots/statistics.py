@@ -0,0 +1,421 @@
+"""Statistics of metadata and annotation files for the plots, collected in one pass.
+
+The files are streamed batch by batch into small mergeable accumulators, which can be
+cached to a .npz file so that the figures can be re-rendered without reading the data.
+"""
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ..dedupe import FRAGMENT_KEYS, dedupe_annotations
+from ..keys import KEY_COLUMNS, shared_categories, spectrum_keys
+from ..readers import column_range, iter_parquet_batches
+
+BATCH_SIZE = 1_000_000
+HISTOGRAM_BINS = 1000
+
+METADATA_COLUMNS = [
+    "raw_file",
+    "scan_number",
+    "precursor_charge",
+    "peptide_length",
+    "retention_time",
+]
+ANNOTATION_COLUMNS = [
+    "raw_file",
+    "scan_number",
+    "experimental_mass",
+    "ion_type",
+    "no",
+    "charge",
+    "neutral_loss",
+    "intensity",
+]
+ION_TYPES = ["b", "y"]
+
+
+class CountTable:
+    """Counts of pairs of non-negative integers, growing with the largest values."""
+
+    def __init__(self, counts=None):
+        self.counts = np.zeros((0, 0), dtype=np.int64) if counts is None else counts
+
+    def grow(self, shape):
+        if shape[0] > self.counts.shape[0] or shape[1] > self.counts.shape[1]:
+            counts = np.zeros(np.maximum(shape, self.counts.shape), dtype=np.int64)
+            counts[: self.counts.shape[0], : self.counts.shape[1]] = self.counts
+            self.counts = counts
+
+    def update(self, rows, columns, weights=None):
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = np.asarray(columns, dtype=np.int64)
+        if len(rows) == 0:
+            return self
+        self.grow((rows.max() + 1, columns.max() + 1))
+        n_columns = self.counts.shape[1]
+        self.counts += (
+            np.bincount(rows * n_columns + columns, weights, minlength=self.counts.size)
+            .astype(np.int64)
+            .reshape(self.counts.shape)
+        )
+        return self
+
+    def merge(self, other):
+        self.grow(other.counts.shape)
+        self.counts[: other.counts.shape[0], : other.counts.shape[1]] += other.counts
+        return self
+
+    def state(self):
+        return {"counts": self.counts}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state["counts"])
+
+
+class GroupedHistogram:
+    """Fixed-bin histograms of values in [low, high] for integer groups.
+
+    Quantiles are interpolated within a bin, so they are accurate to the bin width. Values
+    outside the range are counted in the first or last bin.
+    """
+
+    def __init__(self, low=0.0, high=1.0, n_bins=HISTOGRAM_BINS, counts=None):
+        self.low, self.high = float(low), float(high)
+        if counts is None:
+            counts = np.zeros((0, n_bins), dtype=np.int64)
+        self.counts = counts
+
+    @property
+    def edges(self):
+        return np.linspace(self.low, self.high, self.counts.shape[1] + 1)
+
+    @property
+    def centers(self):
+        edges = self.edges
+        return (edges[1:] + edges[:-1]) / 2
+
+    def update(self, groups, values):
+        groups = np.asarray(groups, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        groups, values = groups[valid], values[valid]
+        if len(groups) == 0:
+            return self
+        n_groups, n_bins = max(groups.max() + 1, len(self.counts)), self.counts.shape[1]
+        if n_groups > len(self.counts):
+            self.counts = np.vstack(
+                [self.counts, np.zeros((n_groups - len(self.counts), n_bins), np.int64)]
+            )
+        scale = n_bins / (self.high - self.low) if self.high > self.low else 0.0
+        bins = np.clip(((values - self.low) * scale).astype(np.int64), 0, n_bins - 1)
+        self.counts += np.bincount(
+            groups * n_bins + bins, minlength=self.counts.size
+        ).reshape(self.counts.shape)
+        return self
+
+    def merge(self, other):
+        if (other.low, other.high) != (self.low, self.high):
+            raise ValueError("Only histograms with the same bins can be merged.")
+        n_groups = max(len(self.counts), len(other.counts))
+        counts = np.zeros((n_groups, self.counts.shape[1]), dtype=np.int64)
+        counts[: len(self.counts)] += self.counts
+        counts[: len(other.counts)] += other.counts
+        self.counts = counts
+        return self
+
+    def quantile(self, group, q):
+        if group >= len(self.counts) or self.counts[group].sum() == 0:
+            return np.full(np.shape(q), np.nan)[()]
+        cumulative = np.append(0, np.cumsum(self.counts[group]))
+        return np.interp(np.asarray(q) * cumulative[-1], cumulative, self.edges)
+
+    def state(self):
+        return {"counts": self.counts, "range": np.array([self.low, self.high])}
+
+    @classmethod
+    def from_state(cls, state):
+        low, high = state["range"]
+        return cls(low, high, counts=state["counts"])
+
+
+class PlotStatistics:
+    """Accumulators of all plots.
+
+    - charge_length: spectra per (precursor charge, peptide length)
+    - retention_time: retention time histogram per peptide length
+    - peaks_per_length: spectra per (peptide length, number of annotated peaks)
+    - intensity_medians: histogram of the median intensity of the b/y ions of each
+      spectrum, per group 2 * ion type + has neutral loss
+    - ion_counts: annotated ions per (ion type, has neutral loss)
+    """
+
+    ACCUMULATORS = {
+        "charge_length": CountTable,
+        "retention_time": GroupedHistogram,
+        "peaks_per_length": CountTable,
+        "intensity_medians": GroupedHistogram,
+        "ion_counts": CountTable,
+    }
+
+    def __init__(self, retention_time_range=(0.0, 1.0)):
+        self.charge_length = CountTable()
+        self.retention_time = GroupedHistogram(*retention_time_range)
+        self.peaks_per_length = CountTable()
+        self.intensity_medians = GroupedHistogram(0.0, 1.0)
+        self.ion_counts = CountTable()
+        # input directories and files the statistics were collected from
+        self.inputs = None
+
+    def update_metadata(self, df):
+        if {"precursor_charge", "peptide_length"} <= set(df.columns):
+            self.charge_length.update(df["precursor_charge"], df["peptide_length"])
+        if {"retention_time", "peptide_length"} <= set(df.columns):
+            self.retention_time.update(df["peptide_length"], df["retention_time"])
+        return self
+
+    def update_annotations(self, df, lengths=None):
+        """Add annotations of whole spectra, `lengths` maps spectra to peptide lengths."""
+        df = dedupe_annotations(
+            df,
+            fragment_score=None,
+            intensity=None,
+            fragment_keys=FRAGMENT_KEYS + ["neutral_loss"],
+        )
+        if len(df) == 0:
+            return self
+
+        keys = spectrum_keys(
+            df["raw_file"], df["scan_number"], shared_categories(df["raw_file"])
+        )
+        if lengths is not None:
+            _, first, peaks = np.unique(keys, return_index=True, return_counts=True)
+            spectrum_lengths = lengths(df.iloc[first])
+            found = spectrum_lengths >= 0
+            self.peaks_per_length.update(spectrum_lengths[found], peaks[found])
+
+        ion_type = pd.Categorical(df["ion_type"], categories=ION_TYPES).codes
+        is_fragment = ion_type >= 0
+        has_neutral_loss = (
+            df["neutral_loss"].astype(object).fillna("") != ""
+        ).to_numpy()
+        groups = (2 * ion_type + has_neutral_loss)[is_fragment]
+        self.ion_counts.update(ion_type[is_fragment], has_neutral_loss[is_fragment])
+
+        # median intensity of each ion group of each spectrum
+        medians = (
+            pd.DataFrame(
+                {
+                    "key": keys[is_fragment],
+                    "group": groups,
+                    "intensity": df["intensity"].to_numpy()[is_fragment],
+                }
+            )
+            .groupby(["key", "group"])["intensity"]
+            .median()
+        )
+        self.intensity_medians.update(
+            medians.index.get_level_values("group"), medians.to_numpy()
+        )
+        return self
+
+    def merge(self, other):
+        for name in self.ACCUMULATORS:
+            getattr(self, name).merge(getattr(other, name))
+        return self
+
+    def save(self, path):
+        arrays = {
+            "{}.{}".format(name, key): value
+            for name in self.ACCUMULATORS
+            for key, value in getattr(self, name).state().items()
+        }
+        if self.inputs is not None:
+            arrays["inputs"] = np.array(json.dumps(self.inputs))
+        np.savez_compressed(path, **arrays)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        statistics = cls()
+        with np.load(path) as data:
+            for name, accumulator in cls.ACCUMULATORS.items():
+                state = {
+                    key.split(".", 1)[1]: data[key]
+                    for key in data.files
+                    if key.split(".", 1)[0] == name
+                }
+                setattr(statistics, name, accumulator.from_state(state))
+            if "inputs" in data.files:
+                statistics.inputs = json.loads(str(data["inputs"]))
+        return statistics
+
+
+class PeptideLengths:
+    """Peptide length of spectra of one pool, looked up by packed spectrum keys."""
+
+    def __init__(self, frames):
+        df = pd.concat(frames, ignore_index=True) if frames else None
+        if df is None or len(df) == 0:
+            self.categories = pd.Index([])
+            self.keys = np.zeros(0, dtype=np.int64)
+            self.lengths = np.zeros(0, dtype=np.int64)
+            return
+        self.categories = shared_categories(df["raw_file"])
+        keys = spectrum_keys(df["raw_file"], df["scan_number"], self.categories)
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.lengths = df["peptide_length"].to_numpy(np.int64)[order]
+
+    def __call__(self, df):
+        # peptide length of each row of `df`, -1 for unknown spectra
+        keys = spectrum_keys(df["raw_file"], df["scan_number"], self.categories)
+        position = np.searchsorted(self.keys, keys).clip(0, max(len(self.keys) - 1, 0))
+        found = (keys >= 0) & (len(self.keys) > 0)
+        found[found] = self.keys[position[found]] == keys[found]
+        return np.where(found, self.lengths[position] if len(self.keys) else -1, -1)
+
+
+def iter_spectra(path, batch_size=BATCH_SIZE, columns=None):
+    """Yield DataFrames of annotation rows that contain whole spectra.
+
+    Rows of a spectrum are consecutive in the annotation files, the rows of the last
+    spectrum of a batch are held back and prepended to the next batch.
+    """
+    carry = None
+    for batch in iter_parquet_batches(path, batch_size, columns):
+        table = pa.Table.from_batches([batch])
+        if carry is not None:
+            table = pa.concat_tables([carry, table], promote_options="permissive")
+        df = table.select(KEY_COLUMNS).to_pandas()
+        same = (df["raw_file"] == df["raw_file"].iat[-1]).to_numpy() & (
+            df["scan_number"] == df["scan_number"].iat[-1]
+        ).to_numpy()
+        different = np.flatnonzero(~same)
+        tail = different[-1] + 1 if len(different) else 0
+        carry = table.slice(tail)
+        if tail:
+            yield table.slice(0, tail).to_pandas()
+    if carry is not None and carry.num_rows:
+        yield carry.to_pandas()
+
+
+def metadata_pools(metadata_dir):
+    # pool name and path of the metadata files
+    return [
+        (path.name.replace("_meta_data.parquet", ""), str(path))
+        for path in sorted(Path(metadata_dir).glob("*meta_data.parquet"))
+    ]
+
+
+def collect_statistics(metadata_dir=None, annotation_dir=None, batch_size=BATCH_SIZE):
+    """Stream the metadata and annotation files once and return their `PlotStatistics`.
+
+    Annotations of a pool are expected in `annotation_dir/<pool>/*annotation.parquet`.
+    Peak counts per peptide length need the metadata of the pool, the intensity
+    statistics use all annotation files under `annotation_dir`.
+    """
+    pools = metadata_pools(metadata_dir) if metadata_dir else []
+    ranges = []
+    for _, path in pools:
+        if "retention_time" in pq.read_schema(path).names:
+            ranges.append(column_range(path, "retention_time"))
+    statistics = PlotStatistics(
+        (min(r[0] for r in ranges), max(r[1] for r in ranges)) if ranges else (0, 1)
+    )
+
+    used_annotations = set()
+    for pool, path in pools:
+        frames = []
+        for batch in iter_parquet_batches(path, batch_size, METADATA_COLUMNS):
+            df = batch.to_pandas()
+            statistics.update_metadata(df)
+            if "peptide_length" in df.columns:
+                frames.append(df[["raw_file", "scan_number", "peptide_length"]])
+        if annotation_dir is None:
+            continue
+        lengths = PeptideLengths(frames)
+        for annotation_path in sorted(
+            Path(annotation_dir, pool).glob("*annotation.parquet")
+        ):
+            used_annotations.add(str(annotation_path))
+            for df in iter_spectra(
+                str(annotation_path), batch_size, ANNOTATION_COLUMNS
+            ):
+                statistics.update_annotations(df, lengths)
+
+    if annotation_dir is not None:
+        # annotations without metadata only add to the intensity statistics
+        for annotation_path in sorted(
+            Path(annotation_dir).glob("*/*annotation.parquet")
+        ):
+            if str(annotation_path) in used_annotations:
+                continue
+            for df in iter_spectra(
+                str(annotation_path), batch_size, ANNOTATION_COLUMNS
+            ):
+                statistics.update_annotations(df)
+    return statistics
+
+
+def statistics_inputs(metadata_dir=None, annotation_dir=None):
+    """Directories and files (with size and modification time) the statistics of
+    `collect_statistics` are built from."""
+    files = [path for _, path in metadata_pools(metadata_dir)] if metadata_dir else []
+    if annotation_dir is not None:
+        files += [
+            str(p) for p in sorted(Path(annotation_dir).glob("*/*annotation.parquet"))
+        ]
+    return {
+        "metadata_dir": os.path.abspath(metadata_dir) if metadata_dir else None,
+        "annotation_dir": os.path.abspath(annotation_dir) if annotation_dir else None,
+        "files": [
+            [os.path.abspath(f), os.path.getsize(f), os.path.getmtime(f)] for f in files
+        ],
+    }
+
+
+def load_or_collect(cache=None, metadata_dir=None, annotation_dir=None):
+    """Load the statistics from the `cache` file if it was built from the same inputs
+    (or no inputs are given, to re-plot from the cache only), otherwise collect them
+    (and write them to `cache`)."""
+    inputs = statistics_inputs(metadata_dir, annotation_dir)
+    if cache and os.path.exists(cache):
+        statistics = PlotStatistics.load(cache)
+        if statistics.inputs == inputs or (metadata_dir, annotation_dir) == (
+            None,
+            None,
+        ):
+            print("Loading the statistics from", cache)
+            return statistics
+        print("The statistics in", cache, "were built from other inputs, collecting")
+    statistics = collect_statistics(metadata_dir, annotation_dir)
+    statistics.inputs = inputs
+    if cache:
+        statistics.save(cache)
+    return statistics
+
+
+def weighted_box_stats(values, weights, label=None):
+    """Box plot statistics (for `Axes.bxp`) of `values` repeated `weights` times."""
+    order = np.argsort(values)
+    values, weights = np.asarray(values)[order], np.asarray(weights)[order]
+    values, weights = values[weights > 0], weights[weights > 0]
+    cumulative = np.cumsum(weights) / weights.sum()
+    q1, median, q3 = values[np.searchsorted(cumulative, [0.25, 0.5, 0.75])]
+    iqr = q3 - q1
+    inside = values[(values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)]
+    return {
+        "label": label,
+        "med": median,
+        "q1": q1,
+        "q3": q3,
+        "whislo": inside.min(),
+        "whishi": inside.max(),
+        "fliers": [],
+    }
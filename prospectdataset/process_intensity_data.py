@@ -1,8 +1,48 @@
 import glob
+import itertools
+import os
 import warnings
-from os.path import dirname, join, splitext
+from os.path import basename, dirname, join
 
+from .dedupe import dedupe_annotations
 from .download import download_dataset
+from .encoders import ROW_GROUP_SIZE, encode_features, to_arrow_table, write_parquet
+from .export import EXPORT_FORMATS, SpectrumShardWriter, export_spectra
+from .index import build_index
+from .keys import (
+    KEY_COLUMNS,
+    as_categorical,
+    concat_frames,
+    encode_dictionary_columns,
+    spectrum_keys,
+)
+from .manifest import parse_file_name
+from .parallel import parallel_map, resolve_n_jobs
+from .profiling import PipelineProfile
+from .readers import (
+    ANNOTATION_COLUMNS,
+    ANNOTATION_FILTERING_CRITERIA,
+    annotation_criteria,
+    iter_parquet_batches,
+    read_parquet,
+)
+from .tokenizer import tokenize_pool, unmodified_lengths
+
+# annotation matrix layout, same as spectrum_fundamentals for HCD
+ANNOTATION_SEQ_LEN = 30
+ANNOTATION_ION_TYPES = ["y", "b"]
+N_FRAGMENT_CHARGES = 3
+ANNOTATION_VECTOR_LENGTH = (
+    (ANNOTATION_SEQ_LEN - 1) * len(ANNOTATION_ION_TYPES) * N_FRAGMENT_CHARGES
+)
+
+# number of annotated peaks per shard when building the annotation matrix in parallel
+SHARD_ROWS = 5_000_000
+
+# streaming mode: memory budget in bytes and estimated in-memory size per on-disk byte
+DEFAULT_MEMORY_BUDGET = 4 * 1024**3
+STREAMING_MEMORY_FACTOR = 10
+MIN_STREAMING_BATCH_SIZE = 10_000
 
 COLUMNS_TO_DROP = [
     "precursor_intensity",
@@ -21,89 +61,385 @@ def download_process_pool(
     pool_name=None,
     save_filepath=None,
     metadata_filtering_criteria=None,
-    parquet_engine="fastparquet",
+    parquet_engine="pyarrow",
+    n_jobs=1,
+    streaming=False,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+    metadata_columns=None,
+    annotation_columns=ANNOTATION_COLUMNS,
+    annotation_filtering_criteria=ANNOTATION_FILTERING_CRITERIA,
+    export_format=None,
+    index=False,
+    tokenize=False,
+    profile=None,
+    profile_path=None,
+    record="prospect",
 ):
-    import pandas as pd
-    from spectrum_fundamentals.constants import FRAGMENTATION_ENCODING
+    """Download (if `pool_name` is given) and process a pool.
+
+    With `index=True` a spectrum index (see `SpectrumIndex`) and with `tokenize=True`
+    the token arrays of the sequences are written next to the processed pool.
 
+    Every stage is measured with a `PipelineProfile` (pass one to keep the report or to
+    set a callback), the report is printed at the end and written to `profile_path`
+    (JSON, or CSV for a `.csv` path) if given.
+    """
+    profile = PipelineProfile() if profile is None else profile
     # if (not annotations_data_dir and not metadata_path) or (not pool_name and not save_path):
     #    raise ValueError("You should either provide path to metadata and annotations or a pool name to download.")
     # if a pool name is provided, trigger download
     if pool_name:
         print("Downloading pool: ", pool_name)
         save_dir = dirname(save_filepath)
-        downloaded_files = download_dataset("all", save_dir, pool_name)
-        for f in downloaded_files:
+        with profile.stage("download"):
+            downloaded_files = download_dataset(
+                record=record,
+                task="all",
+                save_directory=save_dir,
+                select_pool=pool_name,
+            )
+        for f in itertools.chain(*downloaded_files):
             if f.endswith(".parquet"):
                 metadata_path = f
             if f.endswith(".zip"):
-                annotations_data_dir = splitext(f)[0]
+                # annotation archives are extracted into one folder per pool
+                annotations_data_dir = join(save_dir, parse_file_name(basename(f))[1])
 
     print("-" * 80)
     print("Starting processing and filtering the pool, this may take a while...")
     print("-" * 80)
 
+    if export_format and export_format not in EXPORT_FORMATS:
+        raise ValueError(
+            "Unknown export format {}, available: {}".format(
+                export_format, EXPORT_FORMATS
+            )
+        )
+    if export_format and not save_filepath:
+        raise ValueError("Exporting requires a save_filepath (the export directory).")
+
     # read meta data file
     print("Reading metadata file from", metadata_path)
-    metadata_df = pd.read_parquet(metadata_path, engine=parquet_engine)
-    columns_to_drop = list(set(metadata_df.columns).intersection(set(COLUMNS_TO_DROP)))
-    metadata_df.drop(columns_to_drop, axis=1, inplace=True)
+    with profile.stage("read_metadata") as stage:
+        metadata_df = read_metadata(
+            metadata_path, parquet_engine, metadata_columns, metadata_filtering_criteria
+        )
+        stage["rows_out"] = len(metadata_df)
+    if parquet_engine == "pyarrow":
+        # the filters were already pushed down into the metadata scan
+        metadata_filtering_criteria = None
 
     # read annotation files
-    annotation_files = glob.glob(
-        join(annotations_data_dir, "*.parquet"), recursive=True
+    annotation_files = sorted(
+        glob.glob(join(annotations_data_dir, "*.parquet"), recursive=True)
     )
 
-    # time consuming ???
-    print("Reading and processing annotation files...")
-    annotation_df = read_process_annotation_files(annotation_files)
+    if streaming:
+        if not save_filepath:
+            raise ValueError("Streaming mode requires a save_filepath.")
+        stream_process_pool(
+            metadata_df,
+            annotation_files,
+            save_filepath,
+            metadata_filtering_criteria,
+            memory_budget,
+            annotation_columns,
+            annotation_filtering_criteria,
+            export_format,
+            profile,
+        )
+        if index and not export_format:
+            with profile.stage("index"):
+                index_pool(save_filepath)
+        if tokenize and not export_format:
+            with profile.stage("tokenize"):
+                tokenize_pool(save_filepath)
+        profile.report_to(profile_path)
+        return save_filepath
 
-    # rename comlumns for fundamentals # ToDo
-    if "experimental_mass" in list(annotation_df.columns):
-        annotation_df.rename(columns={"experimental_mass": "exp_mass"}, inplace=True)
+    print("Reading and processing annotation files...")
+    with profile.stage("read_annotations") as stage:
+        annotation_df = read_process_annotation_files(
+            annotation_files,
+            parquet_engine,
+            n_jobs=n_jobs,
+            columns=annotation_columns,
+            criteria=annotation_filtering_criteria,
+        )
+        stage["rows_out"] = len(annotation_df)
 
-    # time consuming ???
     print("Building annotation dataframe...")
-    annotation_matrix_df = build_annotation_df(annotation_df, metadata_df)
+    with profile.stage("build_matrix", rows_in=len(annotation_df)) as stage:
+        annotation_matrix_df = build_annotation_df(
+            annotation_df, metadata_df, n_jobs=n_jobs
+        )
+        stage["rows_out"] = len(annotation_matrix_df)
     del annotation_df
 
-    meta_data_merge = metadata_df.merge(
-        annotation_matrix_df, on=["raw_file", "scan_number"], how="inner"
+    meta_data_merge = merge_filter_encode(
+        metadata_df, annotation_matrix_df, metadata_filtering_criteria, profile
     )
     del metadata_df
 
-    print("Applying metadata filters...")
+    if not save_filepath:
+        # return dataframe in-memory
+        profile.report_to(profile_path)
+        return meta_data_merge
+
+    with profile.stage("write", rows_in=len(meta_data_merge)):
+        if export_format:
+            # memory-mappable shards in the directory save_filepath
+            export_spectra(meta_data_merge, save_filepath)
+        else:
+            # save to disk as parquet file and return file path
+            write_parquet(meta_data_merge, save_filepath)
+    if export_format:
+        profile.report_to(profile_path)
+        return save_filepath
+
+    if index:
+        with profile.stage("index"):
+            index_pool(save_filepath)
+    if tokenize:
+        # padded token arrays next to the pool, see tokenizer.load_tokens
+        with profile.stage("tokenize"):
+            tokenize_pool(save_filepath)
+
+    profile.report_to(profile_path)
+    return save_filepath
+
+
+def index_pool(save_filepath):
+    # spectrum index next to the processed pool, see SpectrumIndex.get_spectra
+    print("Building spectrum index...")
+    return build_index(save_filepath)
+
+
+def read_metadata(
+    metadata_path,
+    parquet_engine="pyarrow",
+    columns=None,
+    metadata_filtering_criteria=None,
+):
+    """Read the metadata file without COLUMNS_TO_DROP (or only `columns`).
+
+    With the pyarrow engine, column selection and filtering criteria are pushed down into
+    the parquet scan, other engines read the file and filter in pandas.
+    """
+    import pandas as pd
+
+    if parquet_engine == "pyarrow":
+        metadata_df = read_parquet(
+            metadata_path,
+            columns=columns,
+            criteria=metadata_filtering_criteria,
+            exclude_columns=COLUMNS_TO_DROP,
+        ).to_pandas()
+        return encode_dictionary_columns(metadata_df)
+
+    metadata_df = pd.read_parquet(metadata_path, engine=parquet_engine, columns=columns)
+    columns_to_drop = list(set(metadata_df.columns).intersection(set(COLUMNS_TO_DROP)))
+    metadata_df.drop(columns_to_drop, axis=1, inplace=True)
     if metadata_filtering_criteria:
-        meta_data_merge = apply_metadata_filters(
-            meta_data_merge, metadata_filtering_criteria
+        metadata_df = apply_metadata_filters(metadata_df, metadata_filtering_criteria)
+    return encode_dictionary_columns(metadata_df)
+
+
+def merge_filter_encode(
+    metadata_df, annotation_matrix_df, metadata_filtering_criteria=None, profile=None
+):
+    profile = PipelineProfile() if profile is None else profile
+    with profile.stage("merge", rows_in=len(annotation_matrix_df)) as stage:
+        # join on the packed (raw_file, scan_number) key instead of the strings
+        raw_files = as_categorical(metadata_df["raw_file"])
+        categories = raw_files.categories
+        meta_data_merge = metadata_df.assign(
+            raw_file=raw_files,
+            spectrum_key=spectrum_keys(
+                raw_files, metadata_df["scan_number"], categories
+            ),
+        ).merge(
+            annotation_matrix_df.drop(columns=KEY_COLUMNS).assign(
+                spectrum_key=spectrum_keys(
+                    annotation_matrix_df["raw_file"],
+                    annotation_matrix_df["scan_number"],
+                    categories,
+                )
+            ),
+            on="spectrum_key",
+            how="inner",
         )
+        meta_data_merge = meta_data_merge.drop(columns="spectrum_key")
+
+        print("Applying metadata filters...")
+        if metadata_filtering_criteria:
+            meta_data_merge = apply_metadata_filters(
+                meta_data_merge, metadata_filtering_criteria
+            )
+        stage["rows_out"] = len(meta_data_merge)
 
     print("Scaling and adding encoded columns...")
-    # scale CE
-    if "aligned_collision_energy" in list(meta_data_merge.columns):
-        meta_data_merge["collision_energy_aligned_normed"] = meta_data_merge[
-            "aligned_collision_energy"
-        ].apply(lambda x: x / 100.0)
-
-    # encoding fragmentation methods
-    if "fragmentation" in list(meta_data_merge.columns):
-        meta_data_merge["method_nbr"] = meta_data_merge["fragmentation"].map(
-            FRAGMENTATION_ENCODING
+    with profile.stage("encode", rows_in=len(meta_data_merge)) as stage:
+        meta_data_merge = encode_features(meta_data_merge)
+        stage["rows_out"] = len(meta_data_merge)
+
+    return meta_data_merge
+
+
+def streaming_batch_size(annotation_files, memory_budget):
+    # rows per record batch so that processing one batch stays within the budget
+    import pyarrow.parquet as pq
+
+    rows, size = 0, 0
+    for file in annotation_files:
+        metadata = pq.ParquetFile(file).metadata
+        rows += metadata.num_rows
+        size += sum(
+            metadata.row_group(i).total_byte_size
+            for i in range(metadata.num_row_groups)
         )
+    bytes_per_row = STREAMING_MEMORY_FACTOR * size / max(rows, 1)
+    return max(MIN_STREAMING_BATCH_SIZE, int(memory_budget / max(bytes_per_row, 1)))
 
-    # one-hot encoding  of precursor charge
-    if "precursor_charge" in list(meta_data_merge.columns):
-        meta_data_merge["precursor_charge_onehot"] = meta_data_merge[
-            "precursor_charge"
-        ].apply(precursor_int_to_onehot)
 
-    if not save_filepath:
-        # return dataframe in-memory
-        return meta_data_merge
+def iter_annotation_chunks(annotation_files, batch_size, columns=None, criteria=None):
+    """Yield annotation DataFrames of complete spectra from parquet record batches.
+
+    Annotations are expected to be stored contiguously per (raw_file, scan_number), rows of
+    the last spectrum of a batch are carried over to the next batch (or file).
+    """
+    carry = None
+    for file in annotation_files:
+        print("Streaming file: ", file)
+        for batch in iter_parquet_batches(file, batch_size, columns, criteria):
+            df = batch.to_pandas()
+            if carry is not None:
+                df = concat_frames([carry, df])
+            if df.empty:
+                continue
+            last_spectrum = (df["raw_file"] == df["raw_file"].iloc[-1]) & (
+                df["scan_number"] == df["scan_number"].iloc[-1]
+            )
+            carry = df[last_spectrum]
+            if not last_spectrum.all():
+                yield df[~last_spectrum]
+    if carry is not None and len(carry):
+        yield carry
+
 
-    # save to disk as parquet file and return file path
-    meta_data_merge.to_parquet(save_filepath, index=False)
+def stream_process_pool(
+    metadata_df,
+    annotation_files,
+    save_filepath,
+    metadata_filtering_criteria=None,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+    annotation_columns=ANNOTATION_COLUMNS,
+    annotation_filtering_criteria=ANNOTATION_FILTERING_CRITERIA,
+    export_format=None,
+    profile=None,
+):
+    """Process a pool chunk by chunk and write the result with an incremental ParquetWriter.
 
+    Only one chunk of annotations (sized after `memory_budget` in bytes) and its annotation
+    matrix are held in memory next to the metadata. Rows are written in the order of the
+    annotation files. With `export_format="npy"`, chunks are written to `.npy` shards in
+    the directory `save_filepath` instead.
+    """
+    import numpy as np
+    import pandas as pd
+    import pyarrow.parquet as pq
+
+    charge_seq = spectrum_metadata(metadata_df)
+    categories = charge_seq["raw_file"].cat.categories
+
+    # metadata rows sorted by their packed key, to look up the rows of each chunk
+    metadata_keys = spectrum_keys(
+        metadata_df["raw_file"], metadata_df["scan_number"], categories
+    )
+    metadata_order = np.argsort(metadata_keys, kind="stable")
+    metadata_keys = metadata_keys[metadata_order]
+
+    batch_size = streaming_batch_size(
+        annotation_files, memory_budget or DEFAULT_MEMORY_BUDGET
+    )
+    print("Streaming annotations in batches of", batch_size, "rows...")
+
+    profile = PipelineProfile() if profile is None else profile
+    writer = None
+    n_rows = 0
+    try:
+        for chunk in profile.iterate(
+            "read_annotations",
+            iter_annotation_chunks(
+                annotation_files,
+                batch_size,
+                annotation_columns,
+                annotation_criteria(annotation_filtering_criteria),
+            ),
+        ):
+            with profile.stage("dedupe_annotations", rows_in=len(chunk)) as stage:
+                chunk = process_annotation_df(chunk)
+                stage["rows_out"] = len(chunk)
+            if chunk.empty:
+                continue
+
+            with profile.stage("build_matrix", rows_in=len(chunk)) as stage:
+                raw_files, scans, intensities, masses = build_annotation_matrix(
+                    chunk, charge_seq=charge_seq
+                )
+                annotation_matrix_df = pd.DataFrame(
+                    {
+                        "scan_number": scans,
+                        "raw_file": raw_files,
+                        "intensities_raw": list(intensities),
+                        "masses_raw": list(masses),
+                    }
+                )
+
+                # metadata rows of the spectra in this chunk
+                chunk_keys = spectrum_keys(raw_files, scans, categories)
+                start = np.searchsorted(metadata_keys, chunk_keys, side="left")
+                counts = (
+                    np.searchsorted(metadata_keys, chunk_keys, side="right") - start
+                )
+                rows = np.repeat(
+                    start - np.cumsum(counts) + counts, counts
+                ) + np.arange(counts.sum())
+                metadata_chunk = metadata_df.iloc[np.sort(metadata_order[rows])]
+                stage["rows_out"] = len(annotation_matrix_df)
+
+            out = merge_filter_encode(
+                metadata_chunk,
+                annotation_matrix_df,
+                metadata_filtering_criteria,
+                profile,
+            )
+            n_rows += len(out)
+            with profile.stage("write", rows_in=len(out)):
+                if export_format:
+                    if writer is None:
+                        writer = SpectrumShardWriter(save_filepath)
+                    writer.write(out)
+                    continue
+
+                table = to_arrow_table(out)
+                if writer is None:
+                    writer = pq.ParquetWriter(save_filepath, table.schema)
+                writer.write_table(table.cast(writer.schema), ROW_GROUP_SIZE)
+    except BaseException:
+        # a partial export must not look complete: no index or footer is written
+        if isinstance(writer, SpectrumShardWriter):
+            writer.abort()
+        elif writer is not None:
+            writer.close()
+            os.remove(save_filepath)
+        raise
+
+    if writer is not None:
+        with profile.stage("write"):
+            writer.close()
+
+    print("Wrote", n_rows, "rows to", save_filepath)
     return save_filepath
 
 
@@ -115,6 +451,7 @@ def apply_metadata_filters(df, metadata_filtering_criteria):
     #    "precursor_charge": "<= 6",
     # }
 
+    conditions = []
     for column_name, condition in metadata_filtering_criteria.items():
         print("Filtering Column: ", column_name)
         print("Condition: ", condition)
@@ -126,60 +463,91 @@ def apply_metadata_filters(df, metadata_filtering_criteria):
                 )
             )
             continue
-        filter_query = column_name.strip() + condition.strip()
-        df = df.query(filter_query)
+        conditions.append("({}{})".format(column_name.strip(), condition.strip()))
+
+    # one combined mask and a single copy of the kept rows
+    if conditions:
+        df = df.query(" and ".join(conditions))
     return df
 
 
-def read_process_annotation_files(annotation_files, parquet_engine="fastparquet"):
+def read_process_annotation_file(
+    file,
+    parquet_engine="pyarrow",
+    columns=ANNOTATION_COLUMNS,
+    criteria=ANNOTATION_FILTERING_CRITERIA,
+):
     import pandas as pd
 
-    a_dfs = []
-
-    for file in annotation_files:
-        print("Reading file: ", file)
+    print("Reading file: ", file)
+    if parquet_engine == "pyarrow":
+        # only the needed columns and rows are decoded
+        df = read_parquet(
+            file, columns=columns, criteria=annotation_criteria(criteria)
+        ).to_pandas()
+    else:
         df = pd.read_parquet(file, engine=parquet_engine)
+        df = apply_metadata_filters(df, annotation_criteria(criteria))
+    df = process_annotation_df(encode_dictionary_columns(df))
+
+    print("Done.")
+    print("-" * 80)
+    return df
 
-        # filtering
+
+def process_annotation_df(df):
+    # filtering, unless already done while reading
+    if "neutral_loss" in df.columns:
         print("Filtering annotation file...")
         mask = ((df.neutral_loss) == "") & (df.ion_type != "precursor")
         df = df[mask]
 
-        df.drop("neutral_loss", axis=1, inplace=True)
+        df = df.drop("neutral_loss", axis=1)
 
-        # drop duplicates
+    # drop duplicates: pick the annotation with the highest fragment_score for each
+    # experimental peak, then the peak with the highest intensity for each fragment ion
+    print("Dropping duplicates...")
+    df = dedupe_annotations(df)
 
-        # pick the annotation fragement ion with the highest fragment_score
-        if "fragment_score" in list(df.columns):
-            print("Sorting by fragment_score...")
-            df.sort_values(by="fragment_score", ascending=False, inplace=True)
+    ##To get from metadata --> send raw file and  scan number  --> get charge
 
-        print("Dropping duplicates...")
-        df.drop_duplicates(
-            subset=["raw_file", "scan_number", "experimental_mass"],
-            keep="first",
-            inplace=True,
-        )
+    # rename comlumns for fundamentals # ToDo
+    if "experimental_mass" in list(df.columns):
+        df = df.rename(columns={"experimental_mass": "exp_mass"})
+    return df
 
-        # select peak with highest intensity
-        print("Sorting by intensity...")
-        df.sort_values(by="intensity", ascending=False, inplace=True)
 
-        print("Dropping duplicates...")
-        df.drop_duplicates(
-            subset=["raw_file", "scan_number", "ion_type", "no", "charge"],
-            keep="first",
-            inplace=True,
+def read_process_annotation_files(
+    annotation_files,
+    parquet_engine="pyarrow",
+    n_jobs=1,
+    columns=ANNOTATION_COLUMNS,
+    criteria=ANNOTATION_FILTERING_CRITERIA,
+):
+    # files are processed independently, results are concatenated in file order
+    a_dfs = list(
+        parallel_map(
+            read_process_annotation_file,
+            [(file, parquet_engine, columns, criteria) for file in annotation_files],
+            n_jobs,
         )
+    )
+    return concat_frames(a_dfs)
 
-        ##To get from metadata --> send raw file and  scan number  --> get charge
 
-        a_dfs.append(df)
-        del df
-        print("Done.")
-        print("-" * 80)
+def raw_file_shards(raw_files, n_shards):
+    """Split raw files into at most `n_shards` contiguous groups with similar row counts."""
+    import numpy as np
+    import pandas as pd
 
-    return pd.concat(a_dfs)
+    counts = pd.Series(raw_files).value_counts().sort_index()
+    bounds = np.searchsorted(
+        counts.cumsum().to_numpy(),
+        np.linspace(0, counts.sum(), n_shards + 1)[1:-1],
+        side="right",
+    )
+    shards = np.split(counts.index.to_numpy(), np.unique(bounds))
+    return [shard for shard in shards if len(shard)]
 
 
 def precursor_int_to_onehot(charge):
@@ -190,65 +558,175 @@ def precursor_int_to_onehot(charge):
     return precursor_charge
 
 
-def build_annotation_df(annotation_df, metadata_df):
+def build_annotation_df(
+    annotation_df,
+    metadata_df,
+    dtype="float32",
+    n_jobs=1,
+    shard_rows=SHARD_ROWS,
+):
     import numpy as np
     import pandas as pd
-    from spectrum_fundamentals.annotation.annotation import generate_annotation_matrix
-    from spectrum_fundamentals.mod_string import internal_without_mods
-
-    print("Grouping annotation by scan number and raw file...")
-    annotation_scans = annotation_df.groupby(["raw_file", "scan_number"])
-
-    print("Grouping metadata by scan number and raw file...")
-    charge_seq = metadata_df.groupby(["raw_file", "scan_number"]).agg(
-        {
-            "precursor_charge": lambda x: np.unique(x)[0],
-            "modified_sequence": lambda x: np.unique(x)[0],
-        }
-    )
+    from pandas.api.types import union_categoricals
+
+    # shards share the raw file categories of the metadata
+    metadata_df = metadata_df.assign(raw_file=as_categorical(metadata_df["raw_file"]))
+
+    n_jobs = resolve_n_jobs(n_jobs)
+    # an empty frame has no raw files to shard
+    if n_jobs == 1 or annotation_df.empty:
+        results = [build_annotation_matrix(annotation_df, metadata_df, dtype=dtype)]
+    else:
+        # partition by raw file, every spectrum is built in exactly one shard
+        n_shards = max(n_jobs, -(-len(annotation_df) // shard_rows))
+        shards = raw_file_shards(annotation_df["raw_file"], n_shards)
+        tasks = (
+            (
+                annotation_df[annotation_df["raw_file"].isin(shard)],
+                metadata_df[metadata_df["raw_file"].isin(shard)],
+                dtype,
+            )
+            for shard in shards
+        )
+        results = list(parallel_map(build_annotation_matrix, tasks, n_jobs))
 
-    # Create annotation matrix
-    intensities_raw = []
-    masses_raw = []
-    scans = []
-    raw_files = []
+    raw_files, scans, intensities, masses = zip(*results)
+    raw_files = union_categoricals(raw_files, sort_categories=True)
+    scans, intensities, masses = [
+        np.concatenate(r) for r in (scans, intensities, masses)
+    ]
 
-    # new column with apply function --> get unmodified sequence
+    annotation_matrix_df = pd.DataFrame()
+    annotation_matrix_df["scan_number"] = scans
+    annotation_matrix_df["raw_file"] = raw_files
+    annotation_matrix_df["intensities_raw"] = list(intensities)
+    annotation_matrix_df["masses_raw"] = list(masses)
+    return annotation_matrix_df
 
-    for scan, spectrum in annotation_scans:
-        # select the two columns from meta data
-        raw_file, scan_number = scan
 
-        try:
-            charge_modseq = charge_seq.loc[raw_file, scan_number]
-            charge, mod_sequence = meta_data[
-                (meta_data["scan_number"] == scan[1])
-                & (meta_data["raw_file"] == scan[0])
-            ][["precursor_charge", "modified_sequence"]].values[0]
+def spectrum_metadata(metadata_df):
+    """Return precursor charge and modified sequence of each spectrum.
 
-        except IndexError:
-            print("IndexError: ", raw_file, scan_number)
-            continue
-        except KeyError:
-            print("KeyError: ", raw_file, scan_number)
-            continue
-        charge = charge_modseq.precursor_charge
-        mod_sequence = charge_modseq.modified_sequence
+    One row per spectrum, sorted by the packed (raw_file, scan_number) `spectrum_key`.
+    """
+    import pandas as pd
 
-        # remove all modifications and return strings
-        unmod_seq = internal_without_mods([mod_sequence])[0]
+    print("Grouping metadata by scan number and raw file...")
+    raw_files = as_categorical(metadata_df["raw_file"])
+    charge_seq = pd.DataFrame(
+        {
+            "spectrum_key": spectrum_keys(
+                raw_files, metadata_df["scan_number"], raw_files.categories
+            ),
+            "raw_file": raw_files,
+            "scan_number": metadata_df["scan_number"].to_numpy(),
+            "precursor_charge": metadata_df["precursor_charge"].to_numpy(),
+            "modified_sequence": as_categorical(metadata_df["modified_sequence"]),
+        }
+    )
+    if charge_seq["spectrum_key"].duplicated().any():
+        # several PSMs for one spectrum, take the smallest charge and sequence
+        charge_seq = charge_seq.sort_values(["spectrum_key", "modified_sequence"])
+        charge_seq = charge_seq.assign(
+            precursor_charge=charge_seq.groupby("spectrum_key")[
+                "precursor_charge"
+            ].transform("min")
+        ).drop_duplicates("spectrum_key")
+    return charge_seq.sort_values("spectrum_key", ignore_index=True)
+
+
+def build_annotation_matrix(
+    annotation_df, metadata_df=None, dtype="float32", charge_seq=None
+):
+    """Build the annotation matrix of all spectra in one vectorised pass.
+
+    Every annotated peak is mapped to its slot `(no - 1) * 6 + 3 * ion + (charge - 1)`
+    (y ions first, then b ions) and all intensities and masses are scattered into one
+    preallocated array of shape (n_spectra, 174). Unavailable fragments (beyond the
+    peptide length or above the precursor charge) are -1, available but unobserved
+    fragments are 0, matching `generate_annotation_matrix` of spectrum_fundamentals.
+
+    Returns raw files (as Categorical), scan numbers, intensities and masses of the
+    spectra sorted by (raw_file, scan_number). Spectra without metadata are skipped.
+    `charge_seq` can be passed instead of `metadata_df` to reuse the output of
+    `spectrum_metadata`.
+    """
+    import numpy as np
+    import pandas as pd
 
-        # keep track of index
-        scans.append(scan_number)
-        raw_files.append(raw_file)
+    if charge_seq is None:
+        charge_seq = spectrum_metadata(metadata_df)
 
-        intensities, mz = generate_annotation_matrix(spectrum, unmod_seq, charge)
-        intensities_raw.append(intensities)
-        masses_raw.append(mz)
+    print("Matching annotations to metadata...")
+    metadata_keys = charge_seq["spectrum_key"].to_numpy()
+    keys = spectrum_keys(
+        annotation_df["raw_file"],
+        annotation_df["scan_number"],
+        charge_seq["raw_file"].cat.categories,
+    )
+    spectrum_idx = np.searchsorted(metadata_keys, keys).clip(
+        0, max(len(metadata_keys) - 1, 0)
+    )
+    found = (keys >= 0) & (len(metadata_keys) > 0)
+    found[found] = metadata_keys[spectrum_idx[found]] == keys[found]
+    if not found.all():
+        missing = annotation_df.loc[~found, KEY_COLUMNS].drop_duplicates()
+        print("Skipping {} spectra without metadata.".format(len(missing)))
+
+    # spectra with at least one annotated peak, in (raw_file, scan_number) order
+    spectra = np.unique(spectrum_idx[found])
+    rows = np.searchsorted(spectra, spectrum_idx[found])
+
+    charges = charge_seq["precursor_charge"].to_numpy()[spectra].astype(np.int64)
+    lengths = unmodified_lengths(charge_seq["modified_sequence"].array.take(spectra))
+
+    # fragment slot of every peak
+    ion_codes, ion_types = pd.factorize(annotation_df["ion_type"].to_numpy()[found])
+    ion_index = (
+        pd.Series(ion_types)
+        .str.split("-", n=1)
+        .str[0]
+        .map({ion: i for i, ion in enumerate(ANNOTATION_ION_TYPES)})
+        .to_numpy()[ion_codes]
+    )
+    no = annotation_df["no"].to_numpy()[found].astype(np.int64)
+    fragment_charge = annotation_df["charge"].to_numpy()[found].astype(np.int64)
+    known_ion = ~pd.isna(ion_index)
+    slots = np.full(len(rows), ANNOTATION_VECTOR_LENGTH, dtype=np.int64)
+    slots[known_ion] = (
+        (no[known_ion] - 1) * N_FRAGMENT_CHARGES * len(ANNOTATION_ION_TYPES)
+        + (fragment_charge[known_ion] - 1)
+        + N_FRAGMENT_CHARGES * ion_index[known_ion].astype(np.int64)
+    )
+    valid = slots < ANNOTATION_VECTOR_LENGTH
+
+    # -1 everywhere, 0 for fragments possible given peptide length and precursor charge
+    columns = np.arange(ANNOTATION_VECTOR_LENGTH)
+    slots_per_position = N_FRAGMENT_CHARGES * len(ANNOTATION_ION_TYPES)
+    n_available = (np.minimum(lengths, ANNOTATION_SEQ_LEN) - 1) * slots_per_position
+    available = (columns[None, :] < n_available[:, None]) & (
+        columns[None, :] % N_FRAGMENT_CHARGES < charges[:, None]
+    )
+    intensities = np.where(available, 0, -1).astype(dtype)
+    masses = intensities.copy()
+
+    # scatter peaks, the last peak in a slot wins as in the per-scan loop
+    flat = rows[valid] * ANNOTATION_VECTOR_LENGTH + slots[valid]
+    order = np.arange(len(flat))[::-1]
+    flat, first = np.unique(flat[order], return_index=True)
+    peaks = np.flatnonzero(found)[valid][order[first]]
+    intensities.ravel()[flat] = annotation_df["intensity"].to_numpy()[peaks]
+    masses.ravel()[flat] = annotation_df["exp_mass"].to_numpy()[peaks]
+
+    # fragments of the last position of short peptides are not available
+    masked = (
+        (lengths[:, None] < ANNOTATION_SEQ_LEN)
+        & (columns[None, :] >= (lengths[:, None] - 1) * slots_per_position)
+        & (columns[None, :] < lengths[:, None] * slots_per_position)
+    )
+    intensities[masked] = -1
+    masses[masked] = -1
 
-    annotation_matrix_df = pd.DataFrame()
-    annotation_matrix_df["scan_number"] = scans
-    annotation_matrix_df["raw_file"] = raw_files
-    annotation_matrix_df["intensities_raw"] = intensities_raw
-    annotation_matrix_df["masses_raw"] = masses_raw
-    return annotation_matrix_df
+    raw_files = charge_seq["raw_file"].array.take(spectra)
+    scans = charge_seq["scan_number"].to_numpy()[spectra]
+    return raw_files, scans, intensities, masses
@@ -0,0 +1,231 @@
+import csv
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+# columns of the report, one row per stage
+STAGE_FIELDS = [
+    "stage",
+    "calls",
+    "wall_time",
+    "cpu_time",
+    "rows_in",
+    "rows_out",
+    "bytes_read",
+    "bytes_written",
+    "peak_rss",
+]
+SUMMED_FIELDS = ["wall_time", "cpu_time", "rows_in", "rows_out"]
+IO_FIELDS = {"bytes_read": "rchar", "bytes_written": "wchar"}
+
+
+def io_counters():
+    # bytes read and written by this process through system calls (Linux only)
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":") for line in f)
+    except OSError:
+        return {}
+    return {name: int(value) for name, value in counters.items()}
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of this process (Linux only), so that `peak_rss`
+    returns the peak since the reset. Returns False where it cannot be reset."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, None where unknown.
+
+    This is the peak since the last `reset_peak_rss` on Linux and the peak over the
+    lifetime of the process elsewhere.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def cpu_time():
+    # user and system time of this process and of its finished child processes
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def add(total, value):
+    if value is None:
+        return total
+    return value if total is None else total + value
+
+
+class PipelineProfile:
+    """Wall time, CPU time, rows, bytes and peak memory of the stages of a pipeline.
+
+    Every `stage` block is measured and added to the totals of its name, so a stage run
+    once per chunk is reported as one row with the number of calls:
+
+        profile = PipelineProfile(callback=lambda record: send(record))
+        with profile.stage("read_metadata") as stage:
+            df = read_metadata(path)
+            stage["rows_out"] = len(df)
+        print(profile.summary())
+        profile.save("profile.json")
+
+    The rows and bytes can be set on the yielded record; bytes not set are the bytes
+    read and written by the process during the stage (from /proc/self/io, not available
+    on all platforms). CPU time includes child processes once they have finished. Peak
+    RSS is the peak of the process during the stage on Linux (the peak is reset when a
+    stage starts, a stage run inside another one counts towards both) and the peak of
+    the process so far elsewhere. `callback` is called with the record of every finished
+    stage call.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stages = {}
+        # peaks of the inner stages of the running stages
+        self.peaks = []
+
+    def stage(self, name, rows_in=None):
+        return self.measure(name, rows_in, add=True)
+
+    @contextmanager
+    def measure(self, name, rows_in=None, add=False):
+        # measure a stage call, added to the report with `add=True`
+        record = {
+            "stage": name,
+            "rows_in": rows_in,
+            "rows_out": None,
+            "bytes_read": None,
+            "bytes_written": None,
+        }
+        io_start = io_counters()
+        cpu_start = cpu_time()
+        if self.peaks:
+            # keep the peak of the enclosing stage so far before resetting it
+            self.peaks[-1] = max(self.peaks[-1] or 0, peak_rss() or 0)
+        self.peaks.append(None)
+        reset_peak_rss()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_time"] = time.perf_counter() - start
+            record["cpu_time"] = cpu_time() - cpu_start
+            io_end = io_counters()
+            for field, counter in IO_FIELDS.items():
+                if record[field] is None and counter in io_end:
+                    record[field] = io_end[counter] - io_start[counter]
+            peaks = [peak_rss(), self.peaks.pop()]
+            peaks = [peak for peak in peaks if peak is not None]
+            record["peak_rss"] = max(peaks) if peaks else None
+            if self.peaks and peaks:
+                self.peaks[-1] = max(self.peaks[-1] or 0, record["peak_rss"])
+            if add:
+                self.add(record)
+
+    def report_to(self, path=None):
+        """Print the summary and save the report to `path` if given."""
+        print("-" * 80)
+        print(self.summary())
+        if path:
+            self.save(path)
+
+    def iterate(self, name, items):
+        """Yield the items of an iterable, each step measured as a call of stage `name`
+        with the length of the item as its output rows."""
+        items = iter(items)
+        end = object()
+        while True:
+            with self.measure(name) as record:
+                item = next(items, end)
+                if item is not end:
+                    record["rows_out"] = len(item)
+            # the call that finds the items exhausted is not counted
+            if item is end:
+                return
+            self.add(record)
+            yield item
+
+    def add(self, record):
+        if record["stage"] not in self.stages:
+            self.stages[record["stage"]] = dict.fromkeys(STAGE_FIELDS)
+            self.stages[record["stage"]]["stage"] = record["stage"]
+        total = self.stages[record["stage"]]
+        total["calls"] = add(total["calls"], 1)
+        for field in SUMMED_FIELDS + list(IO_FIELDS):
+            total[field] = add(total[field], record[field])
+        if record["peak_rss"] is not None:
+            total["peak_rss"] = max(total["peak_rss"] or 0, record["peak_rss"])
+        if self.callback is not None:
+            self.callback(dict(record))
+
+    def report(self):
+        """One dict per stage in the order the stages were first run."""
+        return [dict(total) for total in self.stages.values()]
+
+    def summary(self):
+        lines = [
+            "{:<18} {:>6} {:>10} {:>10} {:>12} {:>12} {:>10} {:>10} {:>10}".format(
+                "stage",
+                "calls",
+                "wall [s]",
+                "cpu [s]",
+                "rows in",
+                "rows out",
+                "read [MB]",
+                "write [MB]",
+                "rss [MB]",
+            )
+        ]
+        for total in self.report():
+            lines.append(
+                "{:<18} {:>6} {:>10.2f} {:>10.2f} {:>12} {:>12} {:>10} {:>10} {:>10}".format(
+                    total["stage"],
+                    total["calls"],
+                    total["wall_time"],
+                    total["cpu_time"],
+                    "-" if total["rows_in"] is None else total["rows_in"],
+                    "-" if total["rows_out"] is None else total["rows_out"],
+                    *[
+                        "-"
+                        if total[f] is None
+                        else "{:.1f}".format(total[f] / 1024**2)
+                        for f in ["bytes_read", "bytes_written", "peak_rss"]
+                    ],
+                )
+            )
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.summary()
+
+    def save(self, path):
+        """Write the report as CSV (for a `.csv` path) or JSON."""
+        if path.endswith(".csv"):
+            with open(path, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=STAGE_FIELDS)
+                writer.writeheader()
+                writer.writerows(self.report())
+        else:
+            with open(path, "w") as f:
+                json.dump(self.report(), f, indent=1)
+        return path
@@ -0,0 +1,227 @@
+import ast
+import re
+import time
+import warnings
+
+from .keys import DICTIONARY_COLUMNS
+
+# columns needed from the annotation files to build the annotation matrix
+ANNOTATION_COLUMNS = [
+    "raw_file",
+    "scan_number",
+    "ion_type",
+    "no",
+    "charge",
+    "experimental_mass",
+    "intensity",
+    "fragment_score",
+]
+
+# same format as metadata_filtering_criteria
+ANNOTATION_FILTERING_CRITERIA = {
+    "neutral_loss": '== ""',
+    "ion_type": '!= "precursor"',
+}
+
+
+def annotation_criteria(criteria=None):
+    """`criteria` on top of the neutral loss and precursor filter, which the annotation
+    matrix relies on and is always applied. Other conditions on its columns raise."""
+    merged = dict(ANNOTATION_FILTERING_CRITERIA)
+    for column_name, condition in (criteria or {}).items():
+        column_name = column_name.strip()
+        mandatory = ANNOTATION_FILTERING_CRITERIA.get(column_name)
+        if mandatory is not None and parse_condition(condition) != parse_condition(
+            mandatory
+        ):
+            raise ValueError(
+                "The annotation filter on {} is always {}, got {}.".format(
+                    column_name, mandatory, condition
+                )
+            )
+        merged[column_name] = condition
+    return merged
+
+
+CONDITION_REGEX = re.compile(r"^\s*(==|!=|>=|<=|>|<|in|not in)\s*(.+?)\s*$")
+
+
+def parse_condition(condition):
+    """Split a condition like ">= 70" into its operator and Python literal value."""
+    match = CONDITION_REGEX.match(condition)
+    if match is None:
+        raise ValueError("Cannot parse filtering condition: {}".format(condition))
+    operator, value = match.groups()
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        # unquoted strings
+        value = value.strip("'\"")
+    return operator, value
+
+
+def criteria_to_expression(criteria, available_columns=None):
+    """Combine filtering criteria ({column: condition}) into one pyarrow expression.
+
+    Criteria on columns not in `available_columns` are skipped with a warning.
+    """
+    import pyarrow.dataset as ds
+
+    expression = None
+    for column_name, condition in (criteria or {}).items():
+        column_name = column_name.strip()
+        if available_columns is not None and column_name not in available_columns:
+            warnings.warn(
+                RuntimeWarning(
+                    f"Skipping attribute {column_name} since it is not in columns {list(available_columns)}."
+                )
+            )
+            continue
+
+        operator, value = parse_condition(condition)
+        field = ds.field(column_name)
+        if operator == "==":
+            condition_expression = field == value
+        elif operator == "!=":
+            condition_expression = field != value
+        elif operator == ">=":
+            condition_expression = field >= value
+        elif operator == "<=":
+            condition_expression = field <= value
+        elif operator == ">":
+            condition_expression = field > value
+        elif operator == "<":
+            condition_expression = field < value
+        elif operator == "in":
+            condition_expression = field.isin(list(value))
+        else:
+            condition_expression = ~field.isin(list(value))
+
+        expression = (
+            condition_expression
+            if expression is None
+            else expression & condition_expression
+        )
+    return expression
+
+
+def log_throughput(name, table, seconds):
+    size_mb = table.nbytes / 1024**2
+    print(
+        "Read {} rows, {} columns ({:.1f} MB) from {} in {:.2f} s ({:.1f} MB/s)".format(
+            table.num_rows,
+            table.num_columns,
+            size_mb,
+            name,
+            seconds,
+            size_mb / max(seconds, 1e-9),
+        )
+    )
+
+
+def parquet_format(dictionary_columns=DICTIONARY_COLUMNS):
+    # string columns in `dictionary_columns` are decoded as dictionary arrays
+    import pyarrow.dataset as ds
+
+    return ds.ParquetFileFormat(
+        read_options=ds.ParquetReadOptions(
+            dictionary_columns=list(dictionary_columns or [])
+        )
+    )
+
+
+def parquet_dataset(path, dictionary_columns=DICTIONARY_COLUMNS):
+    import pyarrow.dataset as ds
+
+    return ds.dataset(path, format=parquet_format(dictionary_columns))
+
+
+def read_parquet(
+    path,
+    columns=None,
+    criteria=None,
+    exclude_columns=(),
+    dictionary_columns=DICTIONARY_COLUMNS,
+):
+    """Read parquet file(s) as a pyarrow Table, decoding only the needed data.
+
+    Only `columns` (default: all but `exclude_columns`) are read and `criteria` are pushed
+    down into the scan, so row groups excluded by their statistics are skipped and
+    filtered rows are never materialised. String columns in `dictionary_columns` are read
+    dictionary encoded and become categoricals in pandas.
+    """
+    start = time.perf_counter()
+    dataset = parquet_dataset(path, dictionary_columns)
+    available_columns = dataset.schema.names
+    if columns is None:
+        columns = [c for c in available_columns if c not in exclude_columns]
+    else:
+        columns = [c for c in columns if c in available_columns]
+
+    table = dataset.to_table(
+        columns=columns,
+        filter=criteria_to_expression(criteria, available_columns),
+    )
+    log_throughput(path, table, time.perf_counter() - start)
+    return table
+
+
+def iter_parquet_batches(
+    path,
+    batch_size,
+    columns=None,
+    criteria=None,
+    dictionary_columns=DICTIONARY_COLUMNS,
+):
+    """Yield record batches of a parquet file with projection and filter pushdown."""
+    dataset = parquet_dataset(path, dictionary_columns)
+    available_columns = dataset.schema.names
+    if columns is not None:
+        columns = [c for c in columns if c in available_columns]
+
+    start = time.perf_counter()
+    rows, size = 0, 0
+    for batch in dataset.to_batches(
+        columns=columns,
+        filter=criteria_to_expression(criteria, available_columns),
+        batch_size=batch_size,
+    ):
+        rows += batch.num_rows
+        size += batch.nbytes
+        yield batch
+    seconds = time.perf_counter() - start
+    print(
+        "Streamed {} rows ({:.1f} MB) from {} in {:.2f} s".format(
+            rows, size / 1024**2, path, seconds
+        )
+    )
+
+
+def column_range(path, column):
+    """Minimum and maximum of a numeric column of a parquet file.
+
+    Uses the row group statistics of the file footer when every row group has them, and
+    reads the column otherwise.
+    """
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.metadata
+    index = parquet_file.schema_arrow.get_field_index(column)
+    if index < 0:
+        raise KeyError("Column {} is not in {}".format(column, path))
+
+    minimum, maximum = None, None
+    for row_group in range(metadata.num_row_groups):
+        statistics = metadata.row_group(row_group).column(index).statistics
+        if statistics is None or not statistics.has_min_max:
+            break
+        minimum = statistics.min if minimum is None else min(minimum, statistics.min)
+        maximum = statistics.max if maximum is None else max(maximum, statistics.max)
+    else:
+        if minimum is not None:
+            return minimum, maximum
+
+    min_max = pc.min_max(parquet_file.read(columns=[column]).column(0))
+    return min_max["min"].as_py(), min_max["max"].as_py()
@@ -1,47 +1,275 @@
 import argparse
+import os
 import sys
+import time
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ..dedupe import keep_first
+from ..keys import as_categorical
+from ..readers import iter_parquet_batches
+
+BATCH_SIZE = 1_000_000
+SEQUENCE_COLUMN = "modified_sequence"
+RAW_FILE_COLUMN = "raw_file"
+SCORE_COLUMN = "andromeda_score"
+IRT_COLUMN = "indexed_retention_time"
+
+STATISTICS = ["var", "std", "mad"]
+CENTERS = ["mean", "median", "trimmed_mean"]
 
 parser = argparse.ArgumentParser()
-parser.add_argument("-f", "--file_path", help="Path to the file")
+parser.add_argument("-f", "--file_path", nargs="+", help="Path to the file(s)")
 parser.add_argument(
     "-thr",
     "--threshold",
     help="Threshold for filtering the var irt values",
-    default=2000,
+    default=2,
+    type=float,
+)
+parser.add_argument(
+    "--statistic",
+    default="var",
+    choices=STATISTICS,
+    help="Dispersion of the iRT values of a peptide compared to the threshold",
+)
+parser.add_argument(
+    "--center",
+    default="mean",
+    choices=CENTERS,
+    help="Additional iRT center to report per peptide (mean is always reported)",
+)
+parser.add_argument(
+    "--trim",
+    default=0.1,
+    type=float,
+    help="Fraction cut from each end for the trimmed mean",
+)
+parser.add_argument(
+    "-o",
+    "--output",
+    default="meta_data_median_irt.parquet",
+    help="Path of the filtered output file",
 )
 
 
-def main(sys_args=sys.argv[1:]):
-    args = parser.parse_args(sys_args)
+class MomentAccumulator:
+    """Mergeable per-group count, mean and sum of squared deviations.
 
-    meta_data = pd.read_parquet(args.file_path, engine="fastparquet")
+    Batches are reduced with a two-pass variance and merged into the running moments with
+    Chan's parallel update of Welford's algorithm, so the result does not depend on how
+    the data is split into batches or files.
+    """
 
-    # Group by raw file and seq -> seect only seq with max andromeda score
-    max_score_df = (
-        meta_data.sort_values(["andromeda_score"], ascending=False)
-        .groupby(["modified_sequence", "raw_file"])
-        .first()
-        .reset_index()
-    )
+    def __init__(self):
+        self.count = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros(0, dtype=np.float64)
+        self.m2 = np.zeros(0, dtype=np.float64)
+
+    def grow(self, n_groups):
+        if n_groups > len(self.count):
+            extra = n_groups - len(self.count)
+            self.count = np.append(self.count, np.zeros(extra, dtype=np.int64))
+            self.mean = np.append(self.mean, np.zeros(extra))
+            self.m2 = np.append(self.m2, np.zeros(extra))
+
+    def update(self, groups, values):
+        n_groups = int(groups.max()) + 1 if len(groups) else 0
+        count = np.bincount(groups, minlength=n_groups)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.bincount(groups, values, minlength=n_groups) / count
+        m2 = np.bincount(groups, (values - mean[groups]) ** 2, minlength=n_groups)
+        self.merge(count, np.nan_to_num(mean), m2)
+
+    def merge(self, count, mean, m2):
+        self.grow(len(count))
+        n = len(count)
+        count_a, mean_a, m2_a = self.count[:n], self.mean[:n], self.m2[:n]
+        total = count_a + count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = mean - mean_a
+            weight = np.where(total > 0, count / np.maximum(total, 1), 0)
+            self.mean[:n] = mean_a + delta * weight
+            self.m2[:n] = m2_a + m2 + delta**2 * count_a * weight
+        self.count[:n] = total
+
+    def result(self):
+        # sample variance (ddof=1) as in pandas, NaN for single values
+        with np.errstate(invalid="ignore", divide="ignore"):
+            var = np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+        return pd.DataFrame(
+            {"mean": self.mean, "var": var, "size": self.count, "std": np.sqrt(var)}
+        )
+
+
+def group_medians(groups, values, n_groups):
+    # median of the values of each group, values sorted within groups
+    order = np.lexsort((values, groups))
+    values = values[order]
+    count = np.bincount(groups, minlength=n_groups)
+    start = np.cumsum(count) - count
+    with np.errstate(invalid="ignore"):
+        low = values[np.minimum(start + (count - 1) // 2, len(values) - 1)]
+        high = values[np.minimum(start + count // 2, len(values) - 1)]
+    return np.where(count > 0, (low + high) / 2, np.nan)
+
+
+def robust_statistics(groups, values, n_groups, trim=0.1):
+    """Median, median absolute deviation and trimmed mean of each group."""
+    median = group_medians(groups, values, n_groups)
+    mad = group_medians(groups, np.abs(values - median[groups]), n_groups)
 
-    # Group by seq -> calculate mean, var for irt
-    md = (
-        max_score_df[["modified_sequence", "indexed_retention_time"]]
-        .groupby("modified_sequence")
-        .agg([np.mean, np.var, np.size, np.std])
-        .reset_index()
+    order = np.lexsort((values, groups))
+    cumulative = np.append(0, np.cumsum(values[order]))
+    count = np.bincount(groups, minlength=n_groups)
+    start = np.cumsum(count) - count
+    cut = np.floor(trim * count).astype(np.int64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        trimmed_mean = (cumulative[start + count - cut] - cumulative[start + cut]) / (
+            count - 2 * cut
+        )
+    return pd.DataFrame({"median": median, "mad": mad, "trimmed_mean": trimmed_mean})
+
+
+def encode(values, ids):
+    # global integer ids of the values of a (categorical) column, new values are added
+    values = as_categorical(values)
+    mapping = np.array(
+        [ids.setdefault(v, len(ids)) for v in values.categories] + [-1], dtype=np.int64
     )
-    md.columns = md.columns.droplevel(0)
-    md.columns = ["modified_sequence", "mean", "var", "size", "std"]
+    return mapping[values.codes]
+
+
+class BestRows:
+    """Running best scored row per (modified_sequence, raw_file) over batches of files.
+
+    Every batch is merged into the table of the best rows so far, so memory grows with
+    the number of (peptide, raw file) pairs and not with the number of rows. Rows read
+    earlier win ties, like a stable sort over all files.
+    """
+
+    FIELDS = ["file", "row", "peptide", "raw_file", "score", "irt"]
+
+    def __init__(self):
+        self.table = None
+
+    def update(self, file_id, rows, peptides, raw_files, scores, irts):
+        batch = [np.full(len(rows), file_id), rows, peptides, raw_files, scores, irts]
+        if self.table is not None:
+            batch = [np.concatenate(arrays) for arrays in zip(self.table, batch)]
+        # highest score first, the earlier row wins ties
+        best = keep_first([batch[2], batch[3]], [-batch[4]])
+        self.table = [values[best] for values in batch]
+
+    def result(self):
+        """The best rows as a dict of arrays, in file and row order."""
+        if self.table is None:
+            return {f: np.zeros(0, dtype=np.int64) for f in self.FIELDS}
+        order = np.lexsort((self.table[1], self.table[0]))
+        return {f: values[order] for f, values in zip(self.FIELDS, self.table)}
+
+
+def read_best_rows(path, file_id, best, sequence_ids, raw_file_ids):
+    """Merge the rows of a file into `best` batch by batch, reading only the needed
+    columns."""
+    columns = [SEQUENCE_COLUMN, RAW_FILE_COLUMN, SCORE_COLUMN, IRT_COLUMN]
+    offset = 0
+    for batch in iter_parquet_batches(path, BATCH_SIZE, columns):
+        df = batch.to_pandas()
+        best.update(
+            file_id,
+            np.arange(offset, offset + len(df)),
+            encode(df[SEQUENCE_COLUMN], sequence_ids),
+            encode(df[RAW_FILE_COLUMN], raw_file_ids),
+            df[SCORE_COLUMN].to_numpy(np.float64),
+            df[IRT_COLUMN].to_numpy(np.float64),
+        )
+        offset += len(df)
 
-    # Filter metadata based on the var
-    df_out = max_score_df.merge(
-        md[md["var"] < 2], on="modified_sequence", suffixes=("_l", "_r")
+
+def peptide_statistics(files, center="mean", statistic="var", trim=0.1):
+    """Per-peptide iRT statistics of the best scored PSM per raw file, in one pass.
+
+    The best row per peptide and raw file is kept while the files are read batch by
+    batch, so raw files spread over several files are handled like one run (ties go to
+    the first row). Returns the statistics (indexed by peptide id), the peptide names,
+    and the selected row positions of each file.
+    """
+    sequence_ids, raw_file_ids = {}, {}
+    best = BestRows()
+    for file_id, path in enumerate(files):
+        print("Reading file: ", path)
+        read_best_rows(path, file_id, best, sequence_ids, raw_file_ids)
+    best = best.result()
+    selected = [best["row"][best["file"] == file_id] for file_id in range(len(files))]
+
+    # moments of the selected iRT values, merged batch by batch
+    moments = MomentAccumulator()
+    for start in range(0, len(best["row"]), BATCH_SIZE):
+        moments.update(
+            best["peptide"][start : start + BATCH_SIZE],
+            best["irt"][start : start + BATCH_SIZE],
+        )
+    moments.grow(len(sequence_ids))
+    stats = moments.result()
+    if center != "mean" or statistic == "mad":
+        stats = stats.join(
+            robust_statistics(best["peptide"], best["irt"], len(stats), trim)
+        )
+    return stats, list(sequence_ids), selected
+
+
+def write_filtered(files, selected, stats, peptides, keep, output):
+    """Stream the selected rows of the kept peptides with their statistics to `output`."""
+    stats = stats.assign(**{SEQUENCE_COLUMN: peptides})[keep]
+    writer, n_rows = None, 0
+    try:
+        for path, rows in zip(files, selected):
+            offset = 0
+            for batch in iter_parquet_batches(path, BATCH_SIZE):
+                # selected rows of this batch
+                start, stop = np.searchsorted(rows, [offset, offset + batch.num_rows])
+                offset += batch.num_rows
+                if start == stop:
+                    continue
+                df = (
+                    pa.Table.from_batches([batch])
+                    .take(pa.array(rows[start:stop] - (offset - batch.num_rows)))
+                    .to_pandas()
+                )
+                df[SEQUENCE_COLUMN] = df[SEQUENCE_COLUMN].astype(str)
+                df = df.merge(stats, on=SEQUENCE_COLUMN, how="inner")
+                if df.empty:
+                    continue
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(output, table.schema, compression="gzip")
+                writer.write_table(table.cast(writer.schema))
+                n_rows += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+    print("Wrote", n_rows, "rows to", output)
+    return output
+
+
+def main(sys_args=sys.argv[1:]):
+    start = time.time()
+    args = parser.parse_args(sys_args)
+
+    # Best PSM per raw file and seq -> iRT statistics per seq
+    stats, peptides, selected = peptide_statistics(
+        args.file_path, args.center, args.statistic, args.trim
     )
-    print(df_out)
-    print(df_out["andromeda_score"])
+    print(stats.describe())
+
+    # Filter metadata based on the dispersion of the iRT values
+    keep = (stats[args.statistic] < args.threshold).to_numpy()
+    print("Keeping", int(keep.sum()), "of", len(keep), "peptides")
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    write_filtered(args.file_path, selected, stats, peptides, keep, args.output)
 
-    meta_data.to_parquet("meta_data_median_irt.parquet", compression="gzip")
+    print("Time:", time.time() - start)
@@ -1,43 +1,200 @@
 import argparse
+import os
 import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-import pandas as pd
 import pyarrow as pa
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 
+from ..manifest import parse_file_name
+
+ROW_GROUP_SIZE = 1_000_000
+COMPRESSIONS = ["zstd", "lz4", "snappy", "gzip", "none"]
+PARTITIONS = ["none", "pool", "raw_file"]
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "-d",
     "--dir_path",
     help="Path to the directory with the metadata and annotation files",
 )
+parser.add_argument(
+    "-o",
+    "--output-dir",
+    help="Directory of the merged files (default: the input directory)",
+)
+parser.add_argument(
+    "-c",
+    "--compression",
+    default="zstd",
+    choices=COMPRESSIONS,
+    help="Parquet compression codec",
+)
+parser.add_argument(
+    "--row-group-size",
+    default=ROW_GROUP_SIZE,
+    type=int,
+    help="Number of rows per row group of the merged files",
+)
+parser.add_argument(
+    "--partition-by",
+    default="none",
+    choices=PARTITIONS,
+    help="Write a dataset partitioned by pool or raw file instead of one file",
+)
+parser.add_argument(
+    "-w", "--workers", default=4, type=int, help="Number of files read concurrently"
+)
+
+
+def unified_schema(files):
+    """Union of the schemas of all files, with types promoted where they differ."""
+    schemas = [pq.read_schema(f).remove_metadata() for f in files]
+    return pa.unify_schemas(schemas, promote_options="permissive")
+
+
+def conform_table(table, schema):
+    # cast to `schema`, missing columns are filled with nulls
+    columns = [
+        (
+            table.column(field.name).cast(field.type)
+            if field.name in table.column_names
+            else pa.nulls(table.num_rows, field.type)
+        )
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def read_row_group(path, row_group, schema, pool=None):
+    table = conform_table(pq.ParquetFile(path).read_row_group(row_group), schema)
+    if pool is not None:
+        table = table.append_column(
+            "pool", pa.array([pool] * table.num_rows, pa.string())
+        )
+    return table
+
+
+def iter_row_groups(files, schema, workers=4, add_pool=False):
+    """Yield the row groups of all files in order, read by `workers` threads.
+
+    At most 2 * workers row groups are read ahead.
+    """
+    tasks = [
+        (
+            path,
+            row_group,
+            schema,
+            parse_file_name(os.path.basename(path))[1] or Path(path).stem
+            if add_pool
+            else None,
+        )
+        for path in files
+        for row_group in range(pq.ParquetFile(path).num_row_groups)
+    ]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for task in tasks:
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(read_row_group, *task))
+        while pending:
+            yield pending.popleft().result()
+
+
+def coalesce(tables, row_group_size):
+    """Re-chunk a stream of tables into tables of `row_group_size` rows (the last smaller)."""
+    buffer, buffered = [], 0
+    for table in tables:
+        buffer.append(table)
+        buffered += table.num_rows
+        while buffered >= row_group_size:
+            merged = pa.concat_tables(buffer)
+            yield merged.slice(0, row_group_size)
+            buffer = [merged.slice(row_group_size)]
+            buffered -= row_group_size
+    if buffered:
+        yield pa.concat_tables(buffer)
+
+
+def merge_files(
+    files,
+    output_path,
+    compression="zstd",
+    row_group_size=ROW_GROUP_SIZE,
+    partition_by="none",
+    workers=4,
+):
+    """Merge parquet files into one file, or a partitioned dataset directory."""
+    compression = None if compression == "none" else compression
+    schema = unified_schema(files)
+    tables = iter_row_groups(files, schema, workers, add_pool=partition_by == "pool")
+    rows = 0
+
+    if partition_by == "none":
+        with pq.ParquetWriter(output_path, schema, compression=compression) as writer:
+            for table in coalesce(tables, row_group_size):
+                writer.write_table(table, row_group_size=row_group_size)
+                rows += table.num_rows
+    else:
+        if partition_by == "pool":
+            schema = schema.append(pa.field("pool", pa.string()))
+
+        def batches():
+            nonlocal rows
+            for table in tables:
+                rows += table.num_rows
+                yield from table.to_batches()
+
+        ds.write_dataset(
+            batches(),
+            output_path,
+            schema=schema,
+            format="parquet",
+            partitioning=[partition_by],
+            partitioning_flavor="hive",
+            file_options=ds.ParquetFileFormat().make_write_options(
+                compression=compression
+            ),
+            min_rows_per_group=min(row_group_size, 1 << 20),
+            max_rows_per_group=row_group_size,
+            existing_data_behavior="overwrite_or_ignore",
+        )
+
+    print("Merged", rows, "rows of", len(files), "files into", output_path)
+    return output_path
 
 
 def main(sys_args=sys.argv[1:]):
+    start = time.time()
     args = parser.parse_args(sys_args)
+    output_dir = args.output_dir or args.dir_path
+    os.makedirs(output_dir, exist_ok=True)
+    # a file, or a directory with the partitioned dataset
+    suffix = ".parquet" if args.partition_by == "none" else ""
+
+    for name, pattern in [
+        ("meta_data", "*meta_data.parquet"),
+        ("annotation", "*annotation.parquet"),
+    ]:
+        files = sorted(str(p) for p in Path(args.dir_path).glob(pattern))
+        if not files:
+            print("No", name, "files found in", args.dir_path)
+            continue
+        print("Merging the", name, "files:")
+        for f in files:
+            print(f)
+        merge_files(
+            files,
+            os.path.join(output_dir, "{}_merged{}".format(name, suffix)),
+            compression=args.compression,
+            row_group_size=args.row_group_size,
+            partition_by=args.partition_by,
+            workers=args.workers,
+        )
 
-    # Merge meta_data files
-    print("Merging the meta data files:")
-    for i, parquet_path in enumerate(Path(args.dir_path).glob("*meta_data.parquet")):
-        print(parquet_path)
-        meta_data = pd.read_parquet(parquet_path, engine="pyarrow")
-        meta_data = pa.Table.from_pandas(meta_data)
-        if i == 0:
-            # Create a parquet writer object
-            pqwriter = pq.ParquetWriter(
-                "meta_data_merged.parquet", meta_data.schema, compression="GZIP"
-            )
-        pqwriter.write_table(meta_data)
-
-    # Merge annotation files
-    print("Merging the annotation files:")
-    for i, parquet_path in enumerate(Path(args.dir_path).glob("*annotation.parquet")):
-        print(parquet_path)
-        annotation = pd.read_parquet(parquet_path, engine="pyarrow")
-        annotation = pa.Table.from_pandas(annotation)
-        if i == 0:
-            pqwriter = pq.ParquetWriter(
-                "annotation_merged.parquet", annotation.schema, compression="GZIP"
-            )
-        pqwriter.write_table(annotation)
+    print("Time:", time.time() - start)
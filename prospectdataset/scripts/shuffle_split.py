@@ -1,20 +1,33 @@
 import argparse
-import collections
-import random
+import os
 import sys
 import time
 
-import numpy
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ..keys import as_categorical, spectrum_keys
+from ..readers import iter_parquet_batches
+from ..tokenizer import unmodified, unmodified_lengths
+
+BATCH_SIZE = 1_000_000
+HASH_SPAN = 2.0**64
 
 parser = argparse.ArgumentParser()
-parser.add_argument("-s", "--seed", default=42, help="A seed for RNG")
+parser.add_argument("-s", "--seed", default=42, type=int, help="A seed for hashing")
 parser.add_argument(
     "-t",
     "--trainingsplit",
     default=0.9,
+    type=float,
     help="The fraction to use for training data (e.g. 0.9 would mean that the train-test split is 90-10 percent).",
 )
+parser.add_argument(
+    "--splits",
+    help="N-way split as name=fraction pairs, e.g. train=0.8,val=0.1,test=0.1 (overrides --trainingsplit).",
+)
 
 parser.add_argument(
     "-f",
@@ -23,93 +36,262 @@ parser.add_argument(
     action="store_true",
 )
 
-parser.add_argument("-m", "--metadata", help="Path to the metadata file")
-parser.add_argument("-a", "--annotation", help="Path to the annotation file")
+parser.add_argument("-m", "--metadata", nargs="+", help="Path to the metadata file(s)")
+parser.add_argument(
+    "-a", "--annotation", nargs="*", default=[], help="Path to the annotation file(s)"
+)
+parser.add_argument(
+    "-thr", "--threshold", help="Threshold for Andromeda score", default=70, type=float
+)
+parser.add_argument(
+    "--score-column", default="andromeda_score", help="Column of the Andromeda score"
+)
+parser.add_argument(
+    "--group-by",
+    default="modified",
+    choices=["modified", "unmodified"],
+    help="Keep all spectra of a modified (or unmodified) sequence in the same split.",
+)
 parser.add_argument(
-    "-thr", "--threshold", help="Threshold for Andromeda score", default=70
+    "--stratify",
+    default="none",
+    choices=["none", "charge", "length"],
+    help="Split the peptides of each precursor charge (smallest per peptide) or peptide length in the same proportions.",
+)
+parser.add_argument(
+    "-o", "--output-dir", default=".", help="Directory of the output files"
+)
+parser.add_argument(
+    "--compression", default="gzip", help="Parquet compression of the output files"
 )
 
 
-def argshuffle_splits(idx, traininsplit):
-    train_idx = list(numpy.random.permutation(idx[:traininsplit]))
-    test_idx = list(numpy.random.permutation(idx[traininsplit:]))
-    return train_idx, test_idx
+def parse_splits(splits=None, training_split=0.9):
+    """Return split names and fractions from "train=0.8,val=0.1,test=0.1"."""
+    if not splits:
+        return ["train", "test"], [training_split, 1 - training_split]
+    names, fractions = [], []
+    for split in splits.split(","):
+        name, fraction = split.split("=")
+        names.append(name.strip())
+        fractions.append(float(fraction))
+    if not np.isclose(sum(fractions), 1) or min(fractions) < 0:
+        raise ValueError("Split fractions must be non-negative and sum up to 1.")
+    return names, fractions
 
 
-def peptide_argsort(sequence_integer, seed=42):
-    random.seed(seed)
-    peptide_groups = collections.defaultdict(list)
-    for index, row in enumerate(sequence_integer):
-        peptide_groups[tuple(row)].append(index)
+def peptide_of(sequences, group_by="modified"):
+    # Categorical of the peptides the spectra are grouped by
+    sequences = as_categorical(sequences).remove_unused_categories()
+    if group_by == "unmodified":
+        sequences = as_categorical(unmodified(sequences))
+    return sequences
 
-    # shuffle within peptides
-    for indeces in peptide_groups.values():
-        random.shuffle(indeces)
 
-    # shuffle peptides
-    peptides = list(peptide_groups.keys())
-    random.shuffle(peptides)
+def peptide_hashes(peptides, seed):
+    """Deterministic 64 bit hash of each peptide, the same on every run and machine."""
+    return pd.util.hash_array(
+        np.asarray(peptides, dtype=object), hash_key="{:016d}".format(seed)[-16:]
+    )
 
-    # join indeces
-    indeces = []
-    for peptide in peptides:
-        indeces.extend(peptide_groups[peptide])
-    return indeces
 
+def hash_splits(hashes, fractions):
+    # split of each hash, the hashes are uniform in [0, 2**64)
+    bounds = np.cumsum(fractions)[:-1] * HASH_SPAN
+    return np.searchsorted(bounds, hashes.astype(np.float64), side="right")
 
-def main(sys_args=sys.argv[1:]):
-    start = time.time()
 
-    args = parser.parse_args(sys_args)
+def stratified_splits(peptides, strata, seed, fractions):
+    """Assign the peptides of each stratum to splits in the given proportions.
 
-    # Read the meta data and annotation files
-    meta_data = pd.read_parquet(args.metadata, engine="fastparquet")
-    annotation_df = pd.read_parquet(args.annotation, engine="fastparquet")
+    Peptides are ordered by their hash within each stratum and cut at the cumulative
+    fractions, so the assignment is deterministic without a random shuffle.
+    """
+    df = pd.DataFrame(
+        {"hash": peptide_hashes(peptides, seed), "stratum": np.asarray(strata)}
+    ).sort_values(["stratum", "hash"])
+    groups = df.groupby("stratum", sort=False)
+    rank = groups.cumcount().to_numpy()
+    size = groups["hash"].transform("size").to_numpy()
+    splits = np.empty(len(df), dtype=np.int64)
+    splits[df.index.to_numpy()] = np.searchsorted(
+        np.cumsum(fractions)[:-1], (rank + 0.5) / size, side="right"
+    )
+    return pd.Series(splits, index=pd.Index(peptides))
 
-    # Filter meta data based on Andromeda score threshold
-    initial_size = len(meta_data)
-    print("initial number of peptides", initial_size)
-    meta_data = meta_data[meta_data["SCORE"] > args.threshold]
-    print("removing", initial_size - len(meta_data), "peptides")
-
-    sequence_integer = meta_data["MODIFIED_SEQUENCE"][...]
-    n = sequence_integer.shape[0]
-    n_split = int(n * float(args.trainingsplit))
-    print("training split at: ", n_split, "/", n)
-    print("shuffling peptides")
-    idx = peptide_argsort(sequence_integer, seed=args.seed)
-    del sequence_integer
-    print("shuffling train and test")
-    train_idx, test_idx = argshuffle_splits(idx, n_split)
 
-    if args.splitfile:
-        meta_data_train = meta_data.iloc[train_idx]
-        meta_data_test = meta_data.iloc[test_idx]
+def peptide_strata(metadata_files, criteria, stratify, group_by):
+    """Read the peptides (and their stratum) of all spectra, only the needed columns."""
+    columns = ["modified_sequence", "precursor_charge"]
+    frames = []
+    for file in metadata_files:
+        for batch in iter_parquet_batches(file, BATCH_SIZE, columns, criteria):
+            df = batch.to_pandas()
+            frames.append(
+                pd.DataFrame(
+                    {
+                        "peptide": np.asarray(
+                            peptide_of(df["modified_sequence"], group_by)
+                        ),
+                        "precursor_charge": df["precursor_charge"].to_numpy(),
+                    }
+                )
+            )
+    df = pd.concat(frames, ignore_index=True)
+    if stratify == "charge":
+        strata = df.groupby("peptide")["precursor_charge"].min()
+    else:
+        peptides = pd.Series(df["peptide"].unique())
+        strata = pd.Series(unmodified_lengths(peptides), index=peptides)
+    return strata
+
+
+class SplitWriters:
+    """One ParquetWriter per split, opened with the schema of the first table."""
 
-        annotation_df_train = annotation_df[
-            annotation_df["scan_number"].isin(meta_data_train["SCAN_NUMBER"])
-        ]
-        annotation_df_test = annotation_df[
-            annotation_df["scan_number"].isin(meta_data_test["SCAN_NUMBER"])
-        ]
+    def __init__(self, paths, compression="gzip"):
+        self.paths = paths
+        self.compression = compression
+        self.writers = {}
+        self.rows = [0] * len(paths)
 
-        # Save training + testing annotation and metadata files as parquet files
-        meta_data_train.to_parquet("meta_data_train.parquet", compression="gzip")
-        meta_data_test.to_parquet("meta_data_test.parquet", compression="gzip")
+    def write(self, split, table):
+        if split not in self.writers:
+            self.writers[split] = pq.ParquetWriter(
+                self.paths[split], table.schema, compression=self.compression
+            )
+        writer = self.writers[split]
+        writer.write_table(table.cast(writer.schema))
+        self.rows[split] += table.num_rows
 
-        annotation_df_train.to_parquet("annotation_train.parquet", compression="gzip")
-        annotation_df_test.to_parquet("annotation_test.parquet", compression="gzip")
+    def write_splits(self, table, splits):
+        for split in np.unique(splits):
+            self.write(split, table.filter(pa.array(splits == split)))
 
+    def close(self, schema=None):
+        for split, path in enumerate(self.paths):
+            if split in self.writers:
+                self.writers[split].close()
+            elif schema is not None:
+                pq.write_table(schema.empty_table(), path)
+        return self.rows
+
+
+def split_metadata(
+    metadata_files,
+    paths,
+    criteria,
+    fractions,
+    seed=42,
+    group_by="modified",
+    stratify="none",
+    compression="gzip",
+):
+    """Stream the metadata into one file per split.
+
+    Returns the sorted packed (raw_file, scan_number) keys of the written spectra with
+    their split, and the raw file names of the keys.
+    """
+    peptide_splits = None
+    if stratify != "none":
+        strata = peptide_strata(metadata_files, criteria, stratify, group_by)
+        peptide_splits = stratified_splits(
+            strata.index.to_numpy(), strata.to_numpy(), seed, fractions
+        )
+
+    writers = SplitWriters(paths, compression)
+    raw_files, keys, labels, schema = {}, [], [], None
+    for file in metadata_files:
+        for batch in iter_parquet_batches(file, BATCH_SIZE, criteria=criteria):
+            table = pa.Table.from_batches([batch])
+            schema = table.schema
+            df = table.select(
+                ["raw_file", "scan_number", "modified_sequence"]
+            ).to_pandas()
+
+            # split of each peptide, computed once per unique peptide
+            peptides = peptide_of(df["modified_sequence"], group_by)
+            if peptide_splits is None:
+                category_splits = hash_splits(
+                    peptide_hashes(peptides.categories, seed), fractions
+                )
+            else:
+                category_splits = (
+                    peptide_splits.reindex(peptides.categories).fillna(-1).to_numpy()
+                ).astype(np.int64)
+            splits = category_splits[peptides.codes]
+            writers.write_splits(table, splits)
+
+            for raw_file in as_categorical(df["raw_file"]).categories:
+                raw_files.setdefault(raw_file, len(raw_files))
+            keys.append(
+                spectrum_keys(
+                    df["raw_file"], df["scan_number"], pd.Index(list(raw_files))
+                )
+            )
+            labels.append(splits.astype(np.int8))
+
+    print("Metadata rows per split:", writers.close(schema))
+    keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+    labels = np.concatenate(labels) if labels else np.zeros(0, dtype=np.int8)
+    order = np.argsort(keys, kind="stable")
+    return keys[order], labels[order], pd.Index(list(raw_files))
+
+
+def split_annotations(annotation_files, paths, keys, labels, raw_files, compression):
+    """Stream annotations into the split of their spectrum, dropping unknown spectra."""
+    writers = SplitWriters(paths, compression)
+    schema = None
+    for file in annotation_files:
+        for batch in iter_parquet_batches(file, BATCH_SIZE):
+            table = pa.Table.from_batches([batch])
+            schema = table.schema
+            df = table.select(["raw_file", "scan_number"]).to_pandas()
+            batch_keys = spectrum_keys(df["raw_file"], df["scan_number"], raw_files)
+
+            position = np.searchsorted(keys, batch_keys).clip(0, max(len(keys) - 1, 0))
+            found = (batch_keys >= 0) & (len(keys) > 0)
+            found[found] = keys[position[found]] == batch_keys[found]
+            splits = np.where(found, labels[position] if len(keys) else -1, -1)
+            writers.write_splits(table.filter(pa.array(found)), splits[found])
+    print("Annotation rows per split:", writers.close(schema))
+
+
+def main(sys_args=sys.argv[1:]):
+    start = time.time()
+
+    args = parser.parse_args(sys_args)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.splitfile:
+        names, fractions = parse_splits(args.splits, args.trainingsplit)
     else:
-        dx = train_idx + test_idx
-        meta_data_combined = meta_data.iloc[dx]
-        annotation_combined = annotation_df[
-            annotation_df["scan_number"].isin(meta_data["SCAN_NUMBER"])
-        ]
-
-        meta_data_combined.to_parquet("meta_data_combined.parquet", compression="gzip")
-        annotation_combined.to_parquet(
-            "annotation_combined.parquet", compression="gzip"
+        # filter only, all spectra go to the combined files
+        names, fractions = ["combined"], [1.0]
+    print("Splits:", dict(zip(names, fractions)))
+
+    # Filter meta data based on Andromeda score threshold
+    criteria = {args.score_column: "> {}".format(args.threshold)}
+
+    keys, labels, raw_files = split_metadata(
+        args.metadata,
+        [os.path.join(args.output_dir, f"meta_data_{n}.parquet") for n in names],
+        criteria,
+        fractions,
+        seed=args.seed,
+        group_by=args.group_by,
+        stratify=args.stratify if args.splitfile else "none",
+        compression=args.compression,
+    )
+
+    if args.annotation:
+        split_annotations(
+            args.annotation,
+            [os.path.join(args.output_dir, f"annotation_{n}.parquet") for n in names],
+            keys,
+            labels,
+            raw_files,
+            args.compression,
         )
 
     end = time.time()
@@ -0,0 +1,285 @@
+import os
+import re
+
+from .keys import as_categorical
+
+# one token per residue (with its modification) and per terminal modification
+TOKEN_REGEX = re.compile(r"\[[^\]]*\]-|-\[[^\]]*\]|[A-Z](?:\[[^\]]*\])?")
+# modifications and terminal dashes, removed for the plain amino acid sequence
+MODIFICATION_REGEX = r"\[.*?\]|\-"
+PADDING_TOKEN = ""
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+# residues of the UNIMOD modifications known to spectrum_fundamentals, "^" and "$" stand
+# for the N- and C-terminal modification ("[UNIMOD:1]-" and "-[UNIMOD:2]")
+MODIFIED_RESIDUES = {
+    1: "^KST",
+    2: "$",
+    3: "K",
+    4: "C",
+    5: "^K",
+    6: "C",
+    7: "NQR",
+    21: "STY",
+    23: "STY",
+    24: "C",
+    28: "QE",
+    34: "KR",
+    35: "MPW",
+    36: "KR",
+    37: "K",
+    40: "Y",
+    43: "ST",
+    44: "C",
+    46: "K",
+    47: "C",
+    58: "K",
+    64: "K",
+    122: "K",
+    213: "RS",
+    214: "^KY",
+    259: "K",
+    267: "R",
+    280: "KE",
+    299: "KW",
+    345: "C",
+    351: "W",
+    354: "Y",
+    360: "P",
+    368: "C",
+    385: "C",
+    392: "Y",
+    401: "C",
+    425: "MW",
+    447: "ST",
+    730: "^K",
+    737: "^K",
+    747: "K",
+    1289: "K",
+    1363: "K",
+    1848: "K",
+    1881: "K",
+    1882: "K",
+    1884: "K",
+    1885: "K",
+    1886: "K",
+    1896: "K",
+    1898: "K",
+    1914: "M",
+    2016: "^K",
+}
+
+
+def modification_tokens():
+    tokens = []
+    for accession, residues in MODIFIED_RESIDUES.items():
+        modification = "[UNIMOD:{}]".format(accession)
+        for residue in residues:
+            if residue == "^":
+                tokens.append(modification + "-")
+            elif residue == "$":
+                tokens.append("-" + modification)
+            else:
+                tokens.append(residue + modification)
+    return tokens
+
+
+# token ids are stable for these tokens, others are appended as they are seen
+DEFAULT_VOCABULARY = [PADDING_TOKEN] + list(AMINO_ACIDS) + modification_tokens()
+
+SEQUENCE_COLUMN = "modified_sequence"
+BATCH_SIZE = 1_000_000
+TOKENS_SUFFIX = ".tokens.npz"
+
+
+def split_tokens(sequence):
+    """Split a ProForma sequence into residue and terminal modification tokens."""
+    tokens = TOKEN_REGEX.findall(sequence)
+    if "".join(tokens) != sequence:
+        raise ValueError("Cannot tokenize sequence: {}".format(sequence))
+    return tokens
+
+
+def token_dtype(n_tokens):
+    import numpy as np
+
+    if n_tokens <= 1 << 7:
+        return np.dtype(np.int8)
+    if n_tokens <= 1 << 15:
+        return np.dtype(np.int16)
+    return np.dtype(np.int32)
+
+
+class SequenceTokenizer:
+    """Map modified sequences to integer token arrays, 0 is the padding token.
+
+    Every distinct sequence is split into tokens once and memoised, a column of sequences
+    is encoded through its categories, so the cost grows with the number of peptides and
+    not with the number of spectra:
+
+        tokenizer = SequenceTokenizer()
+        tokens, lengths = tokenizer.encode(df["modified_sequence"])
+        tokenizer.decode(tokens[0])     # "[UNIMOD:737]-PEPTIDEK[UNIMOD:737]"
+
+    Tokens missing from the vocabulary are added, the vocabulary is saved with the
+    encoded sequences.
+    """
+
+    def __init__(self, vocabulary=None):
+        tokens = DEFAULT_VOCABULARY if vocabulary is None else list(vocabulary)
+        if tokens[0] != PADDING_TOKEN:
+            raise ValueError("The first token of the vocabulary must be the padding.")
+        self.vocabulary = {token: i for i, token in enumerate(tokens)}
+        self.memo = {}
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    @property
+    def tokens(self):
+        return list(self.vocabulary)
+
+    def token_ids(self, sequence):
+        ids = self.memo.get(sequence)
+        if ids is None:
+            ids = [
+                self.vocabulary.setdefault(token, len(self.vocabulary))
+                for token in split_tokens(sequence)
+            ]
+            self.memo[sequence] = ids
+        return ids
+
+    def encode_unique(self, sequences, width=None):
+        """Token matrix of distinct sequences and their number of tokens."""
+        import numpy as np
+
+        ids = [self.token_ids(s) for s in sequences]
+        lengths = np.fromiter(map(len, ids), dtype=np.int64, count=len(ids))
+        longest = int(lengths.max()) if len(ids) else 0
+        width = longest if width is None else width
+        if longest > width:
+            raise ValueError(
+                "Sequences with {} tokens do not fit into {} columns.".format(
+                    longest, width
+                )
+            )
+        # scatter the concatenated ids to (row, position in row)
+        starts = np.cumsum(lengths) - lengths
+        positions = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+        matrix = np.zeros((len(ids), width), dtype=token_dtype(len(self)))
+        matrix[np.repeat(np.arange(len(ids)), lengths), positions] = np.fromiter(
+            (i for sequence_ids in ids for i in sequence_ids),
+            dtype=np.int64,
+            count=len(positions),
+        )
+        return matrix, lengths
+
+    def encode(self, sequences, width=None):
+        """Padded (n, width) token array of a column of sequences and their lengths.
+
+        Missing values are encoded as padding only.
+        """
+        import numpy as np
+
+        sequences = as_categorical(sequences)
+        matrix, lengths = self.encode_unique(sequences.categories, width)
+        # code -1 (missing) takes the appended empty row
+        matrix = np.concatenate([matrix, np.zeros_like(matrix[:1])])
+        lengths = np.append(lengths, 0)
+        return matrix[sequences.codes], lengths[sequences.codes]
+
+    def decode(self, tokens):
+        vocabulary = self.tokens
+        return "".join(vocabulary[token] for token in tokens)
+
+
+def plain_categories(sequences):
+    # category codes and the distinct sequences without modifications (Arrow array)
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    sequences = as_categorical(sequences)
+    plain = pc.replace_substring_regex(
+        pa.array(sequences.categories, pa.string()), MODIFICATION_REGEX, ""
+    )
+    return sequences.codes, plain
+
+
+def unmodified(sequences):
+    """Plain amino acid sequences, computed once per distinct sequence."""
+    import numpy as np
+
+    codes, plain = plain_categories(sequences)
+    return np.append(plain.to_numpy(zero_copy_only=False), None)[codes]
+
+
+def unmodified_lengths(sequences):
+    """Number of amino acids of each sequence, without modifications."""
+    import numpy as np
+    import pyarrow.compute as pc
+
+    codes, plain = plain_categories(sequences)
+    lengths = pc.utf8_length(plain).to_numpy(zero_copy_only=False)
+    return np.append(lengths, 0)[codes]
+
+
+def tokens_path(parquet_path):
+    """Default location of the token array of a parquet file, next to the file."""
+    return os.path.splitext(parquet_path)[0] + TOKENS_SUFFIX
+
+
+def tokenize_pool(parquet_path, path=None, tokenizer=None, column=SEQUENCE_COLUMN):
+    """Encode the sequences of a processed pool and save them next to the file.
+
+    The `.tokens.npz` file holds the padded int8 (int16 for large vocabularies) token
+    array with one row per row of the parquet file, the number of tokens per row and
+    the vocabulary. Only the sequence column is read, batch by batch.
+    """
+    import numpy as np
+
+    from .export import pad_columns
+    from .readers import iter_parquet_batches
+
+    tokenizer = tokenizer or SequenceTokenizer()
+    path = path or tokens_path(parquet_path)
+    tokens, lengths = [], []
+    for batch in iter_parquet_batches(parquet_path, BATCH_SIZE, [column]):
+        batch_tokens, batch_lengths = tokenizer.encode(batch.column(0).to_pandas())
+        tokens.append(batch_tokens)
+        lengths.append(batch_lengths)
+
+    dtype = token_dtype(len(tokenizer))
+    width = max([t.shape[1] for t in tokens], default=0)
+    tokens = np.concatenate(
+        [pad_columns(t, width).astype(dtype) for t in tokens]
+        or [np.zeros((0, 0), dtype=dtype)]
+    )
+    lengths = np.concatenate(lengths or [np.zeros(0, dtype=np.int64)])
+    np.savez(
+        path,
+        tokens=tokens,
+        lengths=lengths.astype(np.int16),
+        vocabulary=np.array(tokenizer.tokens),
+    )
+    print("Saved the tokens of {} sequences to {}".format(len(tokens), path))
+    return path
+
+
+def load_tokens(parquet_path, path=None):
+    """Token array, token counts and tokenizer saved by `tokenize_pool`."""
+    import numpy as np
+
+    with np.load(path or tokens_path(parquet_path)) as data:
+        tokenizer = SequenceTokenizer(data["vocabulary"].tolist())
+        return data["tokens"], data["lengths"], tokenizer
+
+
+def load_or_tokenize(parquet_path, path=None):
+    """Load the saved tokens of a pool, tokenizing it only if they are missing or older
+    than the pool."""
+    path = path or tokens_path(parquet_path)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(
+        parquet_path
+    ):
+        tokenize_pool(parquet_path, path)
+    return load_tokens(parquet_path, path)
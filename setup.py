@@ -29,8 +29,6 @@ setuptools.setup(
         "pandas",
         "fastparquet",
         "pyarrow",
-        "requests",
-        "bs4",
         "spectrum_fundamentals @ git+https://github.com/wilhelm-lab/spectrum_fundamentals.git@main",
     ],
     extras_require={
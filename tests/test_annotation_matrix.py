@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from prospectdataset.process_intensity_data import build_annotation_df
+
+AMINO_ACIDS = list("ACDEFGHIKLMNPQRSTVWY")
+
+
+def metadata(n=200, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(7, 35, n)
+    return pd.DataFrame(
+        {
+            "raw_file": rng.choice(["raw_file_1", "raw_file_2", "raw_file_3"], n),
+            "scan_number": np.arange(n) + 1,
+            "modified_sequence": [
+                "".join(rng.choice(AMINO_ACIDS, length)).replace("M", "M[UNIMOD:35]", 1)
+                for length in lengths
+            ],
+            "precursor_charge": rng.integers(1, 5, n),
+        }
+    )
+
+
+def annotations(metadata_df, peaks_per_spectrum=30, seed=0):
+    rng = np.random.default_rng(seed)
+    spectrum = np.repeat(np.arange(len(metadata_df)), peaks_per_spectrum)
+    n = len(spectrum)
+    lengths = (
+        metadata_df["modified_sequence"]
+        .str.replace("[UNIMOD:35]", "", regex=False)
+        .str.len()
+        .to_numpy()
+    )
+    df = pd.DataFrame(
+        {
+            "raw_file": metadata_df["raw_file"].to_numpy()[spectrum],
+            "scan_number": metadata_df["scan_number"].to_numpy()[spectrum],
+            "ion_type": rng.choice(["y", "b"], n),
+            "no": rng.integers(1, lengths[spectrum]),
+            "charge": rng.integers(1, 4, n),
+            "exp_mass": rng.uniform(100, 2000, n),
+            "intensity": rng.uniform(0, 1, n),
+        }
+    )
+    return df.drop_duplicates(
+        subset=["raw_file", "scan_number", "ion_type", "no", "charge"]
+    )
+
+
+def per_scan_loop(annotation_df, metadata_df):
+    # the annotation matrix as it was built before vectorisation
+    annotation = pytest.importorskip("spectrum_fundamentals.annotation.annotation")
+    from spectrum_fundamentals.mod_string import internal_without_mods
+
+    charge_seq = metadata_df.set_index(["raw_file", "scan_number"])
+    intensities_raw, masses_raw = [], []
+    for (raw_file, scan_number), spectrum in annotation_df.groupby(
+        ["raw_file", "scan_number"]
+    ):
+        charge, mod_sequence = charge_seq.loc[
+            (raw_file, scan_number), ["precursor_charge", "modified_sequence"]
+        ]
+        unmod_seq = internal_without_mods([mod_sequence])[0]
+        intensities, mz = annotation.generate_annotation_matrix(
+            spectrum, unmod_seq, charge
+        )
+        intensities_raw.append(intensities)
+        masses_raw.append(mz)
+    return np.stack(intensities_raw), np.stack(masses_raw)
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_build_annotation_df_matches_per_scan_loop(n_jobs):
+    metadata_df = metadata()
+    annotation_df = annotations(metadata_df)
+    expected_intensities, expected_masses = per_scan_loop(annotation_df, metadata_df)
+
+    result = build_annotation_df(
+        annotation_df, metadata_df, dtype="float64", n_jobs=n_jobs, shard_rows=1000
+    )
+    expected_keys = annotation_df[["raw_file", "scan_number"]].drop_duplicates()
+    expected_keys = expected_keys.sort_values(["raw_file", "scan_number"])
+    assert result["raw_file"].astype(str).tolist() == expected_keys["raw_file"].tolist()
+    assert result["scan_number"].tolist() == expected_keys["scan_number"].tolist()
+    assert np.array_equal(np.stack(result["intensities_raw"]), expected_intensities)
+    assert np.array_equal(np.stack(result["masses_raw"]), expected_masses)
+
+
+def test_build_annotation_df_skips_spectra_without_metadata():
+    metadata_df = metadata()
+    annotation_df = annotations(metadata_df)
+    result = build_annotation_df(annotation_df, metadata_df.iloc[10:])
+    assert len(result) == len(metadata_df) - 10
+    assert set(result["scan_number"]) == set(metadata_df["scan_number"].iloc[10:])
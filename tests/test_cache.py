@@ -0,0 +1,78 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from prospectdataset.cache import DatasetCache, file_checksum
+
+
+def add_file(cache, tmp_path, name, size):
+    path = str(tmp_path / name)
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+    checksum = "md5:" + file_checksum(path)
+    return checksum, cache.add("1234", checksum, name, path)
+
+
+def test_add_and_get(tmp_path):
+    cache = DatasetCache(str(tmp_path / "cache"))
+    checksum, cached_path = add_file(cache, tmp_path, "a.parquet", 100)
+    assert not os.path.exists(tmp_path / "a.parquet")
+    assert cache.get("1234", checksum, "a.parquet") == cached_path
+    assert cache.get("1234", "md5:other", "a.parquet") is None
+
+    # a truncated file is not returned
+    with open(cached_path, "wb") as f:
+        f.write(b"x")
+    assert cache.get("1234", checksum, "a.parquet") is None
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = DatasetCache(str(tmp_path / "cache"), max_size=250)
+    a, path_a = add_file(cache, tmp_path, "a.parquet", 100)
+    time.sleep(0.01)
+    b, path_b = add_file(cache, tmp_path, "b.parquet", 100)
+    time.sleep(0.01)
+    cache.get("1234", a, "a.parquet")
+    time.sleep(0.01)
+    add_file(cache, tmp_path, "c.parquet", 100)
+
+    assert cache.get("1234", a, "a.parquet") == path_a
+    assert cache.get("1234", b, "b.parquet") is None
+    assert not os.path.exists(path_b)
+    assert cache.size() == 200
+
+
+def test_linked_files_do_not_count(tmp_path):
+    cache = DatasetCache(str(tmp_path / "cache"), max_size=150)
+    save_directory = tmp_path / "save"
+    save_directory.mkdir()
+    a, path_a = add_file(cache, tmp_path, "a.parquet", 100)
+    linked = cache.link_into(path_a, str(save_directory))
+    assert os.path.samefile(linked, path_a)
+
+    # removing the linked file would not free space, so it is kept
+    add_file(cache, tmp_path, "b.parquet", 100)
+    assert cache.get("1234", a, "a.parquet") == path_a
+    assert cache.evict() == []
+
+
+def add_in_process(cache_dir, directory, name):
+    cache = DatasetCache(cache_dir)
+    checksum, _ = add_file(cache, directory, name, 10)
+    return checksum
+
+
+def test_processes_share_the_index(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    names = ["{}.parquet".format(i) for i in range(16)]
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        checksums = list(
+            executor.map(
+                add_in_process, [cache_dir] * len(names), [tmp_path] * len(names), names
+            )
+        )
+
+    cache = DatasetCache(cache_dir)
+    for checksum, name in zip(checksums, names):
+        assert cache.get("1234", checksum, name) is not None
+    assert cache.size() == 160
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from prospectdataset.dedupe import FRAGMENT_KEYS, MASS_KEYS, dedupe_annotations
+from prospectdataset.keys import encode_dictionary_columns
+
+
+def annotations(n=5000, seed=0):
+    # few distinct values, so that peaks and fragment ions collide
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "raw_file": rng.choice(["a", "b", "c"], n),
+            "scan_number": rng.integers(1, 20, n),
+            "experimental_mass": rng.integers(100, 110, n).astype(float),
+            "ion_type": rng.choice(["y", "b"], n),
+            "no": rng.integers(1, 4, n),
+            "charge": rng.integers(1, 3, n),
+            "fragment_score": rng.integers(0, 5, n).astype(float),
+            "intensity": rng.integers(0, 5, n).astype(np.float32),
+        }
+    )
+
+
+def pandas_dedupe(df):
+    df = df.sort_values(by="fragment_score", ascending=False, kind="stable")
+    df = df.drop_duplicates(subset=MASS_KEYS, keep="first")
+    df = df.sort_values(by="intensity", ascending=False, kind="stable")
+    return df.drop_duplicates(subset=FRAGMENT_KEYS, keep="first")
+
+
+@pytest.mark.parametrize("categorical", [False, True])
+def test_dedupe_matches_pandas(categorical):
+    df = annotations()
+    if categorical:
+        df = encode_dictionary_columns(df)
+    result = dedupe_annotations(df)
+    expected = pandas_dedupe(df)
+    assert result.index.is_monotonic_increasing
+    assert result.index.equals(expected.index.sort_values())
+
+
+def test_dedupe_missing_scores_sort_last():
+    df = annotations(seed=1)
+    df.loc[df.index[::3], "fragment_score"] = np.nan
+    df.loc[df.index[::5], "intensity"] = np.nan
+    result = dedupe_annotations(df)
+    expected = pandas_dedupe(df)
+    assert result.index.equals(expected.index.sort_values())
+
+
+def test_dedupe_without_scores():
+    df = annotations().drop(columns=["fragment_score", "intensity"])
+    expected = df.drop_duplicates(subset=MASS_KEYS).drop_duplicates(
+        subset=FRAGMENT_KEYS
+    )
+    assert dedupe_annotations(df).index.equals(expected.index)
@@ -0,0 +1,137 @@
+import hashlib
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from prospectdataset.download import download_url
+
+CONTENT = bytes(range(256)) * 1000
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serve CONTENT with support for HEAD and single byte range requests."""
+
+    content_length = True
+    ranges = []
+
+    def send_head(self):
+        self.send_header("Accept-Ranges", "bytes")
+        if self.content_length:
+            self.send_header("Content-Length", str(len(CONTENT)))
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_head()
+        self.end_headers()
+
+    def do_GET(self):
+        byte_range = self.headers.get("Range")
+        self.ranges.append(byte_range)
+        if byte_range is None:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(CONTENT)))
+            self.end_headers()
+            self.wfile.write(CONTENT)
+            return
+
+        start, end = re.match(r"bytes=(\d+)-(\d*)", byte_range).groups()
+        start = int(start)
+        end = int(end) if end else len(CONTENT) - 1
+        if start >= len(CONTENT):
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */{}".format(len(CONTENT)))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = CONTENT[start : end + 1]
+        self.send_response(206)
+        self.send_header(
+            "Content-Range", "bytes {}-{}/{}".format(start, end, len(CONTENT))
+        )
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    RangeHandler.content_length = True
+    RangeHandler.ranges = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}/file.bin".format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def md5(data):
+    return "md5:" + hashlib.md5(data).hexdigest()
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_download(server, tmp_path):
+    path = str(tmp_path / "file.bin")
+    download_url(server, path, checksum=md5(CONTENT))
+    assert read(path) == CONTENT
+    assert not os.path.exists(path + ".part")
+
+
+def test_resume_from_part_file(server, tmp_path):
+    path = str(tmp_path / "file.bin")
+    with open(path + ".part", "wb") as f:
+        f.write(CONTENT[:1000])
+    download_url(server, path, checksum=md5(CONTENT))
+    assert read(path) == CONTENT
+    assert RangeHandler.ranges == ["bytes=1000-{}".format(len(CONTENT) - 1)]
+
+
+def test_segmented_download(server, tmp_path):
+    path = str(tmp_path / "file.bin")
+    download_url(
+        server, path, segment_size=100_000, max_segment_workers=2, checksum=md5(CONTENT)
+    )
+    assert read(path) == CONTENT
+    assert sorted(RangeHandler.ranges) == [
+        "bytes=0-99999",
+        "bytes=100000-199999",
+        "bytes=200000-255999",
+    ]
+    assert os.listdir(tmp_path) == ["file.bin"]
+
+
+def test_checksum_mismatch(server, tmp_path):
+    path = str(tmp_path / "file.bin")
+    with pytest.raises(IOError, match="Checksum mismatch"):
+        download_url(server, path, checksum=md5(b"other"))
+    assert os.listdir(tmp_path) == []
+
+
+def test_complete_part_file_of_unknown_size(server, tmp_path):
+    RangeHandler.content_length = False
+    path = str(tmp_path / "file.bin")
+    with open(path + ".part", "wb") as f:
+        f.write(CONTENT)
+    download_url(server, path, checksum=md5(CONTENT))
+    assert read(path) == CONTENT
+    # the 416 answer is not retried
+    assert RangeHandler.ranges == ["bytes={}-".format(len(CONTENT))]
+
+
+def test_stale_part_file_of_unknown_size(server, tmp_path):
+    RangeHandler.content_length = False
+    path = str(tmp_path / "file.bin")
+    with open(path + ".part", "wb") as f:
+        f.write(CONTENT + b"stale")
+    download_url(server, path, checksum=md5(CONTENT))
+    assert read(path) == CONTENT
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+from prospectdataset.index import SpectrumIndex
+
+
+def write_pool(path, raw_files, scans, peaks_per_spectrum=3):
+    # annotation-like pool, row groups of 7 rows split the runs of some spectra
+    n = len(scans) * peaks_per_spectrum
+    df = pd.DataFrame(
+        {
+            "raw_file": np.repeat(raw_files, peaks_per_spectrum),
+            "scan_number": np.repeat(scans, peaks_per_spectrum),
+            "modified_sequence": np.repeat(
+                ["PEP{}K".format(s % 4) for s in scans], peaks_per_spectrum
+            ),
+            "intensity": np.arange(n, dtype=np.float32),
+        }
+    )
+    df.to_parquet(path, row_group_size=7)
+    return df
+
+
+def pools(tmp_path):
+    a = write_pool(str(tmp_path / "a.parquet"), ["r1"] * 5 + ["r2"] * 5, range(10))
+    b = write_pool(str(tmp_path / "b.parquet"), ["r3"] * 4, range(100, 104))
+    return [str(tmp_path / "a.parquet"), str(tmp_path / "b.parquet")], pd.concat(
+        [a, b], ignore_index=True
+    )
+
+
+def test_get_spectra(tmp_path):
+    paths, df = pools(tmp_path)
+    index = SpectrumIndex.build(paths)
+    keys = [("r3", 102), ("r1", 3), ("unknown", 3), ("r2", 9), ("r1", 999)]
+
+    result = index.get_spectra(keys)
+    expected = pd.concat(
+        [df[(df.raw_file == r) & (df.scan_number == s)] for r, s in keys],
+        ignore_index=True,
+    )
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_get_spectra_with_columns(tmp_path):
+    paths, _ = pools(tmp_path)
+    index = SpectrumIndex.build(paths)
+    result = index.get_spectra([("r2", 6)], columns=["intensity"])
+    assert result.columns.tolist() == ["intensity"]
+    assert result["intensity"].tolist() == [18.0, 19.0, 20.0]
+    assert index.get_spectra([("r1", 999)], columns=["intensity"]).empty
+
+
+def test_get_sequences(tmp_path):
+    paths, df = pools(tmp_path)
+    index = SpectrumIndex.build(paths)
+    result = index.get_sequences(["PEP1K", "unknown"])
+    expected = df[df.modified_sequence == "PEP1K"]
+    assert sorted(result["intensity"]) == sorted(expected["intensity"])
+
+
+def test_save_and_load(tmp_path):
+    paths, df = pools(tmp_path)
+    SpectrumIndex.build(paths).save(str(tmp_path / "index" / "pools"))
+    index = SpectrumIndex.load(str(tmp_path / "index" / "pools"))
+    result = index.get_spectra(df[["raw_file", "scan_number"]].drop_duplicates())
+    pd.testing.assert_frame_equal(result, df)
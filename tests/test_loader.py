@@ -0,0 +1,103 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from prospectdataset.loader import BatchLoader
+
+N_ROWS = 95
+
+
+@pytest.fixture
+def pool(tmp_path):
+    # 10 row groups, the last one with 5 rows
+    path = str(tmp_path / "pool.parquet")
+    ids = np.arange(N_ROWS)
+    table = pa.table(
+        {
+            "id": ids,
+            "vector": pa.array(
+                list(np.stack([ids, ids, ids], axis=1).astype(np.float32)),
+                type=pa.list_(pa.float32(), 3),
+            ),
+            "score": ids % 10,
+        }
+    )
+    pq.write_table(table, path, row_group_size=10)
+    return path
+
+
+def epoch_ids(loader):
+    batches = list(loader)
+    assert len(batches) == len(loader)
+    for batch in batches:
+        if "vector" in batch:
+            assert np.array_equal(batch["vector"], np.stack([batch["id"]] * 3, axis=1))
+    return np.concatenate([batch["id"] for batch in batches])
+
+
+@pytest.mark.parametrize("world_size", [1, 2, 3])
+def test_ranks_get_disjoint_equal_shares(pool, world_size):
+    shares = []
+    for rank in range(world_size):
+        loader = BatchLoader(
+            pool,
+            ["id", "vector"],
+            batch_size=8,
+            shuffle_buffer=16,
+            rank=rank,
+            world_size=world_size,
+            num_workers=2,
+        )
+        shares.append(epoch_ids(loader))
+
+    assert len({len(ids) for ids in shares}) == 1
+    ids = np.concatenate(shares)
+    assert len(np.unique(ids)) == len(ids)
+    if world_size == 1:
+        assert sorted(ids) == list(range(N_ROWS))
+
+
+def test_set_epoch_reshuffles_the_same_on_every_rank(pool):
+    loaders = [
+        BatchLoader(pool, ["id"], batch_size=8, rank=rank, world_size=2)
+        for rank in range(2)
+    ]
+    first = [epoch_ids(loader) for loader in loaders]
+    assert [np.array_equal(a, b) for a, b in zip(first, map(epoch_ids, loaders))] == [
+        True,
+        True,
+    ]
+
+    for loader in loaders:
+        loader.set_epoch(1)
+    second = [epoch_ids(loader) for loader in loaders]
+    assert not np.array_equal(first[0], second[0])
+    ids = np.concatenate(second)
+    assert len(np.unique(ids)) == len(ids)
+
+
+def test_unshuffled_drop_last(pool):
+    loader = BatchLoader(pool, ["id"], batch_size=8, shuffle=False, drop_last=True)
+    assert len(loader) == N_ROWS // 8
+    assert list(epoch_ids(loader)) == list(range(N_ROWS // 8 * 8))
+
+
+def test_criteria_keep_ranks_in_step(pool):
+    shares = [
+        epoch_ids(
+            BatchLoader(
+                pool,
+                ["id"],
+                batch_size=4,
+                rank=rank,
+                world_size=2,
+                criteria={"score": "< 3"},
+            )
+        )
+        for rank in range(2)
+    ]
+    assert len(shares[0]) == len(shares[1])
+    ids = np.concatenate(shares)
+    assert (ids % 10 < 3).all()
+    assert len(np.unique(ids)) == len(ids)
@@ -0,0 +1,85 @@
+import os
+import time
+
+import pytest
+
+from prospectdataset import manifest
+from prospectdataset.manifest import (
+    MANIFEST_DIRNAME,
+    ManifestFile,
+    load_manifest,
+    read_manifest,
+    save_manifest,
+)
+
+FILES = [
+    ManifestFile(
+        name="pool_1_meta_data.parquet",
+        size=10,
+        checksum="md5:0",
+        url="https://zenodo.org/pool_1_meta_data.parquet",
+        package="pool",
+        pool="pool_1",
+        kind="meta_data",
+    )
+]
+
+
+@pytest.fixture
+def fetches(monkeypatch):
+    # replace the Zenodo request, record the fetched records
+    records = []
+
+    def fetch_manifest(record, timeout=60):
+        records.append(record)
+        return FILES
+
+    monkeypatch.setattr(manifest, "fetch_manifest", fetch_manifest)
+    return records
+
+
+def cached_path(cache_dir):
+    return os.path.join(cache_dir, MANIFEST_DIRNAME, "6602020.json")
+
+
+def test_fetch_once_and_cache(tmp_path, fetches):
+    cache_dir = str(tmp_path)
+    assert load_manifest("prospect", cache_dir) == FILES
+    assert load_manifest("prospect", cache_dir) == FILES
+    assert fetches == ["prospect"]
+    assert read_manifest(cached_path(cache_dir))[0] == FILES
+
+
+def test_refetch_after_ttl(tmp_path, fetches):
+    cache_dir = str(tmp_path)
+    save_manifest([], cached_path(cache_dir))
+    assert load_manifest("prospect", cache_dir, ttl=3600) == []
+    time.sleep(0.01)
+    assert load_manifest("prospect", cache_dir, ttl=0.001) == FILES
+    assert fetches == ["prospect"]
+
+
+def test_offline_uses_stale_copy(tmp_path, fetches):
+    cache_dir = str(tmp_path)
+    save_manifest([], cached_path(cache_dir))
+    assert load_manifest("prospect", cache_dir, ttl=0, offline=True) == []
+    assert fetches == []
+
+
+def test_offline_without_cached_copy(tmp_path, fetches):
+    with pytest.raises(FileNotFoundError, match="No cached manifest"):
+        load_manifest("prospect", str(tmp_path), offline=True)
+    assert fetches == []
+
+
+def test_fetch_error_falls_back_to_stale_copy(tmp_path, monkeypatch):
+    def fetch_manifest(record, timeout=60):
+        raise OSError("no network")
+
+    monkeypatch.setattr(manifest, "fetch_manifest", fetch_manifest)
+    cache_dir = str(tmp_path)
+    with pytest.raises(OSError):
+        load_manifest("prospect", cache_dir)
+
+    save_manifest(FILES, cached_path(cache_dir))
+    assert load_manifest("prospect", cache_dir, ttl=0) == FILES